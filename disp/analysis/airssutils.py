@@ -3,7 +3,11 @@ Toolkit for working with AIRSS style SHELX files
 
 Collection of function to work with AIRSS
 """
+import io
 import re
+import struct
+import tarfile
+import zipfile
 from collections import namedtuple
 from subprocess import check_output
 
@@ -160,6 +164,9 @@ def _get_res_lines(titl, species, scaled_positions, cellpar, rem_lines=None, spi
 
     if len(titl) != 11:
         raise ValueError("TITL must be a list of length 11.")
+    titl = list(titl)
+    # The symmetry may be parsed including the brackets
+    titl[7] = str(titl[7]).strip("()")
     titl = "{} {:.3f} {:.3f} {:.4f} {:.2f} {:.2f} {} ({}) {} {} {}".format(*titl)
     lines.append("TITL " + titl)
 
@@ -183,11 +190,7 @@ def _get_res_lines(titl, species, scaled_positions, cellpar, rem_lines=None, spi
 
 def unique(items):
     """Get a list of ordered unique items"""
-    out = []
-    for item in items:
-        if item not in out:
-            out.append(item)
-    return out
+    return list(dict.fromkeys(items))
 
 
 def read_res_atoms(lines):
@@ -457,6 +460,551 @@ class RESFile:
         return minsep
 
 
+class RESCollection:
+    """
+    A compact collection of SHELX structures backed by NumPy arrays
+
+    All structures are stored as concatenated arrays instead of one ``RESFile``
+    (and ``pymatgen.Structure``) per entry:
+
+    - ``lattices``: lattice vectors in shape [N, 3, 3]
+    - ``positions``: fractional coordinates of all sites in shape [M, 3]
+    - ``offsets``: start of each structure in ``positions``, shape [N + 1]
+    - ``species``: integer code of each site, indexing ``symbols``
+    - ``spins``: spin of each site (zero if not given)
+    - ``data``: per-structure TITL scalars (label, enthalpy, ...) and REM lines
+
+    Slicing with a unit step returns a new collection sharing the underlying
+    memory. ``RESFile`` objects are only constructed on demand when a single
+    entry is requested.
+    """
+
+    TITL_FIELDS = ("label", "pressure", "volume", "enthalpy", "spin", "spin_abs", "natoms", "symm")
+    ARRAY_FIELDS = ("lattices", "positions", "offsets", "species", "symbols", "spins")
+    _DATA_PREFIX = "data_"
+
+    def __init__(self, lattices, positions, offsets, species, symbols, data, spins=None):
+        """
+        Instantiate a RESCollection from the raw arrays.
+
+        In most cases it is easier to use the class methods such as
+        `from_res_files`, `from_packed` or `load`.
+        """
+        self.lattices = np.asarray(lattices, dtype=float).reshape(-1, 3, 3)
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.species = np.asarray(species, dtype=np.int32)
+        self.symbols = np.asarray(symbols, dtype=str)
+        if spins is None:
+            spins = np.zeros(len(self.positions))
+        self.spins = np.asarray(spins, dtype=float)
+        self.data = {key: np.asarray(value) for key, value in data.items()}
+
+        nstruct = len(self.lattices)
+        if len(self.offsets) != nstruct + 1:
+            raise ValueError("The offsets must have one more element than the number of structures.")
+        nsites = self.offsets[-1] - self.offsets[0]
+        if not len(self.positions) == len(self.species) == len(self.spins) == nsites:
+            raise ValueError("Inconsistent number of sites in positions, species and spins.")
+        for key, value in self.data.items():
+            if len(value) != nstruct:
+                raise ValueError(f"Data field {key} does not match the number of structures.")
+
+    def __len__(self):
+        return len(self.lattices)
+
+    def __repr__(self):
+        return f"<RESCollection with {len(self)} structures and {len(self.positions)} sites>"
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.get_res(idx)
+
+    def __getitem__(self, index):
+        """Return a RESFile for an integer index, otherwise a new RESCollection"""
+        if isinstance(index, (int, np.integer)):
+            return self.get_res(index)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self._slice(start, max(start, stop))
+            return self.take(np.arange(start, stop, step))
+        return self.take(index)
+
+    @property
+    def natoms(self):
+        """Number of atoms in each structure"""
+        return np.diff(self.offsets)
+
+    def _slice(self, start, stop):
+        """Contiguous selection - the underlying arrays are shared"""
+        site_start, site_stop = self.offsets[start], self.offsets[stop]
+        return type(self)(
+            lattices=self.lattices[start:stop],
+            positions=self.positions[site_start:site_stop],
+            offsets=self.offsets[start : stop + 1] - site_start,
+            species=self.species[site_start:site_stop],
+            symbols=self.symbols,
+            spins=self.spins[site_start:site_stop],
+            data={key: value[start:stop] for key, value in self.data.items()},
+        )
+
+    def take(self, indices):
+        """
+        Select structures with an array of integer indices or a boolean mask.
+
+        Unlike contiguous slices, the selected data is copied.
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.nonzero(indices)[0]
+        indices = np.arange(len(self))[indices]
+        counts = self.offsets[indices + 1] - self.offsets[indices]
+        new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(counts, out=new_offsets[1:])
+        # Map each new site to its location in the original site arrays
+        site_idx = np.repeat(self.offsets[indices] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+        return type(self)(
+            lattices=self.lattices[indices],
+            positions=self.positions[site_idx],
+            offsets=new_offsets,
+            species=self.species[site_idx],
+            symbols=self.symbols,
+            spins=self.spins[site_idx],
+            data={key: value[indices] for key, value in self.data.items()},
+        )
+
+    def get_structure(self, idx):
+        """Construct the `pymatgen.Structure` of a single entry"""
+        start, stop = self.offsets[idx], self.offsets[idx + 1]
+        return Structure(self.lattices[idx], self.symbols[self.species[start:stop]].tolist(), self.positions[start:stop])
+
+    def get_res(self, idx):
+        """Construct a `RESFile` view of a single entry"""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} is out of range for collection of size {len(self)}")
+        data = {key: value[idx].item() for key, value in self.data.items() if key not in ("rem", "has_spins")}
+        if "rem" in self.data:
+            rem = self.data["rem"][idx].item()
+            data["rem"] = rem.split("\n") if rem else []
+        if "has_spins" in self.data and self.data["has_spins"][idx]:
+            data["spins"] = self.spins[self.offsets[idx] : self.offsets[idx + 1]].tolist()
+        else:
+            data["spins"] = []
+        return RESFile(self.get_structure(idx), data)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Construct from an iterable of dictionaries with keys: `cell`, `species`,
+        `scaled_positions`, `spins`, `rem_lines` and the TITL fields.
+        """
+        lattices, positions, spins, counts, species = [], [], [], [], []
+        columns = {key: [] for key in cls.TITL_FIELDS}
+        columns["rem"] = []
+        columns["has_spins"] = []
+        for record in records:
+            nsites = len(record["species"])
+            lattices.append(record["cell"])
+            positions.append(np.asarray(record["scaled_positions"], dtype=float).reshape(-1, 3))
+            species.extend(record["species"])
+            counts.append(nsites)
+            has_spins = bool(record.get("spins"))
+            spins.append(np.asarray(record["spins"], dtype=float) if has_spins else np.zeros(nsites))
+            columns["has_spins"].append(has_spins)
+            columns["rem"].append("\n".join(record.get("rem_lines") or []))
+            for key in cls.TITL_FIELDS:
+                columns[key].append(record.get(key))
+
+        symbols, codes = np.unique(np.asarray(species, dtype=str), return_inverse=True)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        data = {}
+        for key, values in columns.items():
+            if key in ("label", "symm", "rem"):
+                data[key] = np.array(["" if value is None else str(value) for value in values], dtype=str)
+            elif key in ("natoms",):
+                data[key] = np.array(counts, dtype=np.int64)
+            elif key == "has_spins":
+                data[key] = np.array(values, dtype=bool)
+            else:
+                data[key] = np.array([np.nan if value is None else value for value in values], dtype=float)
+
+        return cls(
+            lattices=np.array(lattices, dtype=float).reshape(-1, 3, 3),
+            positions=np.concatenate(positions) if positions else np.zeros((0, 3)),
+            offsets=offsets,
+            species=codes.reshape(-1),
+            symbols=symbols,
+            spins=np.concatenate(spins) if spins else np.zeros(0),
+            data=data,
+        )
+
+    @classmethod
+    def from_res_files(cls, res_files):
+        """Construct from an iterable of `RESFile` objects"""
+
+        def _records():
+            for res in res_files:
+                structure = res.structure
+                # The properties give the same defaults as written by `to_res_lines`, e.g. zero spins
+                record = {key: getattr(res, key) for key in cls.TITL_FIELDS}
+                record.update(
+                    {
+                        "cell": structure.lattice.matrix,
+                        "species": [site.symbol for site in structure.species],
+                        "scaled_positions": structure.frac_coords,
+                        "spins": res.spins,
+                        "rem_lines": res.rem,
+                        "volume": res.volume,
+                    }
+                )
+                yield record
+
+        return cls.from_records(_records())
+
+    @classmethod
+    def from_packed(cls, fname):
+        """
+        Construct from a packed file of concatenated SHELX entries.
+
+        The structures are parsed directly into arrays without going through `pymatgen`.
+        """
+
+        def _records():
+            with open(fname) as stream:
+                lines = []
+                for line in stream:
+                    if line.startswith("END"):
+                        yield _res_record(lines)
+                        lines = []
+                    else:
+                        lines.append(line)
+
+        return cls.from_records(_records())
+
+    def to_dataframe(self, norm_mode="per_atom"):
+        """
+        Collect the data into a `pandas.DataFrame`, similar to that returned by `collect_res_in_df`.
+
+        Instead of storing the `RESFile` objects, a `res_index` column is included which can be
+        used to obtain the structures with `get_res` or `take`.
+        """
+        from pymatgen.core import Composition  # pylint: disable=import-outside-toplevel
+
+        dframe = pd.DataFrame({key: value for key, value in self.data.items() if key not in ("rem", "has_spins")})
+        dframe["res_index"] = np.arange(len(self))
+
+        # Count the species in each structure, compositions are only constructed once for each unique row
+        counts = np.zeros((len(self), len(self.symbols)), dtype=np.int64)
+        np.add.at(counts, (np.repeat(np.arange(len(self)), self.natoms), self.species), 1)
+        unique_counts, inverse = np.unique(counts, axis=0, return_inverse=True)
+        props = []
+        for row in unique_counts:
+            comp = Composition({str(symbol): int(count) for symbol, count in zip(self.symbols, row) if count > 0})
+            props.append(
+                (comp.formula.replace(" ", ""), comp.reduced_formula, comp.get_reduced_formula_and_factor()[1], comp.chemical_system)
+            )
+        props = [props[i] for i in inverse.reshape(-1)]
+        for i, key in enumerate(["formula", "reduced_formula", "nform", "chemsys"]):
+            dframe[key] = [item[i] for item in props]
+
+        normalise_energy_volume(dframe, norm_mode)
+        return dframe
+
+    def iter_res_strings(self, chunk_size=10000):
+        """
+        Iterate through the SHELX representation of each entry.
+
+        The formatting is vectorised over chunks of `chunk_size` structures.
+
+        Yields:
+            tuple of (label, content) for each structure
+        """
+        for start in range(0, len(self), chunk_size):
+            chunk = self._slice(start, min(start + chunk_size, len(self)))
+            yield from zip(chunk.data["label"].tolist(), format_res_entries(chunk))
+
+    def write_packed(self, fname, chunk_size=10000):
+        """Write all structures into a single packed SHELX file"""
+        with open(fname, "w") as fhandle:
+            for start in range(0, len(self), chunk_size):
+                chunk = self._slice(start, min(start + chunk_size, len(self)))
+                fhandle.write("".join(format_res_entries(chunk)))
+
+    def write_tar(self, fname, chunk_size=10000):
+        """
+        Write all structures as `<label>.res` members of a tar archive.
+
+        The compression is inferred from the file name, e.g. `export.tar.gz`.
+        Repeated labels are suffixed with `-1`, `-2`, ... so each member has a unique name.
+        """
+        used = set()
+        with tarfile.open(fname, tar_write_mode(fname)) as archive:
+            for label, content in self.iter_res_strings(chunk_size=chunk_size):
+                name, count = label, 0
+                while name in used:
+                    count += 1
+                    name = f"{label}-{count}"
+                used.add(name)
+                add_tar_member(archive, name + ".res", content)
+
+    def save(self, fname):
+        """
+        Save the collection as an uncompressed `.npz` file.
+
+        Uncompressed archives allow the arrays to be memory-mapped with `load(fname, mmap_mode='r')`.
+        """
+        arrays = {key: getattr(self, key) for key in self.ARRAY_FIELDS}
+        arrays.update({self._DATA_PREFIX + key: value for key, value in self.data.items()})
+        np.savez(fname, **arrays)
+
+    @classmethod
+    def load(cls, fname, mmap_mode=None):
+        """
+        Load a collection saved by `save`.
+
+        Args:
+            fname (str): Path to the `.npz` file
+            mmap_mode (str, optional): If given, memory-map the arrays instead of reading them into memory.
+        """
+        if mmap_mode is None:
+            with np.load(fname) as npz:
+                arrays = {key: npz[key] for key in npz.files}
+        else:
+            arrays = _mmap_npz(fname, mmap_mode)
+        data = {key[len(cls._DATA_PREFIX) :]: value for key, value in arrays.items() if key.startswith(cls._DATA_PREFIX)}
+        return cls(data=data, **{key: arrays[key] for key in cls.ARRAY_FIELDS})
+
+
+def format_res_entries(collection):
+    """
+    Format all structures of a `RESCollection` in the SHELX format.
+
+    The site lines of all structures are assembled at once in a byte buffer with
+    vectorised fixed-point formatting, instead of per-site Python string formatting.
+
+    Returns:
+        A list of strings, one for each structure, each terminated by `END`.
+    """
+    nstruct = len(collection)
+    if nstruct == 0:
+        return []
+    natoms = collection.natoms
+    nsym = len(collection.symbols)
+    data = collection.data
+
+    # Label the species with their order of appearance within each structure
+    row = np.repeat(np.arange(nstruct), natoms)
+    key = row * nsym + collection.species
+    ukeys, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    order = np.lexsort((first, ukeys // nsym))
+    sorted_rows = (ukeys // nsym)[order]
+    rank = np.empty(len(ukeys), dtype=np.int64)
+    rank[order] = np.arange(len(ukeys)) - np.searchsorted(sorted_rows, sorted_rows)
+    sfac_idx = rank[inverse.reshape(-1)] + 1
+    sfac_bounds = np.searchsorted(sorted_rows, np.arange(nstruct + 1))
+    sfac_symbols = collection.symbols[ukeys[order] % nsym]
+
+    has_spins = data.get("has_spins", np.zeros(nstruct, dtype=bool))
+    site_text, line_ends = _format_site_lines(
+        collection.symbols[collection.species], sfac_idx, collection.positions, collection.spins, np.repeat(has_spins, natoms)
+    )
+
+    # Plain lists are much faster to index than arrays in the per-structure loop
+    columns = zip(*(data[key].tolist() for key in ("label", "pressure", "volume", "enthalpy", "spin", "spin_abs", "symm")))
+    rems = data["rem"].tolist() if "rem" in data else [""] * nstruct
+    cellpars = cell_to_cellpar_array(collection.lattices).tolist()
+    sfac_symbols = sfac_symbols.tolist()
+    sfac_bounds = sfac_bounds.tolist()
+    line_ends = line_ends[collection.offsets - collection.offsets[0]].tolist()
+    natoms = natoms.tolist()
+    entries = []
+    for idx, (label, pressure, volume, enthalpy, spin, spin_abs, symm) in enumerate(columns):
+        lines = [
+            "TITL {} {:.3f} {:.3f} {:.4f} {:.2f} {:.2f} {} ({}) n - 1".format(
+                label, pressure, volume, enthalpy, spin, spin_abs, natoms[idx], str(symm).strip("()")
+            )
+        ]
+        if rems[idx]:
+            lines.extend("REM " + line for line in rems[idx].split("\n"))
+        lines.append("CELL 1.0 {:<12.6f} {:<12.6f} {:<12.6f} {:<12.6f} {:<12.6f} {:<12.6f}".format(*cellpars[idx]))
+        lines.append("LATT -1")
+        lines.append("SFAC " + " ".join(sfac_symbols[sfac_bounds[idx] : sfac_bounds[idx + 1]]))
+        lines.append(site_text[line_ends[idx] : line_ends[idx + 1]] + "END\n")
+        entries.append("\n".join(lines))
+    return entries
+
+
+def _format_site_lines(symbols, sfac_idx, positions, spins, with_spins):
+    """
+    Format the SHELX site lines of all sites into a single string.
+
+    Returns:
+        A tuple of the text, with each line terminated by a newline, and the character
+        offsets of the line endings with a leading zero, so that the lines of sites
+        `i` to `j` are `text[ends[i]:ends[j]]`.
+    """
+    nsites = len(symbols)
+    symbol_table = np.unique(symbols)
+    coords = [_format_fixed(positions[:, i], 20, 13) for i in range(3)]
+    spin_field = _format_fixed(spins, 8, 3)
+    if (
+        any(len(symbol) > 4 for symbol in symbol_table.tolist())
+        or (nsites and sfac_idx.max() > 99)
+        or any(field is None for field in coords + [spin_field])
+    ):
+        # Fall back to plain string formatting for fields that do not fit the fixed widths
+        lines = []
+        for symbol, idx, (x, y, z), spin, flag in zip(symbols, sfac_idx, positions, spins, with_spins):
+            line = "%-4s %-2d %20.13f %20.13f %20.13f 1.0" % (symbol, idx, x, y, z)
+            lines.append(line + (" %8.3f" % spin if flag else "") + "\n")
+        ends = np.zeros(nsites + 1, dtype=np.int64)
+        np.cumsum([len(line) for line in lines], out=ends[1:])
+        return "".join(lines), ends
+
+    # Fixed-width fields: symbol (5), SFAC index (3), coordinates (3 x 21), "1.0", spin (9) and newline
+    buffer = np.full((nsites, 84), ord(" "), dtype=np.uint8)
+    symbol_bytes = np.array([symbol.ljust(5) for symbol in symbol_table.tolist()], dtype="S5").view(np.uint8).reshape(-1, 5)
+    buffer[:, 0:5] = symbol_bytes[np.searchsorted(symbol_table, symbols)]
+    sfac_bytes = np.array(["%-2d " % i for i in range(100)], dtype="S3").view(np.uint8).reshape(-1, 3)
+    buffer[:, 5:8] = sfac_bytes[sfac_idx]
+    for i, field in enumerate(coords):
+        buffer[:, 8 + 21 * i : 28 + 21 * i] = field
+    buffer[:, 71:74] = np.frombuffer(b"1.0", dtype=np.uint8)
+    buffer[:, 75:83] = spin_field
+    buffer[:, 83] = ord("\n")
+
+    # Drop the spin columns of the sites without spins
+    keep = np.ones(buffer.shape, dtype=bool)
+    keep[~with_spins, 74:83] = False
+    ends = np.zeros(nsites + 1, dtype=np.int64)
+    np.cumsum(np.where(with_spins, 84, 75), out=ends[1:])
+    return buffer[keep].tobytes().decode("ascii"), ends
+
+
+def _format_fixed(values, width, precision):
+    """
+    Vectorised equivalent of `'%{width}.{precision}f' % value`.
+
+    The digits are extracted with integer arithmetic, hence the last digit may occasionally
+    differ from Python's formatting due to rounding.
+
+    Returns:
+        An uint8 array of the ASCII characters in shape [N, width], or None if any value
+        does not fit into the given width.
+    """
+    values = np.asarray(values, dtype=float)
+    out = np.full((len(values), width), ord(" "), dtype=np.uint8)
+    if len(values) == 0:
+        return out
+    magnitude = np.abs(values)
+    if not np.all(np.isfinite(values)) or magnitude.max() >= 1e18:
+        return None
+    # Splitting off the integer part is exact, which keeps the rounding error of the scaling small
+    int_float = np.floor(magnitude)
+    frac_part = np.rint((magnitude - int_float) * 10**precision).astype(np.int64)
+    carry = frac_part == 10**precision
+    int_part = int_float.astype(np.int64) + carry
+    frac_part[carry] = 0
+    ndigits = np.ones(len(values), dtype=np.int64)
+    for power in range(1, 19):
+        ndigits += int_part >= 10**power
+    negative = np.signbit(values)
+    if (ndigits + precision + 1 + negative).max() > width:
+        return None
+
+    for col in range(width - 1, width - 1 - precision, -1):
+        frac_part, digit = np.divmod(frac_part, 10)
+        out[:, col] = ord("0") + digit
+    point = width - 1 - precision
+    out[:, point] = ord(".")
+    for i in range(ndigits.max()):
+        int_part, digit = np.divmod(int_part, 10)
+        out[:, point - 1 - i] = np.where(i < ndigits, ord("0") + digit, ord(" "))
+    rows = np.nonzero(negative)[0]
+    out[rows, point - 1 - ndigits[rows]] = ord("-")
+    return out
+
+
+def tar_write_mode(fname):
+    """Return the mode for writing a tar archive with the compression inferred from the file name"""
+    for suffix in ("gz", "bz2", "xz"):
+        if str(fname).endswith("." + suffix):
+            return "w:" + suffix
+    return "w"
+
+
+def add_tar_member(archive, name, content):
+    """Add a member to an opened tar archive with the content given as a string"""
+    encoded = content.encode()
+    info = tarfile.TarInfo(name=name)
+    info.size = len(encoded)
+    archive.addfile(info, io.BytesIO(encoded))
+
+
+def cell_to_cellpar_array(lattices):
+    """Vectorised conversion of lattice vectors in shape [N, 3, 3] to cell parameters in shape [N, 6]"""
+    lengths = np.linalg.norm(lattices, axis=2)
+    angles = []
+    for i, j in ((1, 2), (0, 2), (0, 1)):
+        cosine = np.einsum("ij,ij->i", lattices[:, i], lattices[:, j]) / (lengths[:, i] * lengths[:, j])
+        angles.append(np.degrees(np.arccos(np.clip(cosine, -1.0, 1.0))))
+    return np.concatenate([lengths, np.stack(angles, axis=1)], axis=1)
+
+
+def _res_record(lines):
+    """Parse the lines of a single SHELX entry into a record for `RESCollection.from_records`"""
+    out = _read_res(lines)
+    if not out["titl"]:
+        raise ValueError("No TITL line found in the SHELX entry")
+    record = out["titl"]._asdict()
+    record.update(
+        {
+            "cell": cellpar_to_cell(out["cellpar"]),
+            "species": out["species"],
+            "scaled_positions": out["scaled_positions"],
+            "spins": out["spins"],
+            "rem_lines": out["rem_lines"],
+        }
+    )
+    return record
+
+
+def _mmap_npz(fname, mode="r"):
+    """
+    Memory-map the arrays stored in an uncompressed `.npz` file.
+
+    `numpy.load` ignores `mmap_mode` for `.npz` archives, but members stored without
+    compression are contiguous in the file so they can be mapped directly.
+    """
+    readers = {(1, 0): np.lib.format.read_array_header_1_0, (2, 0): np.lib.format.read_array_header_2_0}
+    arrays = {}
+    with zipfile.ZipFile(fname) as archive, open(fname, "rb") as fhandle:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Cannot memory-map compressed member {info.filename} in {fname}")
+            # Skip the local file header, whose extra field may differ from the central directory
+            fhandle.seek(info.header_offset)
+            header = fhandle.read(30)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            fhandle.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(fhandle)
+            shape, fortran_order, dtype = readers[version](fhandle)
+            if dtype.hasobject:
+                raise ValueError(f"Cannot memory-map object array {info.filename} in {fname}")
+            key = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if int(np.prod(shape)) == 0:
+                arrays[key] = np.empty(shape, dtype=dtype)
+            else:
+                order = "F" if fortran_order else "C"
+                arrays[key] = np.memmap(fname, dtype=dtype, mode=mode, offset=fhandle.tell(), shape=shape, order=order)
+    return arrays
+
+
 def read_ca(lines):
     """
     Read results from `ca` into a DataFrame
@@ -546,15 +1094,7 @@ def collect_results_in_df(norm_mode="per_atom", include_doc=False, qset=None, **
 
     dframe = pd.DataFrame(records)
 
-    # Normalise the energy and volumes
-    if norm_mode == "per_atom":
-        dframe["H"] = dframe["enthalpy"] / dframe["natoms"]
-        dframe["V"] = dframe["volume"] / dframe["natoms"]
-    else:
-        dframe["H"] = dframe["enthalpy"] / dframe["nform"]
-        dframe["V"] = dframe["volume"] / dframe["nform"]
-    dframe.sort_values("H", inplace=True)
-
+    normalise_energy_volume(dframe, norm_mode)
     return dframe
 
 
@@ -568,8 +1108,11 @@ def collect_res_in_df(res_collection, norm_mode="per_atom"):
 
     Returns:
         A `pandas.DataFrame` object contains the data collected from the collection
-        of RESFile objects.
+        of RESFile objects. If a `RESCollection` is passed, the `res` column is replaced
+        by a `res_index` column pointing to the entries of the collection.
     """
+    if isinstance(res_collection, RESCollection):
+        return res_collection.to_dataframe(norm_mode=norm_mode)
 
     records = []
     for res in res_collection:
@@ -583,7 +1126,18 @@ def collect_res_in_df(res_collection, norm_mode="per_atom"):
         records.append(entry)
 
     dframe = pd.DataFrame(records)
-    # Normalise the energy and volumes
+    normalise_energy_volume(dframe, norm_mode)
+    return dframe
+
+
+def normalise_energy_volume(dframe, norm_mode="per_atom"):
+    """
+    Add normalised enthalpy (H) and volume (V) columns in-place and sort by the former
+
+    Args:
+        dframe (DataFrame): DataFrame with `enthalpy`, `volume`, `natoms` and `nform` columns
+        norm_mode (str): Normalise per atom (`per_atom`) or otherwise per formula unit.
+    """
     if norm_mode == "per_atom":
         dframe["H"] = dframe["enthalpy"] / dframe["natoms"]
         dframe["V"] = dframe["volume"] / dframe["natoms"]
@@ -591,7 +1145,6 @@ def collect_res_in_df(res_collection, norm_mode="per_atom"):
         dframe["H"] = dframe["enthalpy"] / dframe["nform"]
         dframe["V"] = dframe["volume"] / dframe["nform"]
     dframe.sort_values("H", inplace=True)
-
     return dframe
 
 
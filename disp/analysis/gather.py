@@ -10,7 +10,7 @@ from pymatgen.core import Structure
 from pymatgen.entries.computed_entries import ComputedEntry
 from pymatgen.io.vasp.inputs import Poscar
 
-from disp.analysis.airssutils import RESFile
+from disp.analysis.airssutils import RESCollection, RESFile
 from disp.database import SearchDB
 
 
@@ -153,26 +153,44 @@ def get_entry(
     return pd_entries
 
 
-def export_dataframe_as_res(dataframe: pd.DataFrame, comment: str = "VASP export", extra_comments: list = None, stress_key=None):
+def export_dataframe_as_res(
+    dataframe: pd.DataFrame, comment: str = "VASP export", extra_comments: list = None, stress_key=None, output: str = None
+):
     """
     Write all of the structure in a dataframe into RES format for export and visualisation
+
+    Args:
+        output (str, optional): Write into a single file instead of one file per structure
+          under `exports`. A name ending with `.res` gives a packed SHELX file, while a `.tar`,
+          `.tar.gz`, `.tar.bz2` or `.tar.xz` name gives an archive of `<label>.res` members.
     """
-    comments = [comment, *extra_comments]
-    for _, row in dataframe.iterrows():
-        relaxed = row.pmg_struct_relaxed
-        res = RESFile(
-            relaxed,
-            {
-                "enthalpy": row.energy_per_atom * len(relaxed.sites),
-                "volume": row.volume_per_fu * row.nform_refine,
-                # The stress data may not existsk
-                "pressure": 0.0 if stress_key in row.index or stress_key is None else row[stress_key],
-                "label": row.label,
-                "rem": comments + [f"{key} = {row[key]}" for key in row.index if "struct" not in key],
-            },
-        )
-        content = "\n".join(res.to_res_lines())
-        Path(f"exports/{row.label}.res").write_text(content)
+    comments = [comment, *(extra_comments or [])]
+
+    def _res_files():
+        for _, row in dataframe.iterrows():
+            relaxed = row.pmg_struct_relaxed
+            yield RESFile(
+                relaxed,
+                {
+                    "enthalpy": row.energy_per_atom * len(relaxed.sites),
+                    "volume": row.volume_per_fu * row.nform_refine,
+                    # The stress data may not existsk
+                    "pressure": 0.0 if stress_key in row.index or stress_key is None else row[stress_key],
+                    "label": row.label,
+                    "rem": comments + [f"{key} = {row[key]}" for key in row.index if "struct" not in key],
+                },
+            )
+
+    collection = RESCollection.from_res_files(_res_files())
+    if output is None:
+        for label, content in collection.iter_res_strings():
+            Path(f"exports/{label}.res").write_text(content)
+    elif str(output).endswith(".res"):
+        collection.write_packed(output)
+    elif ".tar" in Path(output).name:
+        collection.write_tar(output)
+    else:
+        raise ValueError(f"Cannot infer the output format from file name: {output}")
 
 
 def get_pressure_gpa(stress: list):
@@ -0,0 +1,210 @@
+"""
+Pool of pre-generated random structures
+
+Generating random structures with `buildcell` can take minutes for hard seeds, during
+which the cores allocated for the relaxation sit idle. The pool keeps a small queue of
+ready structures per seed on the local file system, which is topped up in the background
+(e.g. by `trlaunch --buildcell_pool_workers`), so that the build tasks can take a
+structure instantly.
+
+The layout of the pool folder is:
+
+  <POOL_DIR>
+  |- <SEED_HASH>
+     |- seed.cell         the content of the seed
+     |- last_request      touched whenever a structure of this seed is requested
+     |- <UUID>.cell       ready structures
+
+Structures are written to temporary files and renamed when complete, and taken by
+renaming them to a unique name, so multiple producers and consumers can share a pool.
+"""
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from uuid import uuid4
+
+from disp.database import get_hash
+
+__all__ = ("BuildcellPool", "run_buildcell", "POOL_ENV_VAR")
+
+POOL_ENV_VAR = "DISP_BUILDCELL_POOL"
+
+
+def run_buildcell(seed_content, timeout=300, cwd=None):
+    """
+    Run buildcell for a seed and return the generated structure
+
+    Args:
+      seed_content (str): Content of the seed
+      timeout (float): Timeout in seconds, the buildcell process is killed if exceeded
+      cwd (str): Working directory for running buildcell
+
+    Raises:
+      subprocess.TimeoutExpired: If buildcell does not finish in time
+
+    Returns:
+      str: Content of the generated structure
+    """
+    proc = subprocess.Popen(
+        "buildcell",
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        cwd=cwd,
+    )
+    try:
+        stdout, _ = proc.communicate(seed_content, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
+    return stdout
+
+
+class BuildcellPool:
+    """A file system based pool of pre-generated structures"""
+
+    def __init__(self, pool_dir, depth=4, build_timeout=300, max_idle=3600):
+        """
+        Instantiate a pool
+
+        Args:
+          pool_dir (str): Folder of the pool
+          depth (int): Number of ready structures to keep for each seed
+          build_timeout (float): Timeout for each buildcell run
+          max_idle (float): Seeds not requested within this number of seconds are not topped up
+        """
+        self.pool_dir = Path(pool_dir)
+        self.depth = depth
+        self.build_timeout = build_timeout
+        self.max_idle = max_idle
+
+    @classmethod
+    def from_env(cls, fw_env=None):
+        """
+        Construct the pool from the `buildcell_pool` key of the worker's env or
+        the DISP_BUILDCELL_POOL environmental variable
+
+        Returns:
+          A BuildcellPool instance, or None if no pool is configured.
+        """
+        pool_dir = (fw_env or {}).get("buildcell_pool", os.environ.get(POOL_ENV_VAR))
+        if not pool_dir:
+            return None
+        return cls(pool_dir)
+
+    def seed_dir(self, seed_content):
+        """Return the folder for a seed"""
+        return self.pool_dir / get_hash(seed_content)
+
+    def register(self, seed_content):
+        """Register a seed so that the producers start generating structures for it"""
+        seed_dir = self.seed_dir(seed_content)
+        seed_dir.mkdir(parents=True, exist_ok=True)
+        seed_file = seed_dir / "seed.cell"
+        if not seed_file.is_file():
+            self._write_atomic(seed_file, seed_content)
+        (seed_dir / "last_request").touch()
+        return seed_dir
+
+    def pop(self, seed_content):
+        """
+        Take a ready structure for a seed, the seed is registered as requested
+
+        Returns:
+          The content of the structure, or None if the pool for this seed is empty
+        """
+        seed_dir = self.register(seed_content)
+        for candidate in sorted(seed_dir.glob("*.cell")):
+            if candidate.name == "seed.cell":
+                continue
+            claimed = seed_dir / f".claimed-{uuid4().hex}"
+            try:
+                os.rename(candidate, claimed)
+            except FileNotFoundError:
+                # Taken by another consumer
+                continue
+            content = claimed.read_text()
+            claimed.unlink()
+            return content
+        return None
+
+    def count(self, seed_dir):
+        """Number of ready structures in the folder of a seed"""
+        return sum(1 for path in Path(seed_dir).glob("*.cell") if path.name != "seed.cell")
+
+    def get_active_seeds(self):
+        """Return the folders of the seeds that have been requested recently"""
+        if not self.pool_dir.is_dir():
+            return []
+        now = time.time()
+        active = []
+        for seed_dir in self.pool_dir.iterdir():
+            stamp = seed_dir / "last_request"
+            try:
+                if (seed_dir / "seed.cell").is_file() and now - stamp.stat().st_mtime < self.max_idle:
+                    active.append(seed_dir)
+            except FileNotFoundError:
+                continue
+        return active
+
+    def generate(self, seed_dir):
+        """
+        Generate a structure for a seed and add it to the pool
+
+        Returns:
+          True if a structure has been added.
+        """
+        seed_dir = Path(seed_dir)
+        try:
+            content = run_buildcell((seed_dir / "seed.cell").read_text(), timeout=self.build_timeout, cwd=str(seed_dir))
+        except subprocess.TimeoutExpired:
+            return False
+        if not content.strip():
+            return False
+        self._write_atomic(seed_dir / f"{time.time():.6f}-{uuid4().hex[:8]}.cell", content)
+        return True
+
+    def get_jobs(self):
+        """Return a list of seed folders to generate structures for, one entry per missing structure"""
+        jobs = []
+        for seed_dir in self.get_active_seeds():
+            jobs.extend([seed_dir] * max(self.depth - self.count(seed_dir), 0))
+        return jobs
+
+    def fill(self, nworkers=1):
+        """
+        Top up the pool for all active seeds
+
+        Returns:
+          int: Number of structures generated
+        """
+        jobs = self.get_jobs()
+        if not jobs:
+            return 0
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            return sum(executor.map(self.generate, jobs))
+
+    def run(self, nworkers=1, interval=5, stop_after=None):
+        """
+        Keep the pool topped up
+
+        Args:
+          nworkers (int): Number of buildcell processes to run concurrently
+          interval (float): Time to wait between checks if nothing needs to be generated
+          stop_after (float): Stop after this many seconds, run forever if None
+        """
+        deadline = None if stop_after is None else time.monotonic() + stop_after
+        while deadline is None or time.monotonic() < deadline:
+            if self.fill(nworkers) == 0:
+                time.sleep(interval)
+
+    @staticmethod
+    def _write_atomic(path, content):
+        """Write the content to a temporary file and rename it"""
+        tmp_path = path.with_name(f".tmp-{uuid4().hex}")
+        tmp_path.write_text(content)
+        os.replace(tmp_path, path)
@@ -1,33 +1,36 @@
 """
 Module for analyse CASTEP run time statistics
 """
-import re
-from collections import namedtuple
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
+from disp.casteptools import CastepOutputParser
+
 # pylint: disable=import-outside-toplevel
 
 
 class SCFInfo:
     """Class for storing an extracting information of SCF convergence"""
 
-    SCF_LINE = re.compile(r"^ +([0-9]+) +([+-.E0-9]+) +([+-.E0-9]+) +([+-.E0-9]+) +([.0-9]+) +<-- SCF")
-    ScfData = namedtuple("ScfData", ["loops", "energies", "fermi_energies", "gains", "timers"])
+    SCF_LINE = CastepOutputParser.SCF_LINE
+    ScfData = CastepOutputParser.ScfData
 
     def __init__(self, castep_file):
         """Construct an SCFInfo object given the name of the seed"""
         self.filename = castep_file
-        with open(castep_file) as fhandle:
-            self.scf_data = self.parse(fhandle)
-        self.compute_converge_data()
+        self._parser = CastepOutputParser(castep_file)
+        self.reload()
 
     def __len__(self):
         return len(self.scf_data)
 
     def reload(self):
-        with open(self.filename) as fhandle:
-            self.scf_data = self.parse(fhandle)
+        """Reload the file, only the newly appended content is parsed"""
+        self.scf_data = self._parser.update().scf_loops
+        self.compute_converge_data()
 
     def parse(self, lines):
         """
@@ -41,26 +44,7 @@ class SCFInfo:
         Returns:
           A list of data include all SCF loops
         """
-        scf_loops = []
-        pattern = self.SCF_LINE
-        # Collect all SCF data
-        for line in lines:
-            match = pattern.match(line)
-            if not match:
-                continue
-
-            loop = int(match.group(1))
-            # Initialise storage space for first cycle
-            if loop == 1:
-                loops, engs, fermi_engs, gains, timers = [], [], [], [], []
-                scf_loops.append(self.ScfData(loops=loops, energies=engs, fermi_energies=fermi_engs, gains=gains, timers=timers))
-
-            loops.append(loop)
-            engs.append(float(match.group(2)))
-            fermi_engs.append(float(match.group(3)))
-            gains.append(float(match.group(4)))
-            timers.append(float(match.group(5)))
-        return scf_loops
+        return CastepOutputParser().feed(lines).scf_loops
 
     def compute_converge_data(self):
         """
@@ -144,3 +128,63 @@ class SCFInfo:
         if show:
             fig.tight_layout()
             fig.show()
+
+
+def get_castep_summary(castep_file):
+    """Obtain the summary of a CASTEP output file with plain python types"""
+    summary = SCFInfo(castep_file).get_summary()
+    return {key: int(value) if key == "ionic_steps" else float(value) for key, value in summary.items()}
+
+
+def get_castep_summaries(castep_files, cache_file=None, nproc=None):
+    """
+    Obtain the summaries of many CASTEP output files
+
+    The files are parsed in parallel using a pool of processes. If a cache file is
+    given, the summaries are stored along with the size and modification time of each file,
+    and only new or modified files are parsed in the subsequent calls.
+
+    Args:
+      castep_files (list): Paths of the CASTEP output files
+      cache_file (str): Path to the JSON file for caching the summaries
+      nproc (int): Number of processes to use, default to the number of CPUs
+
+    Returns:
+      A list of summary dictionaries in the same order as `castep_files`
+    """
+    cache = {}
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file) as fhandle:
+            cache = json.load(fhandle)
+
+    summaries = [None] * len(castep_files)
+    to_parse = []
+    for idx, fname in enumerate(castep_files):
+        key = os.path.abspath(fname)
+        stat = os.stat(fname)
+        entry = cache.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            summaries[idx] = entry["summary"]
+        else:
+            to_parse.append((idx, key, stat))
+
+    if not to_parse:
+        return summaries
+
+    paths = [key for _, key, _ in to_parse]
+    if nproc == 1 or len(paths) == 1:
+        parsed = list(map(get_castep_summary, paths))
+    else:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            parsed = list(pool.map(get_castep_summary, paths, chunksize=max(1, len(paths) // 64)))
+
+    for (idx, key, stat), summary in zip(to_parse, parsed):
+        summaries[idx] = summary
+        cache[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "summary": summary}
+
+    if cache_file:
+        tmp_name = cache_file + ".tmp"
+        with open(tmp_name, "w") as fhandle:
+            json.dump(cache, fhandle)
+        os.replace(tmp_name, cache_file)
+    return summaries
@@ -9,12 +9,13 @@ import re
 import shutil
 import time
 import uuid
+from collections import OrderedDict, namedtuple
 
 import ase.io
 import numpy as np
 import spglib
 
-from .utils import filter_out_stream, trim_stream
+from .utils import filter_out_stream, read_tail, trim_stream
 
 # pylint: disable=too-many-function-args, invalid-name
 
@@ -56,24 +57,165 @@ pattern_geom = r"""
 \ *$
 """
 
-pattern_time = r"""
-^\ +
-[0-9]+                      # Loop number
-\ +
-[+-.E0-9]+                   # Energy
-\ +
-[+-.E0-9]+                   # Fermi Energy
-\ +
-[+-.E0-9]+                   # Energy gain per atom
-\ +
-([.0-9]+)                      # Timer
-\ +
-<--\ SCF
-$
-"""
+
+class CastepOutputParser:
+    """
+    Incremental single-pass parser of CASTEP output (.castep) files
+
+    The SCF loops, geometry optimisation iterations and timings are recorded in a single
+    pass. Calling `update` again only parses the lines appended since the last call, resuming
+    from the recorded byte offset. Whether the run has finished is checked by `castep_finish_ok`.
+    """
+
+    ScfData = namedtuple("ScfData", ["loops", "energies", "fermi_energies", "gains", "timers"])
+    SCF_LINE = re.compile(r"^ +([0-9]+) +([+-.E0-9]+) +([+-.E0-9]+) +([+-.E0-9]+) +([.0-9]+) +<-- SCF")
+    GEOM_LINE = re.compile(pattern_geom, re.VERBOSE)
+    ITER_START = re.compile(r" Starting \w+ iteration")
+    GEOM_STATUS = re.compile(r"Geometry optimization (\w+)")
+
+    def __init__(self, path=None):
+        """
+        Instantiate a parser
+
+        Args:
+          path: Path to the .castep file. May be omitted if only `feed` is used.
+        """
+        self.path = path
+        self._file_id = None
+        self.reset()
+
+    def reset(self):
+        """Reset the parsed data"""
+        self.offset = 0
+        self.nlines = 0
+        self.scf_loops = []
+        self.enthalpies = []
+        self.iter_num = []
+        self.iter_times = []
+        self.save_times = []
+        self.save_iter = []
+        self.geom_name = None
+        self.unit = None
+        self.geom_status = None
+        self.iter_started = 0  # Number of 'Starting <method> iteration' lines
+        self.geom_count = 0  # Number of '<method>: starting iteration' lines
+        self.finished_iterations = 0
+        self.last_time = 0.0
+
+    def update(self):
+        """
+        Parse the lines appended to the file since the last call
+
+        The data are reset if the file has been replaced or truncated.
+        Only complete lines are consumed, so a partially written line is parsed in the next call.
+        """
+        stat = os.stat(self.path)
+        file_id = (stat.st_dev, stat.st_ino)
+        if file_id != self._file_id or stat.st_size < self.offset:
+            self.reset()
+            self._file_id = file_id
+        if stat.st_size == self.offset:
+            return self
+        with open(self.path, "rb") as fhandle:
+            fhandle.seek(self.offset)
+            self.feed(self._iter_complete_lines(fhandle))
+        return self
+
+    def _iter_complete_lines(self, fhandle):
+        """Iterate through the complete lines of a binary stream while advancing the offset"""
+        for raw in fhandle:
+            if not raw.endswith(b"\n"):
+                break
+            self.offset += len(raw)
+            yield raw.decode(errors="replace")
+
+    def feed(self, lines):
+        """Parse an iterable of lines"""
+        for line in lines:
+            self.nlines += 1
+            # Capture timing of SCF
+            if "<-- SCF" in line:
+                match = self.SCF_LINE.match(line)
+                if match:
+                    self._add_scf_line(match)
+                continue
+
+            if "iteration" in line:
+                # Capture the start of iteration
+                if self.ITER_START.match(line):
+                    self.iter_started += 1
+                if "starting iteration" in line:
+                    self.geom_count += 1
+                # Capture the end of gemo iteration
+                if ": finished iteration" in line:
+                    self.finished_iterations += 1
+                    geom_match = self.GEOM_LINE.match(line)
+                    if geom_match:
+                        self.enthalpies.append(float(geom_match.group("H")))
+                        self.iter_num.append(int(geom_match.group("number")))
+                        self.iter_times.append(self.last_time)
+                        self.geom_name = geom_match.group("name")
+                        self.unit = geom_match.group("unit")
+
+            # Capture timing of save and iteration numbers(current)
+            if "Writing model" in line:
+                self.save_times.append(self.last_time)
+                self.save_iter.append(self.iter_started)
+            elif "Geometry optimization" in line:
+                match = self.GEOM_STATUS.search(line)
+                if match:
+                    self.geom_status = match.group(1)
+        return self
+
+    def _add_scf_line(self, match):
+        """Record a line of the SCF loop"""
+        loop = int(match.group(1))
+        # Initialise storage space for first cycle
+        if loop == 1 or not self.scf_loops:
+            self.scf_loops.append(self.ScfData(loops=[], energies=[], fermi_energies=[], gains=[], timers=[]))
+        data = self.scf_loops[-1]
+        data.loops.append(loop)
+        data.energies.append(float(match.group(2)))
+        data.fermi_energies.append(float(match.group(3)))
+        data.gains.append(float(match.group(4)))
+        self.last_time = float(match.group(5))
+        data.timers.append(self.last_time)
+
+    def get_geom_data(self):
+        """Return the information of the geometry optimisation as a dictionary"""
+        return dict(
+            H=list(self.enthalpies),
+            iter_num=list(self.iter_num),
+            name=self.geom_name,
+            unit=self.unit,
+            time=list(self.iter_times),
+            save_iter=list(self.save_iter),
+            save_times=list(self.save_times),
+        )
+
+
+_PARSER_CACHE = OrderedDict()
+_PARSER_CACHE_SIZE = 16
+
+
+def get_castep_output(dot_castep):
+    """
+    Return an up-to-date `CastepOutputParser` for a .castep file
+
+    Parsers are kept for the most recently used files, so repeated calls only
+    parse the content appended in between.
+    """
+    key = os.path.abspath(dot_castep)
+    parser = _PARSER_CACHE.pop(key, None)
+    if parser is None:
+        parser = CastepOutputParser(key)
+    _PARSER_CACHE[key] = parser
+    while len(_PARSER_CACHE) > _PARSER_CACHE_SIZE:
+        _PARSER_CACHE.popitem(last=False)
+    return parser.update()
 
 
-def parse_dot_castep(fb, aggregate=False):  # pylint: disable=too-many-locals
+def parse_dot_castep(fb, aggregate=False):
     """Parse information from an castep file based on a file handle
     Extract information of geometry convergence
     Return a dictionary with keys:
@@ -82,53 +224,10 @@ def parse_dot_castep(fb, aggregate=False):  # pylint: disable=too-many-locals
         name: Name of the method
         unit: unit for enthalpy
     """
-    iter_start = re.compile(r" Starting \w+ iteration")
-    sfc_line = re.compile(pattern_time, re.VERBOSE)
-    match_geom = re.compile(pattern_geom, re.VERBOSE)
-
-    # Storage space for capture properties
-    eng = []  # Enthalpy list
-    iter_num = []  # Raw iteration array
-    iter_times = []  # Raw timing of finished iteration
-    save_times = []  # Raw timing of saves
-    save_iter = []  # Iteration in which writing checkpoint took place
-    geom_name, unit = None, None
-
-    # In loop variables
-    last_time = 0
-    current_iter = 0
-
-    # Iterate through the file
-    for line in fb:
-        # Capture the start of iteration
-        if iter_start.match(line):
-            current_iter += 1
-            continue
-
-        # Capture timing of save and iteration numbers(current)
-        if "Writing model" in line:
-            save_times.append(last_time)
-            save_iter.append(current_iter)
-
-        # Capture timing of SFC
-        scf_match = sfc_line.match(line)
-        if scf_match:
-            last_time = float(scf_match.group(1))
-            continue
-
-        # Capture the end of gemo iteration
-        geom_match = match_geom.match(line)
-        if geom_match:
-            eng.append(float(geom_match.group("H")))
-            iter_num.append(int(geom_match.group("number")))
-            iter_times.append(float(last_time))
-            geom_name = geom_match.group("name")
-            unit = geom_match.group("unit")
-            continue
-
-    out = dict(H=eng, iter_num=iter_num, name=geom_name, unit=unit, time=iter_times, save_iter=save_iter, save_times=save_times)
+    out = CastepOutputParser().feed(fb).get_geom_data()
     if aggregate:
         # Need to aggregate the timer
+        iter_times = out["time"]
         timer_array = np.array(iter_times)
         last_record = 0
         for i, time_record in enumerate(iter_times):
@@ -321,27 +420,12 @@ def castep_finish_ok(dot_castep):
     """Check for the hint of CASTEP finshed OK"""
     if not os.path.isfile(dot_castep):
         return False
-
-    with open(dot_castep) as fhandle:
-        lines = fhandle.readlines()
-
-    last_few = lines[-20:]
-    ok = False
-    for line in last_few:
-        if "Total time" in line:
-            ok = True
-            break
-    return ok
+    return any("Total time" in line for line in read_tail(dot_castep, 20))
 
 
 def castep_geom_count(dot_castep):
     """Count the number of geom cycles"""
-    count = 0
-    with open(dot_castep) as fhandle:
-        for line in fhandle:
-            if "starting iteration" in line:
-                count += 1
-    return count
+    return get_castep_output(dot_castep).geom_count
 
 
 def push_cell(cellout, cell):
@@ -368,15 +452,32 @@ def push_cell(cellout, cell):
     os.remove(cellout)
 
 
-def gulp_relax_finish_ok(dot_castep):
-    """Check the relaxation of gulp_relax"""
+def gulp_relax_finish_ok(dot_castep, nlines=50, natoms=0):
+    """
+    Check the relaxation of gulp_relax
+
+    The final enthalpy is followed by the final structure, hence it is looked for in the last
+    `nlines` lines plus one line for each of the `natoms` atoms of the structure.
+    """
     if not os.path.isfile(dot_castep):
         return False
 
-    with open(dot_castep) as fh:
-        content = fh.read()
+    pattern = re.compile(r"Final Enthalpy += ([-e0-9\.]+)")
+    return any(pattern.search(line) for line in read_tail(dot_castep, nlines + natoms))
 
-    mathch = re.search(r"Final Enthalpy += ([-e0-9\.]+)", content)
-    if mathch:
-        return True
-    return False
+
+def count_cell_atoms(cell_file):
+    """Count the atoms in the positions block of a .cell file"""
+    natoms = 0
+    in_block = False
+    with open(cell_file) as fhandle:
+        for line in fhandle:
+            tokens = line.lower().split()
+            if tokens[:2] in (["%block", "positions_frac"], ["%block", "positions_abs"]):
+                in_block = True
+            elif tokens[:1] == ["%endblock"] and in_block:
+                break
+            # Skip the unit line and the comments
+            elif in_block and len(tokens) >= 4 and not tokens[0].startswith(("#", "!")):
+                natoms += 1
+    return natoms
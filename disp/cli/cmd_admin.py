@@ -88,6 +88,94 @@ def update_category(sdb, seed, project, category):
         update_spec(sdb, seed, project, {"_category": category}, confirm=True)
 
 
+@admin.command("update-runtimes")
+@click.option("--seed", help="Only update the fireworks of this seed")
+@click.option("--project", help="Only update the fireworks of this project")
+@click.option("--percentile", default=90, type=float, show_default=True, help="Percentile of the time per step and the number of steps.")
+@click.option("--margin", default=1.3, type=float, show_default=True, help="Factor applied to the predicted run time for the walltime.")
+@click.option("--dryrun", is_flag=True, help="Only show the model without updating the fireworks.")
+@pass_db_obj
+def update_runtimes(sdb, seed, project, percentile, margin, dryrun):
+    """
+    Fit the run time model to the completed launches and update the walltime of the READY fireworks
+    """
+    from tabulate import tabulate
+
+    from disp.fws.runtime import RuntimeModel, collect_samples, update_ready_fireworks
+
+    lpad: LaunchPad = sdb.lpad
+    model = RuntimeModel.fit(collect_samples(lpad), percentile=percentile)
+    keys = ["seed_name", "code", "nsamples", "natoms", "step_time", "steps", "overhead"]
+    click.echo(tabulate([[group[key] for key in keys] for group in model.groups.values()], headers=keys))
+    if model.worker_factors:
+        click.echo(tabulate(sorted(model.worker_factors.items()), headers=["worker", "factor"]))
+
+    query = {}
+    if seed:
+        query["spec.seed_name"] = seed
+    if project:
+        query["spec.project_name"] = project
+    if not dryrun:
+        model.save(lpad)
+    nupdated = update_ready_fireworks(lpad, model, margin=margin, query=query, dryrun=dryrun)
+    click.echo(f"Model fitted to {model.nsamples} samples, {nupdated} READY fireworks {'to be ' if dryrun else ''}updated.")
+
+
+@admin.command("scale-arrays")
+@click.option("-w", "--fworker-file", required=True, help="Worker file of the array jobs, its query selects the fireworks counted.")
+@click.option("--job-name", required=True, help="Name of the array jobs to be controlled.")
+@click.option("--scheduler", "scheduler_name", type=click.Choice(["slurm", "pbs", "lsf"]), default="slurm", show_default=True)
+@click.option("--fws-per-job", default=10, type=int, show_default=True, help="Number of fireworks each job is expected to run.")
+@click.option("--min-priority", type=int, help="Only count the fireworks with at least this priority.")
+@click.option("--max-jobs", type=int, help="Maximum number of running and pending jobs.")
+@click.option(
+    "--submit", "submit_script", type=click.Path(exists=True, dir_okay=False), help="Job script to submit if more jobs are needed."
+)
+@click.option("--max-submit", default=100, type=int, show_default=True, help="Maximum number of tasks of a submitted array.")
+@click.option("--interval", type=int, help="Repeat every this many seconds instead of running once.")
+@click.option("--dryrun", is_flag=True, help="Only show the actions without applying them.")
+@pass_db_obj
+def scale_arrays(  # pylint: disable=too-many-arguments
+    sdb, fworker_file, job_name, scheduler_name, fws_per_job, min_priority, max_jobs, submit_script, max_submit, interval, dryrun
+):
+    """
+    Hold, release or submit array jobs to match the queued jobs to the READY fireworks
+    """
+    import time
+
+    from disp.fws.scaling import ArrayScaler
+    from disp.fws.worker import WalltimeAwareFWorker
+    from disp.scheduler import LSF, PBS, Slurm
+
+    scaler = ArrayScaler(
+        sdb.lpad,
+        {"slurm": Slurm, "pbs": PBS, "lsf": LSF}[scheduler_name](),
+        WalltimeAwareFWorker.from_file(fworker_file),
+        job_name,
+        fws_per_job=fws_per_job,
+        min_priority=min_priority,
+        max_jobs=max_jobs,
+        submit_script=submit_script,
+        max_submit=max_submit,
+    )
+    while True:
+        backlog, queue, actions = scaler.step(dryrun=dryrun)
+        click.echo(
+            f"Backlog: {sum(backlog.values())} fireworks, jobs wanted: {actions['wanted']}, "
+            f"running: {queue['running']}, pending: {queue['pending']}, held: {queue['held']}"
+        )
+        prefix = "To be " if dryrun else ""
+        for key, label in [("hold", "held"), ("release", "released")]:
+            if actions[key]:
+                arrays = ",".join(dict.fromkeys(str(task["array_id"]) for task in actions[key]))
+                click.echo(f"{prefix}{label}: {len(actions[key])} tasks of {arrays}")
+        if actions["submit"]:
+            click.echo(f"{prefix}submitted: {actions['submit']} tasks {actions.get('submitted', '')}")
+        if not interval:
+            break
+        time.sleep(interval)
+
+
 @admin.command("delete-entries")
 @click.option("--project", required=True)
 @click.option("--seed", required=False, help="Select seeds by regex")
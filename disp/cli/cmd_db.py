@@ -4,6 +4,7 @@ Module containing the database related CLI commands
 import json
 import os
 import subprocess
+import tarfile
 from collections import namedtuple
 from pathlib import Path
 
@@ -239,9 +240,12 @@ def get_launch_info(fws, query):
 @click.option("--raw", is_flag=True, help="Raw format, no header.")
 @click.option("--pull", is_flag=True, help="Pull the data using rsync")
 @click.option("--pull-mapping", help="A dictionary maps user names to remote machines names.")
+@click.option("--max-transfers", default=4, show_default=True, help="Maximum number of concurrent rsync transfers.")
+@click.option("--chunk-size", default=200, show_default=True, help="Maximum number of launch directories per rsync call.")
+@click.option("--force", is_flag=True, help="Pull all launch directories regardless of the manifest.")
 @common_query_options
 @pass_db_obj
-def launch_dirs(db_obj, project, seed, query, state, raw, pull, pull_mapping):
+def launch_dirs(db_obj, project, seed, query, state, raw, pull, pull_mapping, max_transfers, chunk_size, force):
     """
     Display information about the launch directories.
 
@@ -251,7 +255,13 @@ def launch_dirs(db_obj, project, seed, query, state, raw, pull, pull_mapping):
     remote machine "remote1", pass `--pull-mapping '{"user1": "remote1"}'`.
     For this to work the user name must present in the full paths, which is
     usually the case. rsync will be used for data transfer.
+
+    The transfers are run concurrently, and successfully pulled directories are
+    recorded in a manifest file in the current folder. Directories of finished
+    fireworks that have been pulled already are skipped in the subsequent calls,
+    so an interrupted pull can be resumed by running the same command again.
     """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
 
     # Here it assumed that the db collection is at the same as that of the
     # fireworks collection under the same mongodb 'database'
@@ -275,52 +285,119 @@ def launch_dirs(db_obj, project, seed, query, state, raw, pull, pull_mapping):
     mapping = json.loads(pull_mapping)  # pylint: disable=eval-used
     click.echo(f"Mapping of the remote hosts: {mapping}")
 
-    # Group entry in to different machines
-    machines_and_paths = {}
+    manifest = {} if force else load_pull_manifest()
+    jobs, nskipped = plan_pull_jobs(data, mapping, manifest, chunk_size)
+    if nskipped:
+        click.echo(f"Skipping {nskipped} launch directories that are up to date.")
+
+    # Call rsync to pull the working directories, the manifest is updated as each transfer finishes
+    with ThreadPoolExecutor(max_workers=max_transfers) as pool:
+        futures = {
+            pool.submit(subprocess.call, get_rsync_command(machine, parent, infos)): (machine, infos) for machine, parent, infos in jobs
+        }
+        for future in as_completed(futures):
+            machine, infos = futures[future]
+            if future.result() != 0:
+                click.echo(f"WARNING: rsync failed for {len(infos)} launch directories from machine: {machine}")
+                continue
+            manifest.update({info.launch_dir: info.state for info in infos})
+            save_pull_manifest(manifest)
+            click.echo(f"Pulled {len(infos)} launch directories from machine: {machine}")
+    click.echo(table)
+
+
+PULL_MANIFEST = ".disp_pull_manifest.json"
+LAUNCH_STATS_CACHE = ".disp_launch_stats_cache.json"
+# States of the fireworks whose launch directories are no longer modified
+FINISHED_STATES = ("COMPLETED", "FIZZLED", "DEFUSED")
+
+
+def load_pull_manifest(fname=PULL_MANIFEST):
+    """Load the manifest of pulled launch directories and their states at the time of pulling"""
+    if not os.path.isfile(fname):
+        return {}
+    with open(fname) as fhandle:
+        return json.load(fhandle)
+
+
+def save_pull_manifest(manifest, fname=PULL_MANIFEST):
+    """Save the manifest of pulled launch directories"""
+    tmp_name = fname + ".tmp"
+    with open(tmp_name, "w") as fhandle:
+        json.dump(manifest, fhandle)
+    os.replace(tmp_name, fname)
+
+
+def plan_pull_jobs(data, mapping, manifest, chunk_size):
+    """
+    Group the launch directories to be pulled by remote machines and parent folders
+
+    Args:
+        data: A list of `FWInfo` returned by `get_launch_info`
+        mapping: A dictionary of key words in the paths and the corresponding remote machines
+        manifest: A dictionary of the pulled launch directories and their states
+        chunk_size: Maximum number of launch directories in each job
+
+    Returns:
+        A tuple of the list of jobs as (machine, parent, infos), and the number of skipped launch directories.
+    """
+    groups = {}
+    nskipped = 0
     for info in data:
-        # Populate machine_and_paths dictionary
+        if not info.launch_dir:
+            continue
+        # Launch directories of finished fireworks only need to be pulled once
+        if info.state in FINISHED_STATES and manifest.get(info.launch_dir) == info.state:
+            nskipped += 1
+            continue
         for key, value in mapping.items():
             if key in info.launch_dir:
-                if value not in machines_and_paths:
-                    machines_and_paths[value] = []
-                machines_and_paths[value].append(info.launch_dir)
+                groups.setdefault((value, os.path.split(info.launch_dir)[0]), []).append(info)
                 break
 
-    # Call rsync to pull the working directories
-    for key, value in machines_and_paths.items():
-        click.echo(f"Pulling data from machine: {key}")
-        cmd = ["rsync", "-av"]
-        parent = os.path.split(value[0])[0]
-        for path in value:
-            dirname = os.path.split(path)[1]
-            cmd.append(f"--include={dirname}/***")
-
-        cmd.extend(["--exclude=*", f"{key}:{parent}/", "./"])
-        subprocess.call(cmd)
-    click.echo(table)
+    jobs = []
+    for (machine, parent), infos in groups.items():
+        for i in range(0, len(infos), chunk_size):
+            jobs.append((machine, parent, infos[i : i + chunk_size]))
+    return jobs, nskipped
+
+
+def get_rsync_command(machine, parent, infos):
+    """Construct the rsync command for pulling launch directories under the same parent folder"""
+    cmd = ["rsync", "-a"]
+    for info in infos:
+        dirname = os.path.split(info.launch_dir)[1]
+        cmd.append(f"--include={dirname}/***")
+    cmd.extend(["--exclude=*", f"{machine}:{parent}/", "./"])
+    return cmd
 
 
 @db.command("launch-stats")
 @common_query_options
 @click.option("--cycles", type=int, help="Expected ionic steps for computing the projected time.")
+@click.option("--nproc", type=int, help="Number of processes for parsing the CASTEP files, default to the number of CPUs.")
+@click.option("--cache/--no-cache", default=True, show_default=True, help="Cache the parsed results of the CASTEP files.")
 @pass_db_obj
-def launch_stats(db_obj, project, seed, query, state, cycles):
+def launch_stats(db_obj, project, seed, query, state, cycles, nproc, cache):
     """
     (experimental) Obtain statistics of the runs using snapshots pulled down to
     the local directory.
+
+    The parsed results are cached in a file in the current directory, and only the
+    CASTEP files that have been changed since (e.g. pulled again) are parsed again.
     """
     from glob import glob
 
     import pandas as pd
 
-    from disp.castep_analysis import SCFInfo
+    from disp.castep_analysis import get_castep_summaries
 
     query = generate_fw_query(project, seed, state, query)
     # DataFrame contains the basic data
     dframe = pd.DataFrame(get_launch_info(db_obj.database.fireworks, query))
     dframe["workdir"] = dframe["launch_dir"].apply(lambda x: os.path.split(x)[1])
 
-    summaries = []
+    workdirs, castep_files = [], []
     for _, row in dframe.iterrows():
         workdir = row.workdir
         castep_file = list(glob(workdir + "/*.castep"))
@@ -329,11 +406,13 @@ def launch_stats(db_obj, project, seed, query, state, cycles):
                 ("WARNING: requested FW <{}> of <{}>-" "<{}> is not avalible locally").format(row.fw_id, row.project_name, row.seed_name)
             )
             continue
-        castep_file = castep_file[0]
-        _summary = SCFInfo(castep_file).get_summary()
+        workdirs.append(workdir)
+        castep_files.append(castep_file[0])
+
+    summaries = get_castep_summaries(castep_files, cache_file=LAUNCH_STATS_CACHE if cache else None, nproc=nproc)
+    for workdir, castep_file, _summary in zip(workdirs, castep_files, summaries):
         _summary["workdir"] = workdir
         _summary["castep_file"] = castep_file
-        summaries.append(_summary)
 
     if not summaries:
         click.echo("No data to show - did you forget to pull runs using launch-dirs?")
@@ -364,6 +443,13 @@ def launch_stats(db_obj, project, seed, query, state, cycles):
     click.echo(tabulate(to_show, headers="keys"))
 
 
+def _validate_output_name(ctx, param, value):  # pylint: disable=unused-argument
+    """Check that the output name gives either a packed SHELX file or a tar archive"""
+    if value is None or value.endswith(".res") or ".tar" in Path(value).name:
+        return value
+    raise click.BadParameter(f"Cannot infer the output format from file name: {value}")
+
+
 @db.command("retrieve-project")
 @click.option("--project", required=True)
 @click.option("--seed", required=False, help="Select seeds by regex")
@@ -371,11 +457,22 @@ def launch_stats(db_obj, project, seed, query, state, cycles):
 @click.option("--include-init-structure/--no-include-init-structure", default=False)
 @click.option("--include-seed/--no-include-seed", default=False)
 @click.option("--include-param/--no-include-param", default=False)
+@click.option(
+    "--output",
+    "-o",
+    help="Write into a single packed SHELX file (*.res) or a tar archive (*.tar, *.tar.gz, *.tar.bz2, *.tar.xz) instead",
+    callback=_validate_output_name,
+)
+@click.option("--workers", default=4, show_default=True, help="Number of threads for writing the files")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of documents to retrieve in each batch")
 @pass_db_obj
-def retrieve_project(db_obj, project, seed, struct_name, include_init_structure, include_seed, include_param):
+def retrieve_project(
+    db_obj, project, seed, struct_name, include_init_structure, include_seed, include_param, output, workers, batch_size
+):
     """
     Retrieve the RES files for a particular project
     """
+    from concurrent.futures import ThreadPoolExecutor
 
     click.echo(f"Retrieving data for project: {project}")
     filters = {}
@@ -383,24 +480,61 @@ def retrieve_project(db_obj, project, seed, struct_name, include_init_structure,
         filters["seed_name"] = {"$regex": seed}
     if struct_name:
         filters["struct_name"] = {"$regex": struct_name}
-    results = db_obj.retrieve_project(
+    total = db_obj.retrieve_project(project_name=project, additional_filters=filters).count()
+    batches = db_obj.iter_project_records(
         project_name=project,
         additional_filters=filters,
         include_seed=include_seed,
         include_param=include_param,
         include_initial_structure=include_init_structure,
+        batch_size=batch_size,
     )
     click.echo("Writing files to disk...")
-    # Write data to the disk
-    total = results.count()
-    for res in tqdm(results, total=total):
-        Path(res["struct_name"] + ".res").write_text(res.content)
-        # Write additional contents
-        if res.param_file:
-            Path(res["struct_name"] + ".param").write_text(res.param_file.content)
-        if res.init_structure_file:
-            Path(res["struct_name"] + "-orig.cell").write_text(res.init_structure_file.content)
-        if res.seed_file:
-            Path(res["struct_name"] + "-seed.cell").write_text(res.seed_file.content)
+
+    pbar = tqdm(total=total)
+    if output and output.endswith(".res"):
+        if include_seed or include_param or include_init_structure:
+            click.echo("Warning: only the SHELX files are included in a packed file.")
+        with open(output, "w") as fhandle:
+            for batch in batches:
+                fhandle.write("".join(_ensure_newline(record["content"]) for record in batch))
+                pbar.update(len(batch))
+    elif output:
+        # Any other name has been rejected by _validate_output_name
+        from disp.analysis.airssutils import add_tar_member, tar_write_mode
+
+        with tarfile.open(output, tar_write_mode(output)) as archive:
+            for batch in batches:
+                for name, content in _iter_retrieved_files(batch):
+                    add_tar_member(archive, name, content)
+                pbar.update(len(batch))
+    else:
+        # Files of a batch are written by the pool while the next batch is being retrieved
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for batch in batches:
+                for future in pending:
+                    future.result()
+                pending = [pool.submit(Path(name).write_text, content) for name, content in _iter_retrieved_files(batch)]
+                pbar.update(len(batch))
+            for future in pending:
+                future.result()
+    pbar.close()
 
     click.echo("Done")
+
+
+RETRIEVED_SUFFIXES = {"content": ".res", "param": ".param", "init_structure": "-orig.cell", "seed": "-seed.cell"}
+
+
+def _iter_retrieved_files(batch):
+    """Iterate through the (name, content) of the files to be written for a batch of retrieved records"""
+    for record in batch:
+        for key, suffix in RETRIEVED_SUFFIXES.items():
+            if record.get(key):
+                yield record["struct_name"] + suffix, record[key]
+
+
+def _ensure_newline(content):
+    """Ensure the content ends with a new line"""
+    return content if content.endswith("\n") else content + "\n"
@@ -10,8 +10,10 @@ from ase.io import read
 from fireworks.core.firework import Workflow
 from fireworks.core.launchpad import LaunchPad
 
+from disp.fws.blobs import BlobStore
+from disp.fws.bulk import bulk_add_from_template
 from disp.fws.utils import isolated_filesystem
-from disp.fws.works import AirssSearchFW, RelaxFW, SinglePointFW
+from disp.fws.works import AirssBatchSearchFW, AirssSearchFW, RelaxFW, SinglePointFW
 from disp.tools.modcell import modify_cell
 
 # pylint: disable=invalid-name, too-many-arguments, import-outside-toplevel, too-many-locals
@@ -33,6 +35,12 @@ def deploy(ctx):
 
 
 pass_lpad = click.make_pass_decorator(LaunchPad)
+use_blobs_option = click.option(
+    "--use-blobs",
+    is_flag=True,
+    default=False,
+    help="Store the seed, parameter and structure contents once in the blob collection and reference them by hash in the fireworks.",
+)
 
 
 @deploy.command("info")
@@ -78,9 +86,35 @@ def info(lpad):
     "--castep-code", show_default=True, default="default", help="Alias for resolving the CASTEP executable, as define in the worker file."
 )
 @click.option("--cluster", is_flag=True, default=False)
+@click.option(
+    "--batch-size",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Number of structures to be searched in sequence within each firework. Batches are continued if the walltime runs out.",
+)
+@use_blobs_option
 @pass_lpad
 def deploy_search(
-    lpad, code, seed, project, num, exe, cycles, keep, wf_name, dryrun, priority, category, gzip, record_db, modcell, castep_code, cluster
+    lpad,
+    code,
+    seed,
+    project,
+    num,
+    exe,
+    cycles,
+    keep,
+    wf_name,
+    dryrun,
+    priority,
+    category,
+    gzip,
+    record_db,
+    modcell,
+    castep_code,
+    cluster,
+    batch_size,
+    use_blobs,
 ):
     """
     Deploy the search by uploading it to the Fireserver
@@ -108,48 +142,37 @@ def deploy_search(
         category = list(category)
         spec["_category"] = category
 
-    build_fws = []
     if wf_name is None:
         wf_name = f"{project}-{seed}"
 
     # Adding cell modifications
-    if modcell is not None:
-        tokens = modcell.split(":")
-        if len(tokens) == 2:
-            modcell_name = tokens[1]
-            modcell_content = Path(tokens[0]).read_text()
-        elif len(tokens) == 1:
-            modcell_name = modcell
-            modcell_content = None
-    else:
-        modcell_content = None
-        modcell_name = None
-
-    for idx in range(num):
-        name = f"{wf_name}-{idx}"
-        fw = AirssSearchFW(
-            project_name=project,
-            seed_name=seed,
-            seed_content=seed_content,
-            param_content=param_content,
-            executable=exe,
-            gzip_folder=gzip,
-            record_db=record_db,
-            keep=keep,
-            cycles=cycles,
-            name=name,
-            modcell_content=modcell_content,
-            modcell_name=modcell_name,
-            castep_code=castep_code,
-            code=code,
-            cluster=cluster,
-            spec=spec,
-        )
-
-        workflow = Workflow([fw], name=name)
-        # Add project/seed information to the workflow
-        workflow.metadata.update(wf_metadata)
-        build_fws.append(workflow)
+    modcell_name, modcell_content = parse_modcell(modcell)
+
+    fw_kwargs = dict(
+        project_name=project,
+        seed_name=seed,
+        seed_content=seed_content,
+        param_content=param_content,
+        executable=exe,
+        gzip_folder=gzip,
+        record_db=record_db,
+        keep=keep,
+        cycles=cycles,
+        modcell_content=modcell_content,
+        modcell_name=modcell_name,
+        castep_code=castep_code,
+        code=code,
+        cluster=cluster,
+    )
+    batch_size = max(batch_size, 1)
+    # Number of structures in each firework
+    sizes = [min(batch_size, num - start) for start in range(0, num, batch_size)]
+
+    def make_fw(nstructures, name):
+        """Construct the firework for a given number of structures"""
+        if batch_size > 1:
+            return AirssBatchSearchFW(nstructures=nstructures, name=name, spec=dict(spec), **fw_kwargs)
+        return AirssSearchFW(name=name, spec=dict(spec), **fw_kwargs)
 
     # If we are doing dry runs, print the information only
     if dryrun:
@@ -165,11 +188,142 @@ def deploy_search(
 
         click.echo(f"The default executable for tasks is: {exe}")
         click.echo(f"Each structure will be optimised for maximum {cycles} iterations")
+        if batch_size > 1:
+            click.echo(f"Structures will be searched in batches of {batch_size}, using {len(sizes)} fireworks")
         click.echo(f"The WorkFlows/Fireworks will be named as {wf_name}-*")
 
+        workflow = Workflow([make_fw(sizes[0], f"{wf_name}-0")], name=f"{wf_name}-0")
         dryrun_seed(seed_content, workflow, modcell)
     else:
-        lpad.bulk_add_wfs(build_fws)
+        blob_store = BlobStore(lpad) if use_blobs else None
+        # The documents are constructed from a template firework, one for each distinct batch size
+        for size in sorted(set(sizes)):
+            entries = [(f"{wf_name}-{idx}", None, None) for idx, nstructures in enumerate(sizes) if nstructures == size]
+            bulk_add_from_template(lpad, make_fw(size, entries[0][0]), entries, metadata=wf_metadata, blob_store=blob_store)
+
+
+@deploy.command("campaign")
+@click.option("--name", required=False, help="Name of the campaign, also used for the workflows. Defaults to '<project>-<seed>'.")
+@click.option(
+    "--seed",
+    required=True,
+    help="Name of the seed to be used, two files '<seed>.cell' and '<seed>.param' must present in the current directory.",
+)
+@click.option("--project", required=True, help="Name of the project.")
+@click.option("--num", required=True, type=int, help="Number of structures to search for.")
+@click.option("--priority", type=int, help="Priority for the fireworks.")
+@click.option("--category", multiple=True, help="Category for the fireworks. Useful when the tasks should be run with specific workers.")
+@click.option(
+    "--exe",
+    default="mpirun -np 8 castep.mpi",
+    help="Executable to be used, including the mpi runner part. The latter may be overridden by the worker.",
+)
+@click.option("--modcell", type=str, help="Cell modification to be applied, see `deploy search`.")
+@click.option("--cycles", default=200, type=int, show_default=True, help="Maximum optimisation steps per structure")
+@click.option("--keep/--no-keep", default=True, show_default=True, help="Keep intermediate files.")
+@click.option("--gzip/--no-gzip", default=True, show_default=True, help="Gzip the working directory in the end.")
+@click.option("--record-db/--no-record-db", show_default=True, help="Wether to record the result in to the database or not.", default=True)
+@click.option("--code", show_default=True, help="Code to use for relaxation", default="castep")
+@click.option(
+    "--castep-code", show_default=True, default="default", help="Alias for resolving the CASTEP executable, as define in the worker file."
+)
+@click.option("--cluster", is_flag=True, default=False)
+@click.option("--batch-size", default=1, type=int, show_default=True, help="Number of structures to be searched within each firework.")
+@click.option("--refill-size", default=100, type=int, show_default=True, help="Number of structures to be materialised at a time.")
+@click.option(
+    "--low-water", default=20, type=int, show_default=True, help="Materialise more structures when fewer fireworks than this are READY."
+)
+@use_blobs_option
+@pass_lpad
+def deploy_campaign(
+    lpad,
+    name,
+    code,
+    seed,
+    project,
+    num,
+    exe,
+    cycles,
+    keep,
+    priority,
+    category,
+    gzip,
+    record_db,
+    modcell,
+    castep_code,
+    cluster,
+    batch_size,
+    refill_size,
+    low_water,
+    use_blobs,
+):
+    """
+    Deploy a search campaign whose fireworks are materialised by the workers just in time
+    """
+    from disp.fws.campaign import CampaignManager
+
+    if code == "gulp" and "castep" in exe:
+        exe = "ggulp"
+    if code == "pp3" and "castep" in exe:
+        exe = "pp3"
+    modcell_name, modcell_content = parse_modcell(modcell)
+    fw_kwargs = dict(
+        executable=exe,
+        gzip_folder=gzip,
+        record_db=record_db,
+        keep=keep,
+        cycles=cycles,
+        modcell_content=modcell_content,
+        modcell_name=modcell_name,
+        castep_code=castep_code,
+        code=code,
+        cluster=cluster,
+    )
+    name = name or f"{project}-{seed}"
+    CampaignManager(lpad).create(
+        name,
+        project,
+        seed,
+        Path(seed + ".cell").read_text(),
+        Path(seed + SUFFIX_MAP[code]).read_text(),
+        num,
+        fw_kwargs=fw_kwargs,
+        priority=priority,
+        category=category,
+        refill_size=refill_size,
+        low_water=low_water,
+        batch_size=batch_size,
+        use_blobs=use_blobs,
+    )
+    click.echo(f"Created campaign {name} for {num} structures of project: {project}, seed name: {seed}")
+
+
+@deploy.command("campaign-update")
+@click.argument("name")
+@click.option("--priority", type=int, help="New priority, also applied to the READY fireworks of the campaign.")
+@click.option("--num", type=int, help="New number of structures to search for.")
+@click.option("--pause/--resume", default=None, help="Pause or resume materialising the fireworks.")
+@pass_lpad
+def update_campaign(lpad, name, priority, num, pause):
+    """Update a search campaign"""
+    from disp.fws.campaign import CampaignManager
+
+    state = None if pause is None else ("PAUSED" if pause else "ACTIVE")
+    nupdated = CampaignManager(lpad).update(name, priority=priority, target=num, state=state)
+    click.echo(f"Campaign {name} updated, priority of {nupdated} READY fireworks changed.")
+
+
+@deploy.command("campaign-list")
+@pass_lpad
+def list_campaigns(lpad):
+    """List the search campaigns"""
+    from tabulate import tabulate
+
+    from disp.fws.campaign import CampaignManager
+
+    keys = ["name", "project_name", "seed_name", "state", "priority", "created", "target", "nready"]
+    rows = [[doc.get(key) for key in keys] for doc in CampaignManager(lpad).list()]
+    click.echo(tabulate(rows, headers=keys))
 
 
 @deploy.command("singlepoint")
@@ -221,6 +375,7 @@ def deploy_search(
     help="Function to be used to modified to cell file. Such function should receives a list of lines and return a new list of lines.",
 )
 @click.option("--cluster", is_flag=True, default=False)
+@use_blobs_option
 @pass_lpad
 def deploy_singlepoint(
     lpad,
@@ -240,6 +395,7 @@ def deploy_singlepoint(
     extra_cell_file,
     castep_code,
     modcell,
+    use_blobs,
 ):
     """
     Deploy a workflow to do singlepoint calculation of a particular structure
@@ -263,7 +419,9 @@ def deploy_singlepoint(
 
     # Support multiple input structures
     cells = Path(".").glob(cell)
-    workflows = []
+    # Only the first firework is constructed, the others are inserted using it as the template
+    fw = None
+    entries = []
 
     # Extra lines to be appended to the cell files used as inputs
     if extra_cell_file is not None:
@@ -290,30 +448,27 @@ def deploy_singlepoint(
         if extra_cell_content:
             cell_content += "\n" + extra_cell_content
 
-        fw = SinglePointFW(
-            project_name=project,
-            struct_name=struct_name,
-            struct_content=cell_content,
-            param_content=param_content,
-            executable=exe,
-            clean_dir=not keep,
-            existing_spec=spec,
-            name=name,
-            record_db=record_db,
-            seed_name=seed,
-            castep_code=castep_code,
-            code=code,
-            cluster=cluster,
-        )
-
-        wflow = Workflow([fw], name=name)
-        wflow.metadata.update(wf_metadata)
-        wflow.metadata["struct_name"] = struct_name
-        workflows.append(wflow)
+        if fw is None:
+            fw = SinglePointFW(
+                project_name=project,
+                struct_name=struct_name,
+                struct_content=cell_content,
+                param_content=param_content,
+                executable=exe,
+                clean_dir=not keep,
+                existing_spec=spec,
+                name=name,
+                record_db=record_db,
+                seed_name=seed,
+                castep_code=castep_code,
+                code=code,
+                cluster=cluster,
+            )
+        entries.append((name, {"struct_name": struct_name, "struct_content": cell_content}, {"struct_name": struct_name}))
 
     # If we are doing dry runs, print the information only
     if dryrun:
-        click.echo(f"TOTAL NUMBER OF STRUCTURES: {len(workflows)}")
+        click.echo(f"TOTAL NUMBER OF STRUCTURES: {len(entries)}")
         click.echo(f"Submitting structure {struct_name} for project: {project} (seed: {seed})")
         click.echo(f"Priority: {priority}; Category: {category}")
         click.echo(cell_content)
@@ -327,7 +482,7 @@ def deploy_singlepoint(
         click.echo(f"The default executable for tasks is: {exe}")
         click.echo(f"The WorkFlows/Fireworks will be named as {name}")
     else:
-        lpad.bulk_add_wfs(workflows)
+        bulk_add_from_template(lpad, fw, entries, metadata=wf_metadata, blob_store=BlobStore(lpad) if use_blobs else None)
 
 
 @deploy.command("relax")
@@ -381,6 +536,7 @@ def deploy_singlepoint(
     help="Function to be used to modified to cell file. Such function should receives a list of lines and return a new list of lines.",
 )
 @click.option("--cluster", is_flag=True, default=False)
+@use_blobs_option
 @pass_lpad
 def deploy_relax(
     lpad,
@@ -402,6 +558,7 @@ def deploy_relax(
     extra_cell_file,
     castep_code,
     modcell,
+    use_blobs,
 ):
     """
     Deploy a workflow to do relaxation of a particular structure
@@ -425,7 +582,9 @@ def deploy_relax(
 
     # Support multiple input structures
     cells = Path(".").glob(cell)
-    workflows = []
+    # Only the first firework is constructed, the others are inserted using it as the template
+    fw = None
+    entries = []
 
     # Extra lines to be appended to the cell files used as inputs
     if extra_cell_file is not None:
@@ -460,32 +619,29 @@ def deploy_relax(
         if extra_cell_content:
             cell_content += "\n" + extra_cell_content
 
-        fw = RelaxFW(
-            project_name=project,
-            struct_name=struct_name,
-            struct_content=cell_content,
-            param_content=param_content,
-            executable=exe,
-            gzip_folder=gzip,
-            record_db=record_db,
-            keep=keep,
-            existing_spec=spec,
-            cycles=cycles,
-            name=name,
-            seed_name=seed,
-            castep_code=castep_code,
-            code=code,
-            cluster=cluster,
-        )
-
-        wflow = Workflow([fw], name=name)
-        wflow.metadata.update(wf_metadata)
-        wflow.metadata["struct_name"] = struct_name
-        workflows.append(wflow)
+        if fw is None:
+            fw = RelaxFW(
+                project_name=project,
+                struct_name=struct_name,
+                struct_content=cell_content,
+                param_content=param_content,
+                executable=exe,
+                gzip_folder=gzip,
+                record_db=record_db,
+                keep=keep,
+                existing_spec=spec,
+                cycles=cycles,
+                name=name,
+                seed_name=seed,
+                castep_code=castep_code,
+                code=code,
+                cluster=cluster,
+            )
+        entries.append((name, {"struct_name": struct_name, "struct_content": cell_content}, {"struct_name": struct_name}))
 
     # If we are doing dry runs, print the information only
     if dryrun:
-        click.echo(f"TOTAL NUMBER OF STRUCTURES: {len(workflows)}")
+        click.echo(f"TOTAL NUMBER OF STRUCTURES: {len(entries)}")
         click.echo(f"Submitting structure {struct_name} for project: {project} (seed: {seed})")
         click.echo(f"Priority: {priority}; Category: {category}")
         click.echo(cell_content)
@@ -500,7 +656,7 @@ def deploy_relax(
         click.echo(f"Each structure will be optimised for maximum {cycles} iterations")
         click.echo(f"The WorkFlows/Fireworks will be named as {name}")
     else:
-        lpad.bulk_add_wfs(workflows)
+        bulk_add_from_template(lpad, fw, entries, metadata=wf_metadata, blob_store=BlobStore(lpad) if use_blobs else None)
 
 
 def cell_from_file(fname):
@@ -553,7 +709,8 @@ def dryrun_seed(seed_content: str, workflow: Workflow, modcell: bool):
         # Test applying cell modifications
         if modcell is not None:
             fw = workflow.fws[0]
-            mod_task = fw.tasks[1]
+            # Batched fireworks have the tasks of each structure nested
+            mod_task = fw.tasks[0].get("tasks", fw.tasks)[1]
             dummy_spec = {
                 "struct_name": "SEED-OUT",
             }
@@ -574,6 +731,21 @@ def dryrun_seed(seed_content: str, workflow: Workflow, modcell: bool):
             )
 
 
+def parse_modcell(modcell):
+    """
+    Parse the cell modification option
+
+    Returns:
+      A tuple of the name of the function and the content of the file defining it.
+    """
+    if modcell is None:
+        return None, None
+    tokens = modcell.split(":")
+    if len(tokens) == 2:
+        return tokens[1], Path(tokens[0]).read_text()
+    return modcell, None
+
+
 def apply_modcell(modcell, cell_content):
     tokens = modcell.split(":")
     if len(tokens) == 2:
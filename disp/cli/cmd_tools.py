@@ -116,3 +116,47 @@ def plot_sheap(sheapout, vmax, savename, plot):
     fig.savefig(savename, dpi=200)
     # Save the raw data as json
     Path(savename).with_suffix(".json").write_text(dumps(parsed._asdict()))
+
+
+@tools.command("compact-datastore")
+@click.argument("project_name")
+@click.option("--base-path", help="Alternative <BASE_PATH> of the datastore.")
+@click.option("--pack-loose", is_flag=True, help="Also move the per-structure files in the project folder into the packed datastore.")
+def compact_datastore(project_name, base_path, pack_loose):
+    """
+    Compact the packed datastore of a project, dropping the superseded records
+    """
+    from disp.fws.packed import PackedDatastore
+    from disp.fws.utils import FWPathManager
+
+    store = PackedDatastore(FWPathManager(base_path).get_project_path(project_name))
+    stats = store.compact(pack_loose=pack_loose)
+    click.echo(
+        f"Compacted {stats['segments']} segments of {store.path}: {stats['kept']} records kept, "
+        f"{stats['dropped']} dropped, {stats['loose']} loose files packed"
+    )
+
+
+@tools.command("get-structure")
+@click.argument("project_name")
+@click.argument("struct_names", nargs=-1)
+@click.option("--base-path", help="Alternative <BASE_PATH> of the datastore.")
+@click.option("--output", "-o", default=".", show_default=True, help="Folder where the files are written.")
+@click.option("--list", "list_only", is_flag=True, help="Only list the files stored, the default if no structure is given.")
+def get_structure(project_name, struct_names, base_path, output, list_only):
+    """
+    Fetch the files of structures from the packed datastore of a project
+    """
+    from disp.fws.packed import PackedDatastore
+    from disp.fws.utils import FWPathManager
+
+    store = PackedDatastore(FWPathManager(base_path).get_project_path(project_name))
+    list_only = list_only or not struct_names
+    for struct_name in struct_names or store.list_structures():
+        if list_only:
+            click.echo(f"{struct_name}: {' '.join(store.list_files(struct_name))}")
+            continue
+        paths = store.extract(struct_name, output)
+        if not paths:
+            raise click.ClickException(f"Structure {struct_name} is not in the datastore {store.path}")
+        click.echo(f"{struct_name}: {len(paths)} files written")
@@ -2,13 +2,16 @@
 A runnable script to launch a single Rocket (a command-line interface to rocket_launcher.py)
 Modify from the original rlaunch.py script in Fireworks package
 """
+import multiprocessing
 import os
+import shutil
 import signal
 import sys
+import tempfile
 from argparse import ArgumentParser
 
 from fireworks.core.launchpad import LaunchPad
-from fireworks.core.rocket_launcher import launch_rocket, rapidfire
+from fireworks.core.rocket_launcher import launch_rocket
 from fireworks.features.multi_launcher import launch_multiprocess
 from fireworks.fw_config import CONFIG_FILE_DIR, LAUNCHPAD_LOC
 from fireworks.utilities.fw_utilities import (
@@ -17,7 +20,11 @@ from fireworks.utilities.fw_utilities import (
     get_my_ip,
 )
 
+from disp.buildpool import POOL_ENV_VAR, BuildcellPool
+from disp.fws.drain import install_drain_handlers, restore_default_handlers
+from disp.fws.launcher import pack_launch, rapidfire
 from disp.fws.worker import WalltimeAwareFWorker
+from disp.scheduler import Dummy, Scheduler
 
 # pylint: disable=too-many-statements,line-too-long,import-outside-toplevel
 
@@ -29,6 +36,34 @@ def handle_interrupt(signum, frame):
     sys.exit(1)
 
 
+def start_buildcell_pool(pool_dir, nworkers, depth):
+    """
+    Start a background process keeping the pool of pre-generated structures topped up
+
+    The location of the pool is exported to the environment so the build tasks can find it.
+    """
+    os.environ[POOL_ENV_VAR] = str(pool_dir)
+    pool = BuildcellPool(pool_dir, depth=depth)
+    proc = multiprocessing.Process(target=_run_pool, args=(pool, nworkers), daemon=True)
+    proc.start()
+    return proc
+
+
+def _run_pool(pool, nworkers):
+    """Run the pool, which is stopped by SIGTERM rather than draining like the launcher"""
+    restore_default_handlers()
+    pool.run(nworkers=nworkers)
+
+
+def stop_buildcell_pool(proc, timeout=5):
+    """Stop the pool process, killing it if it does not exit in time"""
+    proc.terminate()
+    proc.join(timeout)
+    if proc.is_alive():
+        proc.kill()
+        proc.join()
+
+
 def trlaunch():
     """
     Function rapid-fire job launching
@@ -42,8 +77,20 @@ def trlaunch():
     parser = ArgumentParser(description=m_description)
     subparsers = parser.add_subparsers(help="command", dest="command")
     single_parser = subparsers.add_parser("singleshot", help="launch a single Rocket")
-    rapid_parser = subparsers.add_parser("rapidfire", help="launch multiple Rockets (loop until all FireWorks complete)")
+    rapid_parser = subparsers.add_parser(
+        "rapidfire", help="launch multiple Rockets (loop until all FireWorks complete or none fits into the remaining walltime)"
+    )
     multi_parser = subparsers.add_parser("multi", help="launches multiple Rockets simultaneously")
+    pack_parser = subparsers.add_parser(
+        "pack",
+        help="launches multiple Rockets simultaneously, packing them by their cores",
+        description=(
+            "Launches multiple Rockets simultaneously, packing them by their cores. The cores of each FireWork are taken from "
+            "the executable given at the deployment, unless the worker runs a different command line: `ncores` in the env of "
+            "the worker file gives the count (for all FireWorks, or keyed by the castep_code alias or the code), otherwise it "
+            "is read from MPI_LAUNCH_CMD, `castep_codes` or `castep_executable`. A MPI launcher without a count takes the whole node."
+        ),
+    )
 
     single_parser.add_argument("-f", "--fw_id", help="specific fw_id to run", default=None, type=int)
     single_parser.add_argument("--offline", help="run in offline mode (FW.json required)", action="store_true")
@@ -78,12 +125,37 @@ def trlaunch():
     multi_parser.add_argument("--exclude_current_node", help="Don't use the script launching node" "as compute node", action="store_true")
     multi_parser.add_argument("--local_redirect", help="Redirect stdout and stderr to the launch directory", action="store_true")
 
+    pack_parser.add_argument(
+        "--ncores", help="number of cores to be filled (default is the number of CPUs of the job or the node)", default=None, type=int
+    )
+    pack_parser.add_argument(
+        "--default_ncores", help="number of cores for the FireWorks not declaring them (default is the whole node)", default=None, type=int
+    )
+    pack_parser.add_argument("--sleep", help="sleep time between checking for finished Rockets (secs)", default=None, type=int)
+    pack_parser.add_argument(
+        "--timeout", help="timeout (secs) after which no new Rockets are started (default None)", default=None, type=int
+    )
+    pack_parser.add_argument("--local_redirect", help="Redirect stdout and stderr to the launch directory", action="store_true")
+
     parser.add_argument("-l", "--launchpad_file", help="path to launchpad file")
     parser.add_argument("-w", "--fworker_file", required=True, help="path to fworker file")
     parser.add_argument(
         "-c", "--config_dir", help="path to a directory containing the config file " "(used if -l, -w unspecified)", default=CONFIG_FILE_DIR
     )
 
+    parser.add_argument(
+        "--buildcell_pool_workers",
+        help="number of buildcell processes to run in the background for pre-generating structures (default 0 is disabled)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--buildcell_pool_dir",
+        help="folder of the pool of pre-generated structures",
+        default=os.environ.get(POOL_ENV_VAR, os.path.join(tempfile.gettempdir(), "disp-buildcell-pool")),
+    )
+    parser.add_argument("--buildcell_pool_depth", help="number of structures to keep ready for each seed", default=4, type=int)
+
     parser.add_argument("--loglvl", help="level to print log messages", default="INFO")
     parser.add_argument("-s", "--silencer", help="shortcut to mute log messages", action="store_true")
 
@@ -101,6 +173,7 @@ def trlaunch():
     args = parser.parse_args()
 
     signal.signal(signal.SIGINT, handle_interrupt)  # graceful exit on ^C
+    install_drain_handlers()  # finish the running jobs on SIGTERM/SIGUSR1 from the scheduler
 
     if not args.launchpad_file and os.path.exists(os.path.join(args.config_dir, "my_launchpad.yaml")):
         args.launchpad_file = os.path.join(args.config_dir, "my_launchpad.yaml")
@@ -115,6 +188,9 @@ def trlaunch():
         launchpad = LaunchPad.from_file(args.launchpad_file) if args.launchpad_file else LaunchPad(strm_lvl=args.loglvl)
 
     fworker = WalltimeAwareFWorker.from_file(args.fworker_file)
+    if args.command != "multi":
+        # Allow the worker to materialise the Fireworks of search campaigns
+        fworker.launchpad = launchpad
 
     # prime addr lookups
     _log = get_fw_logger("rlaunch", stream_level="INFO")
@@ -122,6 +198,22 @@ def trlaunch():
     get_my_host()
     get_my_ip()
 
+    pool_proc = None
+    if args.buildcell_pool_workers > 0 and not shutil.which("buildcell"):
+        _log.error("buildcell is not found in PATH - structures are not pre-generated")
+    elif args.buildcell_pool_workers > 0:
+        pool_proc = start_buildcell_pool(args.buildcell_pool_dir, args.buildcell_pool_workers, args.buildcell_pool_depth)
+        _log.info(f"Started pre-generating structures in {args.buildcell_pool_dir} with {args.buildcell_pool_workers} workers")
+
+    try:
+        _launch(args, launchpad, fworker)
+    finally:
+        if pool_proc is not None:
+            stop_buildcell_pool(pool_proc)
+
+
+def _launch(args, launchpad, fworker):
+    """Launch the rockets as requested by the command line arguments"""
     if args.command == "rapidfire":
         rapidfire(
             launchpad,
@@ -154,9 +246,27 @@ def trlaunch():
             exclude_current_node=args.exclude_current_node,
             local_redirect=args.local_redirect,
         )
+    elif args.command == "pack":
+        pack_launch(
+            launchpad,
+            fworker,
+            args.ncores or get_node_ncores(),
+            default_ncores=args.default_ncores,
+            sleep_time=args.sleep,
+            strm_lvl=args.loglvl,
+            timeout=args.timeout,
+            local_redirect=args.local_redirect,
+        )
     else:
         launch_rocket(launchpad, fworker, args.fw_id, args.loglvl, pdb_on_exception=args.pdb)
 
 
+def get_node_ncores():
+    """Return the number of cores allocated by the scheduler, or those of the node"""
+    scheduler = Scheduler.get_scheduler()
+    ncores = scheduler.get_n_cpus() if scheduler is not None and not isinstance(scheduler, Dummy) else None
+    return int(ncores) if ncores else os.cpu_count()
+
+
 if __name__ == "__main__":
     trlaunch()
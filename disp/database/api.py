@@ -21,6 +21,7 @@ from pymongo.errors import PyMongoError
 
 from disp.database.odm import (
     Creator,
+    DispEntry,
     InitialStructureFile,
     ParamFile,
     ResFile,
@@ -293,6 +294,86 @@ class SearchDB:
             qset = qset.filter(__raw__=additional_filters)
         return qset.all()
 
+    @staticmethod
+    def iter_project_records(
+        project_name: str,
+        include_seed=False,
+        include_param=False,
+        additional_filters=None,
+        include_initial_structure=False,
+        batch_size=1000,
+    ):
+        """
+        Iterate through the results of a project in batches of raw records
+
+        Unlike `retrieve_project`, the referenced files are resolved with a single `$in` query
+        per batch rather than dereferenced for each document. The seed and param files, which are
+        shared by many structures, are only fetched once.
+
+        Args:
+          project_name: Name of the projection to query
+          include_seed: Include the content of thhe seed in the result.
+          include_param: Include the 'param' file content in the result.
+          include_initial_structure: Include initial structures
+          batch_size: Number of documents to be resolved in each batch
+
+        Yields:
+          list: a list of dictionaries with the `struct_name` and `content` of the SHELX files,
+            plus the contents of the `param`, `seed` and `init_structure` files if requested.
+        """
+        refs = {}
+        if include_param:
+            refs["param_file"] = "param"
+        if include_seed:
+            refs["seed_file"] = "seed"
+        if include_initial_structure:
+            refs["init_structure_file"] = "init_structure"
+
+        qset = ResFile.objects(project_name=project_name)
+        if additional_filters:
+            qset = qset.filter(__raw__=additional_filters)
+        cursor = qset.only("struct_name", "content", *refs).no_cache().as_pymongo().batch_size(batch_size)
+
+        shared = {}  # Cached contents of the seed and param files
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                yield _resolve_references(batch, refs, shared)
+                batch = []
+        if batch:
+            yield _resolve_references(batch, refs, shared)
+
+    def get_enthalpies_per_atom(self, project_name: str, seed_name: str = None):
+        """
+        Obtain the enthalpies per atom of the relaxed structures in a project
+
+        Only the TITL lines of the SHELX files are transferred from the server.
+
+        Args:
+          project_name: Name of the project
+          seed_name: Name of the seed, if given only the structures of this seed are included
+
+        Returns:
+          list: a list of the enthalpies per atom
+        """
+        match = {"_cls": "DispEntry.ResFile", "project_name": project_name}
+        if seed_name:
+            match["seed_name"] = seed_name
+        pipeline = [
+            {"$match": match},
+            {"$project": {"_id": 0, "titl": {"$arrayElemAt": [{"$split": ["$content", "\n"]}, 0]}}},
+        ]
+        values = []
+        for doc in self.collection.aggregate(pipeline):
+            # TITL <label> <pressure> <volume> <enthalpy> <spin> <abs spin> <natoms> ...
+            tokens = doc.get("titl", "").split()
+            try:
+                values.append(float(tokens[4]) / int(tokens[7]))
+            except (IndexError, ValueError, ZeroDivisionError):
+                continue
+        return values
+
     @staticmethod
     def get_summary_df(projects=None, seeds=None):
         """
@@ -561,6 +642,38 @@ def get_hash(string):
     return hashlib.md5(string.encode()).hexdigest()
 
 
+def _resolve_references(batch, refs, shared):
+    """
+    Resolve the referenced files of a batch of raw `ResFile` documents with a single query
+
+    Args:
+      batch: A list of raw documents
+      refs: A dictionary of the reference fields to be resolved and the keys of their contents in the output
+      shared: A dictionary of cached contents for the seed and param files, updated in place
+
+    Returns:
+      A list of dictionaries containing the `struct_name`, `content` and the resolved contents
+    """
+    ids = {doc[field] for doc in batch for field in refs if doc.get(field) is not None}
+    contents = {key: value for key, value in shared.items() if key in ids}
+    missing = ids.difference(contents)
+    if missing:
+        for entry in DispEntry._get_collection().find({"_id": {"$in": list(missing)}}, {"content": 1}):
+            contents[entry["_id"]] = entry["content"]
+    # Only the seed and param files are worth caching as they are shared by many structures
+    shared.update(
+        {doc[field]: contents[doc[field]] for doc in batch for field in ("param_file", "seed_file") if doc.get(field) in contents}
+    )
+
+    records = []
+    for doc in batch:
+        record = {"struct_name": doc.get("struct_name"), "content": doc.get("content")}
+        for field, key in refs.items():
+            record[key] = contents.get(doc.get(field))
+        records.append(record)
+    return records
+
+
 def get_pipeline(cls_string, projects=None, seeds=None):
     """
     Obtain the pipline for querying SearchDB
@@ -8,13 +8,12 @@ import io
 import json
 import logging
 import os
-import re
 import shutil
 import subprocess
 
 import slurmtools as stl
 
-from .casteptools import push_cell
+from .casteptools import castep_finish_ok, get_castep_output, push_cell
 from .utils import filter_out_stream, trim_stream
 
 try:
@@ -91,16 +90,9 @@ class FullRelax:
         logger.debug(f"Calling subprocess '{args}'")
         subprocess.call(args, shell=True, timeout=timeout)
         logger.debug(f"Checking {self.dot_castep} for results")
-        with open(self.dot_castep) as fh:
-            line_container = []
-            for line in fh:
-                line_container.append(line)
-                if len(line_container) > 20:
-                    line_container.pop(0)
-
-            # Use the 'Total time' as a sign of sucessful castep run
-            if "Total time" not in "".join(line_container):
-                raise RelaxError("CASTEP finished with error. " "struct_name: {}".format(self.struct_name))
+        # Use the 'Total time' as a sign of sucessful castep run
+        if not castep_finish_ok(self.dot_castep):
+            raise RelaxError("CASTEP finished with error. " "struct_name: {}".format(self.struct_name))
 
     def _set_short_geom_iter(self):
         """Set the geom iteration for initial rough relaxation"""
@@ -353,21 +345,8 @@ def check_relax_status(dot_castep):
     Return (relax flag, total iterations)
     relax flag is True is the last relaxation is successful
     """
-    geom_line = re.compile(r"Geometry optimization (\w+)")
-    count = 0
-
-    with open(dot_castep) as fh:
-        for line in fh:
-            m = geom_line.search(line)
-            if m:
-                g_res = m.group(1)
-            if ": finished iteration" in line:
-                count += 1
-
-    if g_res == "completed":
-        return (True, count)
-    else:
-        return (False, count)
+    output = get_castep_output(dot_castep)
+    return (output.geom_status == "completed", output.finished_iterations)
 
 
 ########## For reading geom file ##############
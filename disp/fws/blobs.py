@@ -0,0 +1,183 @@
+"""
+Content-addressed storage of the seeds, parameters and structures
+
+The same seed and parameter contents are repeated in the spec and the task parameters of
+every Firework of a search. When blobs are used, these contents are stored only once in the
+`disp_blobs` collection of the LaunchPad database, keyed by their md5 hash, and the Fireworks
+hold a reference of the form `{"_blob": <hash>}` instead.
+
+The references are resolved by the tasks at the run time. The resolved contents are cached
+in memory and on the disk of the worker, so each content is fetched from the database
+at most once per worker.
+"""
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+from disp.database import get_hash
+
+__all__ = ("BlobStore", "extract_blobs", "resolve_blobs", "store_firework_blobs")
+
+BLOB_COLLECTION = "disp_blobs"
+BLOB_KEY = "_blob"
+CACHE_ENV_VAR = "DISP_BLOB_CACHE"
+# Keys of the spec and the task parameters that are stored as blobs
+CONTENT_KEYS = ("seed_content", "param_content", "struct_content", "func_content")
+# Contents shorter than this are kept inline
+MIN_BLOB_SIZE = 64
+
+_MEMORY_CACHE = OrderedDict()
+_MEMORY_CACHE_SIZE = 256
+
+
+def _cache_in_memory(blob_hash, content):
+    """Keep a content in memory, dropping the least recently used ones"""
+    _MEMORY_CACHE[blob_hash] = content
+    while len(_MEMORY_CACHE) > _MEMORY_CACHE_SIZE:
+        _MEMORY_CACHE.popitem(last=False)
+
+
+def is_blob_ref(value):
+    """Check if a value is a reference to a blob"""
+    return isinstance(value, dict) and len(value) == 1 and BLOB_KEY in value
+
+
+def extract_blobs(obj, blobs):
+    """
+    Replace the contents with references to blobs, in place
+
+    Args:
+      obj: A (nested) dictionary or list, such as the spec or the dictionary of a task
+      blobs: A dictionary where the extracted contents are added, keyed by their hashes
+
+    Returns:
+      The dictionary of blobs
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in CONTENT_KEYS and isinstance(value, str) and len(value) >= MIN_BLOB_SIZE:
+                blob_hash = get_hash(value)
+                blobs[blob_hash] = value
+                obj[key] = {BLOB_KEY: blob_hash}
+            else:
+                extract_blobs(value, blobs)
+    elif isinstance(obj, list):
+        for value in obj:
+            extract_blobs(value, blobs)
+    return blobs
+
+
+class BlobStore:
+    """Store for the blobs with a local cache"""
+
+    def __init__(self, lpad, cache_dir=None):
+        """
+        Instantiate a BlobStore
+
+        Args:
+          lpad: The LaunchPad instance
+          cache_dir: Folder for caching the blobs locally. Defaults to the value of the DISP_BLOB_CACHE
+            environmental variable, no disk cache is used if neither is set.
+        """
+        self.lpad = lpad
+        cache_dir = cache_dir or os.environ.get(CACHE_ENV_VAR)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+
+    @property
+    def collection(self):
+        """The collection of the blobs"""
+        return self.lpad.db[BLOB_COLLECTION]
+
+    def put(self, blobs):
+        """
+        Store blobs in the database, existing blobs are left untouched
+
+        Args:
+          blobs: A dictionary of the contents keyed by their hashes
+
+        Returns:
+          The number of new blobs stored
+        """
+        from pymongo import UpdateOne  # pylint: disable=import-outside-toplevel
+
+        if not blobs:
+            return 0
+        requests = [UpdateOne({"_id": key}, {"$setOnInsert": {"content": value}}, upsert=True) for key, value in blobs.items()]
+        result = self.collection.bulk_write(requests, ordered=False)
+        return result.upserted_count
+
+    def get(self, blob_hash):
+        """Return the content of a blob"""
+        if blob_hash in _MEMORY_CACHE:
+            _MEMORY_CACHE.move_to_end(blob_hash)
+            return _MEMORY_CACHE[blob_hash]
+
+        cache_file = self.cache_dir / blob_hash if self.cache_dir else None
+        if cache_file and cache_file.is_file():
+            content = cache_file.read_text()
+            # Guard against partially written or corrupted files
+            if get_hash(content) == blob_hash:
+                _cache_in_memory(blob_hash, content)
+                return content
+
+        doc = self.collection.find_one({"_id": blob_hash})
+        if doc is None:
+            raise KeyError(f"Blob {blob_hash} does not exist")
+        content = doc["content"]
+        _cache_in_memory(blob_hash, content)
+        if cache_file:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_dir / f".{blob_hash}.{os.getpid()}"
+            tmp_file.write_text(content)
+            os.replace(tmp_file, cache_file)
+        return content
+
+
+def resolve_blobs(task, fw_spec):
+    """
+    Resolve the references to blobs in the parameters of a task and in the spec
+
+    The LaunchPad is taken from the task (requires the `_add_launchpad_and_fw_id` key in the spec),
+    otherwise the default LaunchPad is loaded.
+
+    Returns:
+      The BlobStore used, or None if there was nothing to resolve
+    """
+    task_keys = [key for key, value in task.items() if is_blob_ref(value)]
+    spec_keys = [key for key in CONTENT_KEYS if is_blob_ref(fw_spec.get(key))]
+    if not (task_keys or spec_keys):
+        return None
+    lpad = getattr(task, "launchpad", None)
+    if lpad is None:
+        from fireworks.core.launchpad import LaunchPad  # pylint: disable=import-outside-toplevel
+
+        lpad = LaunchPad.auto_load()
+    fw_env = fw_spec.get("_fw_env") or {}
+    store = BlobStore(lpad, cache_dir=fw_env.get("blob_cache"))
+    # Nested tasks are left to resolve their own references
+    for key in task_keys:
+        task[key] = store.get(task[key][BLOB_KEY])
+    for key in spec_keys:
+        fw_spec[key] = store.get(fw_spec[key][BLOB_KEY])
+    return store
+
+
+def store_firework_blobs(store, firework):
+    """
+    Move the contents of a Firework to the blob store
+
+    Args:
+      store: The BlobStore instance
+      firework: The Firework, modified in place
+
+    Returns:
+      The modified Firework
+    """
+    blobs = extract_blobs(firework.spec, {})
+    for task in firework.tasks:
+        extract_blobs(task, blobs)
+    store.put(blobs)
+    # The tasks need the LaunchPad to resolve the references
+    firework.spec["_add_launchpad_and_fw_id"] = True
+    return firework
+
@@ -0,0 +1,80 @@
+"""
+Fast bulk insertion of single-Firework workflows
+
+Constructing a Firework and a Workflow object for each structure becomes slow for large
+deployments. Here a single Firework is used as the template, and the documents of the
+workflows are constructed as raw dictionaries with only the fields that differ (name,
+spec entries and metadata) replaced. The ids are reserved with a single update of the
+`fw_id_assigner`, and the documents are written with chunked `insert_many`.
+"""
+from datetime import datetime
+
+from .blobs import extract_blobs, store_firework_blobs
+
+__all__ = ("bulk_add_from_template",)
+
+
+def bulk_add_from_template(lpad, firework, entries, metadata=None, chunk_size=1000, blob_store=None):
+    """
+    Add workflows each containing a single Firework constructed from a template
+
+    Args:
+      lpad: The LaunchPad instance
+      firework: The template Firework
+      entries: A list of (name, spec_updates, metadata_updates) tuples, one for each workflow.
+        `spec_updates` and `metadata_updates` may be None.
+      metadata: Metadata shared by all workflows
+      chunk_size: Number of documents to be inserted at a time
+      blob_store: If given, the contents are moved to this BlobStore and referenced by their hashes
+
+    Returns:
+      A list of the fw_ids of the Fireworks added
+    """
+    entries = list(entries)
+    if not entries:
+        return []
+
+    if blob_store is not None:
+        store_firework_blobs(blob_store, firework)
+    template = firework.to_db_dict()
+    template["state"] = "READY"
+    metadata = metadata or {}
+    first_id = lpad.get_new_fw_id(quantity=len(entries))
+    now = datetime.utcnow()
+    now_str = now.isoformat()
+
+    fw_ids = []
+    for start in range(0, len(entries), chunk_size):
+        wf_docs = []
+        fw_docs = []
+        blobs = {}
+        for offset, (name, spec_updates, metadata_updates) in enumerate(entries[start : start + chunk_size]):
+            fw_id = first_id + start + offset
+            fw_doc = dict(template, fw_id=fw_id, name=name, created_on=now_str, updated_on=now_str)
+            if spec_updates:
+                if blob_store is not None:
+                    spec_updates = dict(spec_updates)
+                    extract_blobs(spec_updates, blobs)
+                # Shallow copy - the tasks are shared with the template
+                fw_doc["spec"] = dict(template["spec"], **spec_updates)
+            wf_docs.append(
+                {
+                    "links": {str(fw_id): []},
+                    "parent_links": {},
+                    "nodes": [fw_id],
+                    "metadata": dict(metadata, **metadata_updates) if metadata_updates else dict(metadata),
+                    "state": "READY",
+                    "name": name,
+                    "created_on": now,
+                    "updated_on": now,
+                    "fw_states": {str(fw_id): "READY"},
+                }
+            )
+            fw_docs.append(fw_doc)
+            fw_ids.append(fw_id)
+        if blob_store is not None:
+            blob_store.put(blobs)
+        # Workflows first so the Fireworks are not checked out before their workflows exist
+        lpad.workflows.insert_many(wf_docs)
+        lpad.fireworks.insert_many(fw_docs)
+    return fw_ids
@@ -0,0 +1,237 @@
+"""
+Search campaigns - deploy searches lazily
+
+Instead of inserting all Fireworks of a search at the deployment time, a campaign document
+records the seed, the parameters, the number of structures requested and the priority. The
+workers materialise the Fireworks just in time, whenever the number of READY Fireworks of a
+campaign drops below a threshold. This keeps the `fireworks` collection small and allows
+changing the priority of the remaining structures instantly.
+
+The campaigns are stored in the `disp_campaigns` collection of the LaunchPad database.
+"""
+import time
+from datetime import datetime
+
+from .blobs import BlobStore
+from .bulk import bulk_add_from_template
+from .works import AirssBatchSearchFW, AirssSearchFW
+
+# pylint: disable=too-many-arguments
+
+CAMPAIGN_COLLECTION = "disp_campaigns"
+
+
+class CampaignManager:
+    """Manager for creating, updating and materialising search campaigns"""
+
+    LOCK_SECONDS = 60  # Time for a worker to finish materialising before others may step in
+
+    def __init__(self, lpad):
+        """
+        Instantiate a CampaignManager
+
+        Args:
+          lpad: The LaunchPad instance
+        """
+        self.lpad = lpad
+        self.collection = lpad.db[CAMPAIGN_COLLECTION]
+
+    def create(
+        self,
+        name,
+        project_name,
+        seed_name,
+        seed_content,
+        param_content,
+        target,
+        fw_kwargs=None,
+        priority=None,
+        category=None,
+        refill_size=100,
+        low_water=20,
+        batch_size=1,
+        use_blobs=False,
+    ):
+        """
+        Create a new campaign
+
+        Args:
+          name: Unique name of the campaign, also used for naming the workflows
+          target: Number of structures to search for
+          fw_kwargs: Additional keyword arguments for `AirssSearchFW`
+          refill_size: Number of structures to materialise at a time
+          low_water: Materialise more structures when the number of READY Fireworks is below this
+          batch_size: Number of structures in each Firework, see `AirssBatchSearchFW`
+          use_blobs: Reference the seed and the parameters by their hashes in the blob collection
+
+        Returns:
+          The ObjectId of the campaign document
+        """
+        if self.collection.find_one({"name": name}):
+            raise ValueError(f"Campaign {name} already exists")
+        doc = {
+            "name": name,
+            "project_name": project_name,
+            "seed_name": seed_name,
+            "seed_content": seed_content,
+            "param_content": param_content,
+            "target": target,
+            "created": 0,
+            "fw_kwargs": fw_kwargs or {},
+            "priority": priority,
+            "category": list(category) if category else None,
+            "refill_size": refill_size,
+            "low_water": low_water,
+            "batch_size": max(batch_size, 1),
+            "use_blobs": use_blobs,
+            "state": "ACTIVE",
+            "lock_until": 0.0,
+            "created_on": datetime.utcnow(),
+        }
+        self.collection.create_index("name", unique=True)
+        return self.collection.insert_one(doc).inserted_id
+
+    def update(self, name, priority=None, target=None, state=None):
+        """
+        Update a campaign
+
+        The priority of the READY Fireworks already materialised is updated as well. A completed
+        campaign is made active again if its target is raised above the number of structures created.
+
+        Returns:
+          The number of READY Fireworks with their priority updated
+        """
+        updates = {}
+        if priority is not None:
+            updates["priority"] = priority
+        if target is not None:
+            updates["target"] = target
+        if state is not None:
+            updates["state"] = state
+        if not updates:
+            return 0
+        result = self.collection.update_one({"name": name}, {"$set": updates})
+        if result.matched_count == 0:
+            raise ValueError(f"Campaign {name} does not exist")
+        if target is not None and state is None:
+            self.collection.update_one({"name": name, "state": "COMPLETED", "created": {"$lt": target}}, {"$set": {"state": "ACTIVE"}})
+        if priority is None:
+            return 0
+        result = self.lpad.fireworks.update_many({"state": "READY", "spec._campaign": name}, {"$set": {"spec._priority": priority}})
+        return result.modified_count
+
+    def list(self):
+        """Return the campaigns, with the number of READY Fireworks included"""
+        campaigns = []
+        for doc in self.collection.find({}, {"seed_content": 0, "param_content": 0}):
+            doc["nready"] = self.count_ready(doc["name"])
+            campaigns.append(doc)
+        return campaigns
+
+    def count_ready(self, name):
+        """Count the READY Fireworks of a campaign"""
+        return self.lpad.fireworks.count_documents({"state": "READY", "spec._campaign": name})
+
+    def refill(self, category=None):
+        """
+        Materialise Fireworks for the active campaigns that are running low
+
+        Args:
+          category: The category of the worker, only campaigns that can be run by it are refilled
+
+        Returns:
+          The number of structures materialised
+        """
+        total = 0
+        projection = {"_id": 1, "name": 1, "created": 1, "target": 1, "category": 1, "low_water": 1}
+        for doc in self.collection.find({"state": "ACTIVE"}, projection):
+            if doc["created"] >= doc["target"] or not category_match(doc.get("category"), category):
+                continue
+            if self.count_ready(doc["name"]) >= doc["low_water"]:
+                continue
+            total += self._materialise(self.collection.find_one({"_id": doc["_id"]}))
+        return total
+
+    def _materialise(self, doc):
+        """Reserve and insert the next chunk of structures of a campaign"""
+        now = time.time()
+        start = doc["created"]
+        count = min(doc["refill_size"], doc["target"] - start)
+        if count <= 0:
+            return 0
+        # Reserve the chunk - fails if another worker has reserved it first
+        reserved = self.collection.find_one_and_update(
+            {"_id": doc["_id"], "created": start, "lock_until": {"$lt": now}},
+            {"$set": {"lock_until": now + self.LOCK_SECONDS}},
+        )
+        if reserved is None:
+            return 0
+        # The counter is only moved forward once the chunk is inserted, so a chunk of a worker that died
+        # is taken over when its lock expires - skipping any workflows it had already added
+        names = [f"{doc['name']}-{idx}" for idx in range(start, start + count, doc.get("batch_size", 1))]
+        existing = set(self.lpad.fireworks.distinct("name", {"spec._campaign": doc["name"], "name": {"$in": names}}))
+        add_workflows(self.lpad, doc, start, count, skip=existing)
+        state = "COMPLETED" if start + count >= doc["target"] else "ACTIVE"
+        self.collection.update_one(
+            {"_id": doc["_id"], "created": start}, {"$inc": {"created": count}, "$set": {"lock_until": 0.0, "state": state}}
+        )
+        return count
+
+
+def category_match(campaign_category, worker_category):
+    """Check if a worker with a given category can run the Fireworks of a campaign"""
+    if not worker_category:
+        return True
+    if worker_category == "__none__":
+        return not campaign_category
+    if isinstance(worker_category, str):
+        worker_category = [worker_category]
+    return bool(campaign_category) and bool(set(campaign_category) & set(worker_category))
+
+
+def add_workflows(lpad, doc, start, count, skip=None):
+    """
+    Add the workflows for a range of structures of a campaign
+
+    Args:
+      lpad: The LaunchPad instance
+      doc: The campaign document
+      start: Index of the first structure
+      count: Number of structures
+      skip: Names of the workflows not to be added again
+
+    Returns:
+      A list of the fw_ids added
+    """
+    spec = {"_campaign": doc["name"]}
+    if doc.get("priority"):
+        spec["_priority"] = doc["priority"]
+    if doc.get("category"):
+        spec["_category"] = doc["category"]
+    metadata = {"project_name": doc["project_name"], "seed_name": doc["seed_name"], "disp_type": "search", "campaign": doc["name"]}
+
+    # Number of structures of each firework keyed by the index of the first structure
+    batch_size = doc.get("batch_size", 1)
+    sizes = {idx: min(batch_size, start + count - idx) for idx in range(start, start + count, batch_size)}
+    blob_store = BlobStore(lpad) if doc.get("use_blobs") else None
+    fw_ids = []
+    for size in sorted(set(sizes.values())):
+        entries = [(f"{doc['name']}-{idx}", None, None) for idx, nstructures in sizes.items() if nstructures == size]
+        entries = [entry for entry in entries if entry[0] not in (skip or ())]
+        if not entries:
+            continue
+        kwargs = dict(
+            project_name=doc["project_name"],
+            seed_name=doc["seed_name"],
+            seed_content=doc["seed_content"],
+            param_content=doc["param_content"],
+            name=entries[0][0],
+            spec=dict(spec),
+            **doc["fw_kwargs"],
+        )
+        if batch_size > 1:
+            template = AirssBatchSearchFW(nstructures=size, **kwargs)
+        else:
+            template = AirssSearchFW(**kwargs)
+        fw_ids.extend(bulk_add_from_template(lpad, template, entries, metadata=metadata, blob_store=blob_store))
+    return fw_ids
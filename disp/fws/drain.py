@@ -0,0 +1,60 @@
+"""
+Draining the worker on the pre-termination signals of the scheduler
+
+Schedulers can signal a job some time before killing it, e.g. with `sbatch --signal=USR1@300`
+for SLURM, or send SIGTERM when a job is preempted or cancelled. Once such signal is received:
+
+- The running relaxation is terminated and handled as if it had timed out, so the partial
+  output is uploaded and the continuation Firework is created straight away.
+- The launchers stop pulling new Fireworks and exit once the running Rockets are finished.
+"""
+import os
+import signal
+import sys
+
+__all__ = ("DRAIN_SIGNALS", "install_drain_handlers", "restore_default_handlers", "is_draining", "forward_drain_signal")
+
+DRAIN_SIGNALS = (signal.SIGTERM, signal.SIGUSR1)
+
+_STATE = {"signum": None}
+
+
+def handle_drain(signum, frame):
+    """Handler for the pre-termination signals, only records that the worker should drain"""
+    del frame
+    if _STATE["signum"] is None:
+        sys.stderr.write(f"Received signal {signum:d} - finishing the running jobs and stopping\n")
+    _STATE["signum"] = signum
+
+
+def install_drain_handlers(signals=DRAIN_SIGNALS):
+    """Install the handler for the pre-termination signals"""
+    for signum in signals:
+        signal.signal(signum, handle_drain)
+
+
+def restore_default_handlers(signals=DRAIN_SIGNALS):
+    """Restore the default handlers, e.g. in helper processes that should simply exit on these signals"""
+    for signum in signals:
+        signal.signal(signum, signal.SIG_DFL)
+
+
+def is_draining():
+    """Return True if a pre-termination signal has been received"""
+    return _STATE["signum"] is not None
+
+
+def reset_drain():
+    """Clear the received signal"""
+    _STATE["signum"] = None
+
+
+def forward_drain_signal(pids):
+    """Forward the received signal to the given processes, e.g. the Rockets running in parallel"""
+    if _STATE["signum"] is None:
+        return
+    for pid in pids:
+        try:
+            os.kill(pid, _STATE["signum"])
+        except ProcessLookupError:
+            pass
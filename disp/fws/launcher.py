@@ -0,0 +1,315 @@
+"""
+Launching Rockets within the walltime of a scheduler job
+
+`rapidfire` is modified from `fireworks.core.rocket_launcher.rapidfire`. The loop exits as soon
+as none of the READY Fireworks fit into the remaining walltime, instead of sleeping until the
+job is killed by the scheduler.
+
+`pack_launch` runs several Rockets at the same time, each in its own process. The Fireworks
+are picked such that the cores they declare (`_ncores` in the spec) fit into the free cores
+of the node, so small jobs can run alongside a wide one. The declared cores are worked out from
+the executable given at the deployment, hence they are replaced by those of the command line the
+worker actually runs, see `get_worker_ncores`.
+
+Both stop pulling new Fireworks once the worker is draining (see `disp.fws.drain`).
+"""
+import multiprocessing
+import os
+import re
+import time
+from datetime import datetime
+
+from fireworks.core.launchpad import LaunchPad
+from fireworks.core.rocket_launcher import get_fworker, launch_rocket
+from fireworks.fw_config import RAPIDFIRE_SLEEP_SECS
+from fireworks.utilities.fw_utilities import (
+    create_datestamp_dir,
+    get_fw_logger,
+    log_multi,
+    redirect_local,
+)
+
+from disp.fws.drain import forward_drain_signal, is_draining
+from disp.fws.works import get_ncores
+
+__all__ = ("rapidfire", "pack_launch", "get_worker_ncores")
+
+# Names of the relaxation tasks and the codes they run
+CODE_TASK_REGEX = re.compile(r"(Castep|Gulp|Pp3)\w*Task")
+# Keys of the worker env replacing the command line of the Fireworks
+WORKER_COMMAND_KEYS = ("ncores", "castep_executable", "castep_codes")
+
+# pylint: disable=too-many-arguments, too-many-branches
+
+
+def rapidfire(
+    launchpad,
+    fworker=None,
+    m_dir=None,
+    nlaunches=0,
+    max_loops=-1,
+    sleep_time=None,
+    strm_lvl="INFO",
+    timeout=None,
+    local_redirect=False,
+    pdb_on_exception=False,
+):
+    """
+    Keep running Rockets until there is nothing left to run, or nothing can be run in the remaining walltime
+
+    The arguments are the same as `fireworks.core.rocket_launcher.rapidfire`.
+
+    Returns:
+      The number of Rockets launched
+    """
+    sleep_time = sleep_time if sleep_time else RAPIDFIRE_SLEEP_SECS
+    curdir = m_dir if m_dir else os.getcwd()
+    l_logger = get_fw_logger("rocket.launcher", l_dir=launchpad.get_logdir(), stream_level=strm_lvl)
+    nlaunches = -1 if nlaunches == "infinite" else int(nlaunches)
+    fworker = get_fworker(fworker)
+
+    num_launched = 0
+    start_time = datetime.now()
+    num_loops = 0
+
+    def time_ok():
+        # has the rapidfire run timed out?
+        return timeout is None or (datetime.now() - start_time).total_seconds() < timeout
+
+    while num_loops != max_loops and time_ok():
+        skip_check = False  # this is used to speed operation
+        while not is_draining() and (skip_check or launchpad.run_exists(fworker)) and time_ok():
+            os.chdir(curdir)
+            launcher_dir = create_datestamp_dir(curdir, l_logger, prefix="launcher_")
+            os.chdir(launcher_dir)
+            if local_redirect:
+                with redirect_local():
+                    rocket_ran = launch_rocket(launchpad, fworker, strm_lvl=strm_lvl, pdb_on_exception=pdb_on_exception)
+            else:
+                rocket_ran = launch_rocket(launchpad, fworker, strm_lvl=strm_lvl, pdb_on_exception=pdb_on_exception)
+
+            if rocket_ran:
+                num_launched += 1
+            elif not os.listdir(launcher_dir):
+                # remove the empty shell of a directory
+                os.chdir(curdir)
+                os.rmdir(launcher_dir)
+            if nlaunches > 0 and num_launched == nlaunches:
+                break
+            if launchpad.run_exists(fworker):
+                skip_check = True  # don't wait, pull the next FW right away
+            else:
+                # add a small amount of buffer breathing time for DB to refresh in case we have a dynamic WF
+                time.sleep(0.15)
+                skip_check = False
+        if nlaunches > 0 and num_launched == nlaunches:
+            break
+        if is_draining():
+            log_multi(l_logger, "The worker is draining - exiting")
+            break
+        # Waiting will not help if the READY Fireworks need more time than is left
+        if hasattr(fworker, "is_out_of_time") and fworker.is_out_of_time(launchpad):
+            log_multi(l_logger, "None of the READY FWs fit into the remaining walltime - exiting")
+            break
+        if nlaunches == 0 and not launchpad.future_run_exists(fworker):
+            break
+        log_multi(l_logger, f"Sleeping for {sleep_time} secs")
+        time.sleep(sleep_time)
+        num_loops += 1
+        log_multi(l_logger, "Checking for FWs to run...")
+    os.chdir(curdir)
+    return num_launched
+
+
+def get_task_code(tasks):
+    """
+    Find the code run by the tasks of a Firework, including the tasks nested in a batch
+
+    Returns:
+      A tuple of the code (castep, gulp or pp3) and the `castep_code` alias, (None, None) if not found
+    """
+    for task in tasks or []:
+        match = CODE_TASK_REGEX.search(task.get("_fw_name", ""))
+        if match:
+            return match.group(1).lower(), task.get("castep_code", "default")
+        code = get_task_code(task.get("tasks"))
+        if code[0] is not None:
+            return code
+    return None, None
+
+
+def get_worker_ncores(spec, fw_env, default_ncores):
+    """
+    Return the number of cores a Firework takes when run by this worker
+
+    The `_ncores` of the spec is worked out at the deployment, but the worker may run a different
+    command line. In the order of precedence:
+
+    - `ncores` in the worker env gives the count, either for all Fireworks or in a dictionary keyed
+      by the `castep_code` alias or the code (castep, gulp or pp3) of the Firework,
+    - `MPI_LAUNCH_CMD` replaces the MPI launcher of CASTEP,
+    - `castep_codes` and `castep_executable` in the worker env replace the CASTEP executable.
+
+    A launcher without a count takes the whole node, hence `default_ncores` is returned for it.
+    """
+    code, castep_code = get_task_code(spec.get("_tasks"))
+    override = fw_env.get("ncores")
+    if isinstance(override, dict):
+        override = override.get(castep_code, override.get(code))
+    if override is not None:
+        return int(override)
+    if code == "castep":
+        executable = None
+        if os.environ.get("MPI_LAUNCH_CMD"):
+            executable = os.environ["MPI_LAUNCH_CMD"]
+        elif castep_code != "default" and castep_code in fw_env.get("castep_codes", {}):
+            executable = fw_env["castep_codes"][castep_code]
+        elif fw_env.get("castep_executable"):
+            executable = fw_env["castep_executable"]
+        if executable is not None:
+            ncores = get_ncores(executable)
+            return default_ncores if ncores is None else ncores
+    return spec.get("_ncores", default_ncores)
+
+
+def find_fitting_firework(launchpad, fworker, free_cores, total_cores, default_ncores=None, exclude=None):
+    """
+    Find the READY Firework with the highest priority that fits into the free cores
+
+    Fireworks declaring more cores than the node has are run when the whole node is free. If the
+    worker replaces the command lines, the cores are resolved for each Firework in the order of
+    priority by `get_worker_ncores`, otherwise the query selects those fitting.
+
+    Args:
+      default_ncores: Number of cores for the Fireworks without `_ncores` in the spec,
+        those are given the whole node by default
+      exclude: fw_ids to be excluded, e.g. those started but not checked out yet
+
+    Returns:
+      A tuple of the fw_id and the number of cores to be reserved, (None, 0) if nothing fits.
+    """
+    if default_ncores is None:
+        default_ncores = total_cores
+    conditions = [fworker.query, {"state": "READY"}]
+    if exclude:
+        conditions.append({"fw_id": {"$nin": list(exclude)}})
+    sort = [("spec._priority", -1), ("created_on", 1)]
+    fw_env = getattr(fworker, "env", None) or {}
+    if os.environ.get("MPI_LAUNCH_CMD") or any(key in fw_env for key in WORKER_COMMAND_KEYS):
+        projection = {"fw_id": 1, "spec._ncores": 1}
+        for prefix in ("spec._tasks", "spec._tasks.tasks"):
+            projection.update({f"{prefix}._fw_name": 1, f"{prefix}.castep_code": 1})
+        for doc in launchpad.fireworks.find({"$and": conditions}, projection, sort=sort):
+            ncores = min(get_worker_ncores(doc["spec"], fw_env, default_ncores), total_cores)
+            if ncores <= free_cores:
+                return doc["fw_id"], ncores
+        return None, 0
+
+    if free_cores < total_cores:
+        cores_condition = [{"spec._ncores": {"$lte": free_cores}}]
+        if default_ncores <= free_cores:
+            cores_condition.append({"spec._ncores": {"$exists": False}})
+        conditions.append({"$or": cores_condition})
+    doc = launchpad.fireworks.find_one({"$and": conditions}, {"fw_id": 1, "spec._ncores": 1}, sort=sort)
+    if doc is None:
+        return None, 0
+    return doc["fw_id"], min(doc["spec"].get("_ncores", default_ncores), total_cores)
+
+
+def _run_rocket(lpad_dict, fworker, fw_id, launch_dir, strm_lvl, local_redirect):
+    """Run a single Rocket in a child process, with its own connection to the database"""
+    launchpad = LaunchPad.from_dict(lpad_dict)
+    if hasattr(fworker, "launchpad"):
+        fworker.launchpad = launchpad
+    os.chdir(launch_dir)
+    if local_redirect:
+        with redirect_local():
+            launch_rocket(launchpad, fworker, fw_id=fw_id, strm_lvl=strm_lvl)
+    else:
+        launch_rocket(launchpad, fworker, fw_id=fw_id, strm_lvl=strm_lvl)
+
+
+def _start_rocket(launchpad, fworker, fw_id, launch_dir, strm_lvl, local_redirect):
+    """Start a Rocket for a given Firework in a new process"""
+    proc = multiprocessing.Process(
+        target=_run_rocket, args=(launchpad.to_dict(), fworker, fw_id, launch_dir, strm_lvl, local_redirect), daemon=False
+    )
+    proc.start()
+    return proc
+
+
+def pack_launch(
+    launchpad,
+    fworker,
+    total_cores,
+    m_dir=None,
+    default_ncores=None,
+    sleep_time=None,
+    strm_lvl="INFO",
+    timeout=None,
+    local_redirect=False,
+):
+    """
+    Run Rockets in parallel such that their cores fill the node
+
+    Whenever cores are freed, the READY Firework with the highest priority that fits into
+    them is started. The launcher exits when nothing is running and nothing can be run.
+
+    Args:
+      launchpad: The LaunchPad instance
+      fworker: The worker
+      total_cores: Number of cores of the node to be filled
+      m_dir: The directory in which to run the Rockets
+      default_ncores: Number of cores for the Fireworks without `_ncores` in the spec, defaults to the whole node
+      sleep_time: Seconds between checking for finished Rockets and new Fireworks
+      timeout: Seconds after which no new Rockets are started
+
+    Returns:
+      The number of Rockets started
+    """
+    sleep_time = sleep_time if sleep_time else RAPIDFIRE_SLEEP_SECS
+    curdir = m_dir if m_dir else os.getcwd()
+    l_logger = get_fw_logger("rocket.launcher", l_dir=launchpad.get_logdir(), stream_level=strm_lvl)
+    start_time = datetime.now()
+    running = {}  # Process -> (fw_id, number of cores)
+    nstarted = 0
+    drain_forwarded = False
+
+    def time_ok():
+        return timeout is None or (datetime.now() - start_time).total_seconds() < timeout
+
+    while True:
+        for proc in [proc for proc in running if not proc.is_alive()]:
+            proc.join()
+            del running[proc]
+
+        if is_draining() and not drain_forwarded:
+            # The Rockets may not have received the signal themselves
+            log_multi(l_logger, f"The worker is draining - waiting for {len(running)} running Rockets")
+            forward_drain_signal([proc.pid for proc in running])
+            drain_forwarded = True
+
+        free_cores = total_cores - sum(ncores for _, ncores in running.values())
+        fw_id = None
+        if free_cores > 0 and time_ok() and not is_draining():
+            exclude = [fw_id for fw_id, _ in running.values()]
+            fw_id, ncores = find_fitting_firework(launchpad, fworker, free_cores, total_cores, default_ncores, exclude=exclude)
+        if fw_id is not None:
+            launch_dir = create_datestamp_dir(curdir, l_logger, prefix="launcher_")
+            running[_start_rocket(launchpad, fworker, fw_id, launch_dir, strm_lvl, local_redirect)] = (fw_id, ncores)
+            nstarted += 1
+            log_multi(l_logger, f"Started FW {fw_id} on {ncores} cores, {free_cores - ncores}/{total_cores} cores free")
+            # Fill the remaining cores right away
+            continue
+
+        if not running:
+            if not time_ok() or is_draining():
+                break
+            if hasattr(fworker, "is_out_of_time") and fworker.is_out_of_time(launchpad):
+                log_multi(l_logger, "None of the READY FWs fit into the remaining walltime - exiting")
+                break
+            if not launchpad.future_run_exists(fworker):
+                break
+        time.sleep(sleep_time)
+    os.chdir(curdir)
+    return nstarted
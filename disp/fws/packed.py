@@ -0,0 +1,316 @@
+"""
+Packed storage of the per-structure files of a project
+
+Storing the `.res`, `-orig.cell` and `_data.tar.*` files of each structure as separate files
+puts millions of inodes under `airss-datastore/<project>`, which makes listing and backing up
+the project folder slow on shared filesystems. In the packed layout, the files are appended
+as records to a few segment files under `<project>/packed`:
+
+- Each worker process appends to its own segment, named after the host and the process ID, so the
+  writers do not contend with each other. A new segment is started once one reaches the size limit.
+- Each record is self-describing: a magic number, the length of a JSON header (structure name,
+  file name, size, CRC32 and time) and the raw data.
+- The location of each record is appended to the `.idx` file next to the segment, so the reader only
+  has to load the small index files for finding the files of a structure.
+- Records are never modified. A file stored again supersedes the previous record, and the
+  compaction rewrites the live records into new segments, dropping the superseded ones.
+
+The appends and the compaction lock the segment with `flock`, so a segment is never removed
+while being written to.
+"""
+import fcntl
+import json
+import os
+import socket
+import struct
+import time
+import zlib
+from pathlib import Path
+from uuid import uuid4
+
+__all__ = ("PackedDatastore", "PACKED_DIRNAME", "LOOSE_SUFFIXES")
+
+PACKED_DIRNAME = "packed"
+SEGMENT_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+MAGIC = b"DSPK"
+HEADER_LENGTH = struct.Struct("<I")
+# Size at which the writers move on to a new segment
+MAX_SEGMENT_SIZE = 1024**3
+# Amount of data rewritten in a single append by the compaction
+COMPACTION_BATCH_SIZE = 64 * 1024**2
+# Suffixes of the per-structure files stored directly in the project folder
+LOOSE_SUFFIXES = ("-orig.cell", "-seed.cell", "_data.tar.gz", "_data.tar.zst", ".res")
+
+
+class PackedDatastore:
+    """Append-only store of the files of the structures in a project folder"""
+
+    def __init__(self, project_path, writer_id=None, max_segment_size=MAX_SEGMENT_SIZE):
+        """
+        Instantiate a PackedDatastore
+
+        Args:
+          project_path: Path of the project folder, the segments are stored in its `packed` sub-folder
+          writer_id: Name of the segments written, defaults to the host name and the process ID
+          max_segment_size: Size in bytes at which a new segment is started
+        """
+        self.project_path = Path(project_path)
+        self.path = self.project_path / PACKED_DIRNAME
+        self.writer_id = writer_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.max_segment_size = max_segment_size
+        self._segment_number = 0
+        self._index = None
+
+    def __repr__(self):
+        return f"PackedDatastore(project_path={self.project_path})"
+
+    # Writing
+
+    def put(self, struct_name, files):
+        """
+        Store the files of a structure
+
+        Args:
+          struct_name: Name of the structure
+          files: A dictionary of the contents keyed by the file names. The contents can be
+            bytes, str or the Path of the file to be stored.
+
+        Returns:
+          The number of files stored
+        """
+        records = []
+        for name, content in files.items():
+            if isinstance(content, Path):
+                content = content.read_bytes()
+            elif isinstance(content, str):
+                content = content.encode()
+            records.append(({"struct": struct_name, "name": str(name), "time": time.time()}, content))
+        if records:
+            self._append(records)
+        return len(records)
+
+    def _append(self, records):
+        """Append (entry, data) records to the current segment and its index under the lock"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        while True:
+            segment = self.path / f"{self.writer_id}-{self._segment_number:04d}{SEGMENT_SUFFIX}"
+            with open(segment, "ab") as fhandle:
+                fcntl.flock(fhandle, fcntl.LOCK_EX)
+                stat = os.fstat(fhandle.fileno())
+                # Removed by the compaction while waiting for the lock - open it again
+                if stat.st_nlink == 0:
+                    continue
+                if stat.st_size >= self.max_segment_size:
+                    self._segment_number += 1
+                    continue
+                offset = stat.st_size
+                lines = []
+                for entry, data in records:
+                    entry = dict(entry, size=len(data), crc=zlib.crc32(data))
+                    header = json.dumps(entry).encode()
+                    fhandle.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header + data)
+                    offset += len(MAGIC) + HEADER_LENGTH.size + len(header)
+                    lines.append(json.dumps(dict(entry, offset=offset)) + "\n")
+                    offset += len(data)
+                fhandle.flush()
+                # The index is written after the data so it never points to missing records
+                with open(segment.with_suffix(INDEX_SUFFIX), "a") as index:
+                    index.write("".join(lines))
+            self._index = None
+            return segment
+
+    # Reading
+
+    def get_segments(self):
+        """Return the paths of the segments"""
+        if not self.path.is_dir():
+            return []
+        return sorted(self.path.glob("*" + SEGMENT_SUFFIX))
+
+    def load_index(self, segments=None):
+        """
+        Load the locations of the latest records
+
+        Args:
+          segments: Only load the index of these segments
+
+        Returns:
+          A dictionary of the index entries keyed by (struct_name, file name)
+        """
+        index = {}
+        for segment in self.get_segments() if segments is None else segments:
+            try:
+                lines = segment.with_suffix(INDEX_SUFFIX).read_text().splitlines()
+            except FileNotFoundError:
+                continue
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written line
+                    continue
+                entry["segment"] = segment
+                key = (entry["struct"], entry["name"])
+                if key not in index or index[key]["time"] <= entry["time"]:
+                    index[key] = entry
+        return index
+
+    @property
+    def index(self):
+        """The cached index of the latest records"""
+        if self._index is None:
+            self._index = self.load_index()
+        return self._index
+
+    def list_structures(self):
+        """Return the names of the structures stored"""
+        return sorted({key[0] for key in self.index})
+
+    def list_files(self, struct_name):
+        """Return the names of the files stored for a structure"""
+        return sorted(key[1] for key in self.index if key[0] == struct_name)
+
+    def get(self, struct_name, name):
+        """
+        Return the content of a file of a structure as bytes
+
+        Raises:
+          KeyError: if the file is not stored
+        """
+        for attempt in range(2):
+            entry = self.index.get((struct_name, name))
+            if entry is None:
+                raise KeyError(f"{name} of structure {struct_name} is not in the datastore {self.path}")
+            try:
+                return self._read_record(entry)
+            except FileNotFoundError:
+                # The segment has been compacted since the index was loaded
+                if attempt:
+                    raise
+                self._index = None
+        return None
+
+    def get_files(self, struct_name):
+        """Return the contents of all files of a structure keyed by their names"""
+        return {name: self.get(struct_name, name) for name in self.list_files(struct_name)}
+
+    def extract(self, struct_name, destination="."):
+        """
+        Write the files of a structure to a folder
+
+        Returns:
+          A list of the paths written
+        """
+        destination = Path(destination)
+        destination.mkdir(parents=True, exist_ok=True)
+        paths = []
+        for name, content in self.get_files(struct_name).items():
+            (destination / name).parent.mkdir(parents=True, exist_ok=True)
+            (destination / name).write_bytes(content)
+            paths.append(destination / name)
+        return paths
+
+    @staticmethod
+    def _read_record(entry):
+        """Read and verify the data of a record"""
+        with open(entry["segment"], "rb") as fhandle:
+            fhandle.seek(entry["offset"])
+            data = fhandle.read(entry["size"])
+        if len(data) != entry["size"] or zlib.crc32(data) != entry["crc"]:
+            raise ValueError(f"Corrupted record of {entry['name']} of structure {entry['struct']} in {entry['segment']}")
+        return data
+
+    # Maintenance
+
+    def compact(self, pack_loose=False):
+        """
+        Rewrite the latest records into new segments and remove the old ones
+
+        Segments being written to are left for the next compaction. The writers of the removed
+        segments simply start them again on their next append.
+
+        Args:
+          pack_loose: Also move the per-structure files stored directly in the project folder
+            into the datastore, e.g. when converting an existing project
+
+        Returns:
+          A dictionary with the number of segments compacted, records kept, records dropped and
+          loose files packed
+        """
+        stats = {"segments": 0, "kept": 0, "dropped": 0, "loose": 0}
+        writer = PackedDatastore(self.project_path, writer_id=f"compact-{uuid4().hex[:8]}", max_segment_size=self.max_segment_size)
+        locked = {}
+        try:
+            for segment in self.get_segments():
+                fhandle = open(segment, "rb")  # pylint: disable=consider-using-with
+                try:
+                    fcntl.flock(fhandle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    fhandle.close()
+                    continue
+                locked[segment] = fhandle
+
+            # Records superseded by those in the segments being written to are dropped as well
+            latest = self.load_index()
+            batch, batch_size = [], 0
+            for key in self.load_index(list(locked)):
+                entry = latest[key]
+                if entry["segment"] not in locked:
+                    continue
+                data = self._read_record(entry)
+                stats["kept"] += 1
+                batch.append(({"struct": entry["struct"], "name": entry["name"], "time": entry["time"]}, data))
+                batch_size += len(data)
+                if batch_size >= COMPACTION_BATCH_SIZE:
+                    writer._append(batch)  # pylint: disable=protected-access
+                    batch, batch_size = [], 0
+            if batch:
+                writer._append(batch)  # pylint: disable=protected-access
+
+            for segment in locked:
+                index_file = segment.with_suffix(INDEX_SUFFIX)
+                nrecords = len(index_file.read_text().splitlines()) if index_file.is_file() else 0
+                stats["dropped"] += nrecords
+                # The index goes first while the segment is still locked - a writer can create the
+                # segment again as soon as it is unlinked, and its entries must not go to the old index
+                index_file.unlink(missing_ok=True)
+                segment.unlink()
+                stats["segments"] += 1
+        finally:
+            for fhandle in locked.values():
+                fhandle.close()
+        stats["dropped"] -= stats["kept"]
+
+        if pack_loose:
+            stats["loose"] = self._pack_loose(writer)
+        self._index = None
+        return stats
+
+    def _pack_loose(self, writer):
+        """Move the per-structure files in the project folder into the datastore"""
+        batch, paths, batch_size = [], [], 0
+        nfiles = 0
+        for path in sorted(self.project_path.iterdir()):
+            suffix = next((suffix for suffix in LOOSE_SUFFIXES if path.name.endswith(suffix)), None)
+            if suffix is None or len(path.name) == len(suffix) or not path.is_file():
+                continue
+            data = path.read_bytes()
+            # Keep the original time so newer records written by the tasks take the precedence
+            batch.append(({"struct": path.name[: -len(suffix)], "name": path.name, "time": path.stat().st_mtime}, data))
+            paths.append(path)
+            batch_size += len(data)
+            if batch_size >= COMPACTION_BATCH_SIZE or len(batch) >= 1000:
+                nfiles += self._flush_loose(writer, batch, paths)
+                batch, paths, batch_size = [], [], 0
+        if batch:
+            nfiles += self._flush_loose(writer, batch, paths)
+        return nfiles
+
+    @staticmethod
+    def _flush_loose(writer, batch, paths):
+        """Append a batch of loose files and remove them once stored"""
+        writer._append(batch)  # pylint: disable=protected-access
+        for path in paths:
+            path.unlink()
+        return len(paths)
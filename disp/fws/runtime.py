@@ -0,0 +1,305 @@
+"""
+Estimating the run times of the Fireworks
+
+The relaxation tasks record the timing of each launch parsed from the CASTEP output (see
+`AirssCastepRelaxTask._get_timing_data`). A simple model is fitted to the completed launches:
+
+- For each combination of seed and code: a high percentile of the time per ionic step and of
+  the number of ionic steps, and the median overhead of a launch outside of the relaxation.
+- A power law of the time per ionic step against the number of atoms, used for the seeds
+  without any completed launches.
+- A speed factor for each worker, relative to the others running the same seeds.
+
+The model is stored in the `disp_runtime_model` collection of the LaunchPad database. It is used
+to set the `_walltime_seconds` (the predicted run time with a safety margin) and `_expected_runtime`
+fields of the READY Fireworks, so that the workers only pick the jobs that fit their remaining time.
+"""
+import re
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+
+__all__ = ("RuntimeModel", "collect_samples", "update_ready_fireworks")
+
+MODEL_COLLECTION = "disp_runtime_model"
+MODEL_ID = "default"
+# Codes of the relaxation tasks
+CODE_TASKS = {
+    "AirssCastepRelaxTask": "castep",
+    "CastepSinglepointTask": "castep",
+    "AirssGulpRelaxTask": "gulp",
+    "AirssPp3RelaxTask": "pp3",
+}
+# Status of the relaxations run to the end, the others have truncated steps
+FINISHED = "FINISHED"
+FW_NAME_REGEX = re.compile(r"(\w+)\}*$")
+POSITIONS_REGEX = re.compile(r"%block\s+positions_(?:frac|abs)\s*\n(.*?)%endblock", re.IGNORECASE | re.DOTALL)
+
+
+def get_relax_task(tasks):
+    """
+    Find the relaxation task from a list of task dictionaries, including those of batched searches
+
+    Returns:
+      A tuple of the code and the task dictionary, (None, None) if there is no relaxation task.
+    """
+    for task in tasks:
+        match = FW_NAME_REGEX.search(task.get("_fw_name", ""))
+        name = match.group(1) if match else ""
+        if name == "AirssBatchSearchTask":
+            return get_relax_task(task.get("tasks", []))
+        if name in CODE_TASKS:
+            return CODE_TASKS[name], task
+    return None, None
+
+
+def count_atoms(cell_content):
+    """Count the atoms in the content of a cell file, returns None if it cannot be found"""
+    if not isinstance(cell_content, str):
+        return None
+    match = POSITIONS_REGEX.search(cell_content)
+    if not match:
+        return None
+    lines = [line for line in match.group(1).split("\n") if line.strip() and not line.strip().lower().startswith(("ang", "bohr"))]
+    return len(lines)
+
+
+def collect_samples(lpad, query=None):
+    """
+    Collect the timing of the completed launches
+
+    Only the relaxations finished in their first launch are sampled. A continuation (with
+    `launch_count` in the spec) restarts from the structure left by the previous launch, so its
+    number of ionic steps falls short of those needed by a fresh structure.
+
+    Args:
+      lpad: The LaunchPad instance
+      query: Additional query for the launches
+
+    Returns:
+      A list of dictionaries with the seed name, code, worker, total run time of the launch (None for
+      structures of batched searches) and the timing recorded by the relaxation task.
+    """
+    launch_query = {
+        "state": "COMPLETED",
+        "$or": [{"action.stored_data.timing": {"$exists": True}}, {"action.stored_data.structures": {"$exists": True}}],
+    }
+    if query:
+        launch_query.update(query)
+    projection = {"fw_id": 1, "runtime_secs": 1, "fworker.name": 1, "action.stored_data": 1}
+    launches = list(lpad.launches.find(launch_query, projection))
+
+    fw_projection = {"fw_id": 1, "spec.seed_name": 1, "spec.launch_count": 1, "spec._tasks._fw_name": 1, "spec._tasks.tasks._fw_name": 1}
+    fw_ids = [launch["fw_id"] for launch in launches]
+    fireworks = {doc["fw_id"]: doc for doc in lpad.fireworks.find({"fw_id": {"$in": fw_ids}}, fw_projection)}
+
+    samples = []
+    for launch in launches:
+        fw_doc = fireworks.get(launch["fw_id"])
+        if fw_doc is None or fw_doc["spec"].get("launch_count"):
+            continue
+        code, _ = get_relax_task(fw_doc["spec"].get("_tasks", []))
+        stored_data = launch["action"]["stored_data"]
+        if "timing" in stored_data:
+            records = [(stored_data, launch.get("runtime_secs"))]
+        else:
+            records = [(data, None) for data in stored_data["structures"] if "timing" in data]
+        timings = [(data["timing"], runtime) for data, runtime in records if data.get("relax_status", FINISHED) == FINISHED]
+        for timing, runtime in timings:
+            samples.append(
+                {
+                    "seed_name": fw_doc["spec"].get("seed_name"),
+                    "code": code,
+                    "worker": launch.get("fworker", {}).get("name"),
+                    "runtime": runtime,
+                    "timing": timing,
+                }
+            )
+    return samples
+
+
+class RuntimeModel:
+    """Model for predicting the run time of relaxations"""
+
+    MIN_WORKER_SAMPLES = 5  # Minimum number of samples for estimating the speed factor of a worker
+
+    def __init__(self, groups=None, natoms_fit=None, default_steps=None, default_overhead=0.0, worker_factors=None, nsamples=0):
+        """
+        Instantiate a RuntimeModel
+
+        Args:
+          groups: A list of dictionaries with the estimates for each combination of seed and code
+          natoms_fit: Slope and intercept of log(time per ionic step) against log(number of atoms)
+          default_steps: Number of ionic steps for the seeds without any samples
+          default_overhead: Overhead in seconds for the seeds without any samples
+          worker_factors: Relative speed of each worker, larger is slower
+          nsamples: Number of samples the model is fitted to
+        """
+        self.groups = {(group["seed_name"], group["code"]): group for group in groups or []}
+        self.natoms_fit = natoms_fit
+        self.default_steps = default_steps
+        self.default_overhead = default_overhead
+        self.worker_factors = worker_factors or {}
+        self.nsamples = nsamples
+
+    @classmethod
+    def fit(cls, samples, percentile=90):
+        """
+        Fit the model to the timing of the completed launches
+
+        Args:
+          samples: A list of samples as returned by `collect_samples`
+          percentile: Percentile of the time per step and the number of steps used for the predictions
+
+        Returns:
+          A RuntimeModel instance
+        """
+        by_group = defaultdict(list)
+        for sample in samples:
+            by_group[(sample["seed_name"], sample["code"])].append(sample)
+
+        groups = []
+        ratios = defaultdict(list)
+        for (seed_name, code), group_samples in by_group.items():
+            step_times = np.array([sample["timing"]["avg_ionic_time"] for sample in group_samples])
+            steps = [sample["timing"]["ionic_steps"] for sample in group_samples]
+            overheads = [
+                max(sample["runtime"] - sample["timing"]["total_time"], 0.0) for sample in group_samples if sample["runtime"] is not None
+            ]
+            natoms = [sample["timing"].get("natoms") for sample in group_samples if sample["timing"].get("natoms")]
+            groups.append(
+                {
+                    "seed_name": seed_name,
+                    "code": code,
+                    "step_time": float(np.percentile(step_times, percentile)),
+                    "median_step_time": float(np.median(step_times)),
+                    "steps": float(np.percentile(steps, percentile)),
+                    "overhead": float(np.median(overheads)) if overheads else 0.0,
+                    "natoms": int(np.median(natoms)) if natoms else None,
+                    "nsamples": len(group_samples),
+                }
+            )
+            for sample, step_time in zip(group_samples, step_times):
+                ratios[sample["worker"]].append(step_time / groups[-1]["median_step_time"])
+
+        natoms_fit = None
+        with_natoms = [group for group in groups if group["natoms"]]
+        if len({group["natoms"] for group in with_natoms}) > 1:
+            slope, intercept = np.polyfit(
+                np.log([group["natoms"] for group in with_natoms]), np.log([group["step_time"] for group in with_natoms]), 1
+            )
+            natoms_fit = [float(slope), float(intercept)]
+
+        worker_factors = {
+            worker: float(np.median(values)) for worker, values in ratios.items() if worker and len(values) >= cls.MIN_WORKER_SAMPLES
+        }
+        return cls(
+            groups=groups,
+            natoms_fit=natoms_fit,
+            default_steps=float(np.median([group["steps"] for group in groups])) if groups else None,
+            default_overhead=float(np.median([group["overhead"] for group in groups])) if groups else 0.0,
+            worker_factors=worker_factors,
+            nsamples=len(samples),
+        )
+
+    def predict(self, seed_name, code, cycles=None, natoms=None):
+        """
+        Predict the run time of a relaxation
+
+        Args:
+          seed_name: Name of the seed
+          code: Code used for the relaxation
+          cycles: Maximum number of ionic steps, zero for singlepoint calculations
+          natoms: Number of atoms, used if there is no sample for the seed
+
+        Returns:
+          The predicted run time in seconds, or None if no prediction can be made.
+        """
+        group = self.groups.get((seed_name, code))
+        if group is not None:
+            step_time, steps, overhead = group["step_time"], group["steps"], group["overhead"]
+        elif natoms and self.natoms_fit and code == "castep":
+            slope, intercept = self.natoms_fit
+            step_time, steps, overhead = float(np.exp(intercept) * natoms**slope), self.default_steps, self.default_overhead
+        else:
+            return None
+        if cycles is not None:
+            steps = min(steps, max(cycles, 1))
+        return overhead + steps * step_time
+
+    def to_dict(self):
+        """Return the model as a dictionary"""
+        return {
+            "groups": list(self.groups.values()),
+            "natoms_fit": self.natoms_fit,
+            "default_steps": self.default_steps,
+            "default_overhead": self.default_overhead,
+            "worker_factors": self.worker_factors,
+            "nsamples": self.nsamples,
+        }
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Construct the model from a dictionary"""
+        keys = ["groups", "natoms_fit", "default_steps", "default_overhead", "worker_factors", "nsamples"]
+        return cls(**{key: dct[key] for key in keys if key in dct})
+
+    def save(self, lpad):
+        """Store the model in the database"""
+        doc = dict(self.to_dict(), updated_on=datetime.utcnow())
+        lpad.db[MODEL_COLLECTION].replace_one({"_id": MODEL_ID}, doc, upsert=True)
+
+    @classmethod
+    def load(cls, lpad):
+        """Load the model from the database, returns None if there is no model"""
+        doc = lpad.db[MODEL_COLLECTION].find_one({"_id": MODEL_ID})
+        if doc is None:
+            return None
+        return cls.from_dict(doc)
+
+
+def update_ready_fireworks(lpad, model, margin=1.3, query=None, dryrun=False):
+    """
+    Update the walltime and the expected run time of the READY Fireworks
+
+    Args:
+      lpad: The LaunchPad instance
+      model: The RuntimeModel instance
+      margin: Factor applied to the prediction to obtain the `_walltime_seconds`
+      query: Additional query for selecting the Fireworks
+      dryrun: Only count the Fireworks to be updated
+
+    Returns:
+      The number of Fireworks with a predicted run time
+    """
+    fw_query = {"state": "READY"}
+    if query:
+        fw_query.update(query)
+    projection = {
+        "fw_id": 1,
+        "spec.seed_name": 1,
+        "spec.struct_content": 1,
+        "spec._tasks._fw_name": 1,
+        "spec._tasks.cycles": 1,
+        "spec._tasks.tasks._fw_name": 1,
+        "spec._tasks.tasks.cycles": 1,
+    }
+    # Group the Fireworks by the new values so they can be updated together
+    updates = defaultdict(list)
+    for doc in lpad.fireworks.find(fw_query, projection):
+        spec = doc["spec"]
+        code, task = get_relax_task(spec.get("_tasks", []))
+        if code is None:
+            continue
+        expected = model.predict(spec.get("seed_name"), code, cycles=task.get("cycles"), natoms=count_atoms(spec.get("struct_content")))
+        if expected is None:
+            continue
+        updates[(int(expected * margin), int(expected))].append(doc["fw_id"])
+
+    if not dryrun:
+        for (walltime, expected), fw_ids in updates.items():
+            lpad.fireworks.update_many(
+                {"fw_id": {"$in": fw_ids}}, {"$set": {"spec._walltime_seconds": walltime, "spec._expected_runtime": expected}}
+            )
+    return sum(len(fw_ids) for fw_ids in updates.values())
@@ -0,0 +1,168 @@
+"""
+Matching the number of queued array tasks to the work available
+
+The controller counts the backlog of a worker - the READY Fireworks its query selects plus the
+structures that its search campaigns are yet to materialise - and converts it into the number of
+jobs needed, given the number of Fireworks each job is expected to run. The tasks of the arrays
+with the given job name are then controlled individually:
+
+- pending tasks in excess of the jobs needed are held, the last ones to start first,
+- held tasks are released for the jobs missing, up to the number missing,
+- a new array is submitted if even the held tasks are not enough (optional).
+
+This avoids allocations starting only to find nothing to run, which wastes the fairshare.
+"""
+import math
+from collections import Counter
+
+from .campaign import CAMPAIGN_COLLECTION, category_match
+
+__all__ = ("ArrayScaler",)
+
+# pylint: disable=too-many-arguments, too-many-instance-attributes
+
+
+class ArrayScaler:
+    """Controller for holding, releasing and submitting the arrays of a worker"""
+
+    def __init__(
+        self,
+        lpad,
+        scheduler,
+        fworker,
+        job_name,
+        fws_per_job=10,
+        min_priority=None,
+        max_jobs=None,
+        submit_script=None,
+        max_submit=100,
+        user_name=None,
+    ):
+        """
+        Instantiate an ArrayScaler
+
+        Args:
+          lpad: The LaunchPad instance
+          scheduler: The Scheduler instance (Slurm, PBS or LSF) used for querying and controlling the queue
+          fworker: The worker run by the array jobs, its query selects the Fireworks counted
+          job_name: Name of the array jobs to be controlled
+          fws_per_job: Number of Fireworks each job is expected to run
+          min_priority: Only count the Fireworks with at least this priority
+          max_jobs: Maximum number of running and pending jobs
+          submit_script: Job script to be submitted when more jobs are needed
+          max_submit: Maximum number of tasks of a submitted array
+          user_name: Name of the owner of the jobs, defaults to the current user
+        """
+        self.lpad = lpad
+        self.scheduler = scheduler
+        self.fworker = fworker
+        self.job_name = job_name
+        self.fws_per_job = fws_per_job
+        self.min_priority = min_priority
+        self.max_jobs = max_jobs
+        self.submit_script = submit_script
+        self.max_submit = max_submit
+        self.user_name = user_name
+
+    def count_backlog(self):
+        """
+        Count the Fireworks waiting to be run by the worker
+
+        Returns:
+          A Counter of the number of Fireworks keyed by their priority
+        """
+        query = {"$and": [self.fworker.base_query, {"state": "READY"}]}
+        if self.min_priority is not None:
+            query["$and"].append({"spec._priority": {"$gte": self.min_priority}})
+        pipeline = [{"$match": query}, {"$group": {"_id": "$spec._priority", "count": {"$sum": 1}}}]
+        backlog = Counter()
+        for doc in self.lpad.fireworks.aggregate(pipeline):
+            backlog[doc["_id"]] += doc["count"]
+
+        # Structures of the campaigns not materialised yet
+        projection = {"created": 1, "target": 1, "category": 1, "priority": 1, "batch_size": 1}
+        for doc in self.lpad.db[CAMPAIGN_COLLECTION].find({"state": "ACTIVE"}, projection):
+            if not category_match(doc.get("category"), self.fworker.category):
+                continue
+            if self.min_priority is not None and (doc.get("priority") is None or doc["priority"] < self.min_priority):
+                continue
+            remaining = max(doc["target"] - doc["created"], 0)
+            backlog[doc.get("priority")] += math.ceil(remaining / (doc.get("batch_size") or 1))
+        return backlog
+
+    def get_queue(self):
+        """
+        Count the tasks of the controlled arrays in the queue
+
+        Returns:
+          A dictionary with the number of running, pending and held tasks, and the lists of the
+          pending and the held tasks.
+        """
+        queue = {"running": 0, "pending": 0, "held": 0, "pending_tasks": [], "held_tasks": []}
+        for task in self.scheduler.get_array_tasks(user_name=self.user_name, job_name=self.job_name):
+            if task["state"] in ("R", "CG", "CF"):
+                queue["running"] += 1
+            elif task["state"] == "PD":
+                key = "held" if task["held"] else "pending"
+                queue[key] += 1
+                queue[f"{key}_tasks"].append(task)
+        return queue
+
+    def get_wanted_jobs(self, nfws):
+        """Return the number of jobs needed for running a number of Fireworks"""
+        wanted = math.ceil(nfws / self.fws_per_job)
+        if self.max_jobs is not None:
+            wanted = min(wanted, self.max_jobs)
+        return wanted
+
+    def plan(self, backlog, queue):
+        """
+        Decide the actions for matching the queue to the backlog
+
+        The number of jobs wanted is capped by `max_jobs`, so neither the tasks released nor those
+        submitted take the running and pending jobs over the limit.
+
+        Returns:
+          A dictionary with the number of jobs wanted, the tasks to be held and released,
+          and the number of tasks to be submitted.
+        """
+        wanted = self.get_wanted_jobs(sum(backlog.values()))
+        actions = {"wanted": wanted, "hold": [], "release": [], "submit": 0}
+        queued = queue["running"] + queue["pending"]
+        if queued > wanted:
+            actions["hold"] = sorted(queue["pending_tasks"], key=task_order, reverse=True)[: queued - wanted]
+            return actions
+        missing = wanted - queued
+        actions["release"] = sorted(queue["held_tasks"], key=task_order)[:missing]
+        missing -= len(actions["release"])
+        if missing > 0 and self.submit_script:
+            actions["submit"] = min(missing, self.max_submit)
+        return actions
+
+    def step(self, dryrun=False):
+        """
+        Run a single control cycle
+
+        Args:
+          dryrun: Only plan the actions without applying them
+
+        Returns:
+          A tuple of the backlog, the queue and the planned actions
+        """
+        backlog = self.count_backlog()
+        queue = self.get_queue()
+        actions = self.plan(backlog, queue)
+        if not dryrun:
+            if actions["hold"]:
+                self.scheduler.hold_tasks(actions["hold"])
+            if actions["release"]:
+                self.scheduler.release_tasks(actions["release"])
+            if actions["submit"]:
+                actions["submitted"] = self.scheduler.submit_array(self.submit_script, actions["submit"], job_name=self.job_name)
+        return backlog, queue, actions
+
+
+def task_order(task):
+    """Key for sorting the array tasks in the order they are started by the scheduler"""
+    task_id = str(task.get("task_id"))
+    return (str(task["array_id"]), int(task_id) if task_id.isdigit() else 0)
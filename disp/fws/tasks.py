@@ -2,34 +2,47 @@
 Module defining the FIRE tasks for AIRSS operations
 """
 import contextlib
+import copy
 import filecmp
+import json
 import os
 import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
-import tarfile
+import tempfile
 import time
 from enum import Enum
 from pathlib import Path
 from uuid import uuid4
 
+import numpy as np
 from fireworks import explicit_serialize
 from fireworks.core.firework import FiretaskBase, Firework, FWAction
+from fireworks.utilities.fw_serializers import load_object
 from fireworks.utilities.fw_utilities import get_fw_logger
 
+from disp.buildpool import BuildcellPool, run_buildcell
+from disp.castep_analysis import get_castep_summary
 from disp.casteptools import (
     castep_finish_ok,
     castep_geom_count,
+    count_cell_atoms,
     get_rand_cell_name,
     gulp_relax_finish_ok,
     push_cell,
 )
 from disp.database import DB_FILE, SearchDB, get_hash
+from disp.fws.blobs import resolve_blobs, store_firework_blobs
+from disp.fws.drain import is_draining
+from disp.fws.packed import PackedDatastore
 from disp.fws.utils import FWPathManager
+from disp.monitor import CastepRelaxMonitor, EnthalpyCutoff, GulpRelaxMonitor, build_rules
 from disp.scheduler import Scheduler
 
-from .utility_tasks import GzipDir
+from .utility_tasks import GzipDir, write_archive
 
 # pylint: disable=logging-format-interpolation, too-many-lines
 
@@ -43,6 +56,8 @@ class RelaxOutcome(Enum):
     UNDETERMINED = 3
     CYCLE_EXCEEDED = 4
     INSUFFICIENT_TIME = 5
+    ABORTED = 6
+    UNPROMISING = 7
 
 
 @explicit_serialize
@@ -92,6 +107,10 @@ class AirssBuildcellTask(FiretaskBase):
       relaxation within the same Firework.
     - deposit_init_structure: Store the initial structure to the database or not. Default to False.
     - keep_seed: Whether write out the seed to the file system. Default to True.
+
+    If a pool of pre-generated structures is configured, either with the `buildcell_pool` key
+    under `env` of the worker file or the `DISP_BUILDCELL_POOL` environmental variable, a ready
+    structure is taken from the pool and buildcell is only run when the pool is empty.
     """
 
     # _fw_name = 'BuildcellTask'
@@ -103,6 +122,7 @@ class AirssBuildcellTask(FiretaskBase):
         """
         Internal function for running buildcell
         """
+        resolve_blobs(self, fw_spec)
         seed_name = self["seed_name"]
         project_name = self["project_name"]
         seed_content = self["seed_content"]
@@ -110,33 +130,31 @@ class AirssBuildcellTask(FiretaskBase):
         # Timeout default to 600 seconds
         build_timeout = self.get("build_timeout", 300)
 
+        # Take a pre-generated structure if available
+        stdout = None
+        pool = BuildcellPool.from_env(fw_spec.get("_fw_env"))
+        if pool is not None:
+            stdout = pool.pop(seed_content)
+            if stdout is not None:
+                self.logger.info(f"Took a pre-generated structure from the pool at {pool.pool_dir}")
+
         # Try to build the random structure with timeout
-        self.logger.info("Start building a random structure...")
         attempt = 3
-        while attempt > 0:
+        if stdout is None:
+            self.logger.info("Start building a random structure...")
+        while stdout is None and attempt > 0:
             try:
-                proc = subprocess.Popen(
-                    "buildcell",
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    universal_newlines=True,
-                )
-                stdout, stderr = proc.communicate(seed_content, timeout=build_timeout)
+                stdout = run_buildcell(seed_content, timeout=build_timeout)
             except subprocess.TimeoutExpired:
                 attempt -= 1
-            else:
-                break
 
-        if attempt <= 0:
+        if stdout is None:
             msg = "Warning - random structure generation timedout"
             self.logger.error(msg)
             return FWAction(defuse_children=True, stored_data={"message": msg})
 
         self.logger.info("Random structure building completed")
 
-        stdout = stdout.decode("utf-8") if isinstance(stdout, bytes) else stdout
-        stderr = stderr.decode("utf-8") if isinstance(stderr, bytes) else stderr
-
         cell_name = get_rand_cell_name(self["seed_name"])
         struct_name = cell_name.replace(".cell", "")
 
@@ -211,6 +229,7 @@ class AirssModcellTask(FiretaskBase):
     logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
 
     def run_task(self, fw_spec):
+        resolve_blobs(self, fw_spec)
         # Importing the function
         func_content = self.get("func_content", None)
         # If given the content, we write it to the disk and import it
@@ -282,6 +301,20 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
       Can also be defined at a per-worker basis using `castep_relax_prepend_command` under the `env` field.
     - append_command: A list of commands to be run after the relaxation, such as cleaning certain files.
       Can also be defined at a per-worker basis using `castep_relax_append_command` under the `env` field.
+    - abort_rules: A list of rules for aborting hopeless relaxations early, see `disp.monitor.build_rules`.
+      The output is checked every `MONITOR_INTERVAL` seconds while the relaxation runs.
+    - energy_cutoff: A dictionary for aborting relaxations that are projected to end far above the low
+      energy structures already found in the project, see `ENERGY_CUTOFF_DEFAULTS` for the keys.
+      Such relaxations are recorded with the `UNPROMISING` status.
+
+    If the worker receives a pre-termination signal (see `disp.fws.drain`), the relaxation is stopped
+    within `DRAIN_CHECK_INTERVAL` seconds and continued in a new Firework, as for a timeout.
+
+    Setting `local_scratch` in the spec or under the `env` field of the worker runs the calculation in
+    a node-local directory, to reduce the metadata operations on shared file systems. It can be `true`
+    for using $TMPDIR or a path. The files are copied back to the launch directory in a single pass at
+    the end, apart from those with the suffixes in `local_scratch_exclude` (`SCRATCH_ONLY_SUFFIXES` by
+    default), and no symbolic links are created in the `running` folder of the project.
 
     Required parameter for this task:
 
@@ -296,8 +329,19 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
 
     # _fw_name = 'CastepRelaxTask'
     required_params = ["cycles", "param_content", "executable"]
-    optional_params = ["minimum_run_time", "prepend_command", "append_command", "castep_code", "cluster"]
+    optional_params = ["minimum_run_time", "prepend_command", "append_command", "castep_code", "cluster", "abort_rules", "energy_cutoff"]
     MINIMUM_RUN_TIME = 600
+    MONITOR_INTERVAL = 30
+    DRAIN_CHECK_INTERVAL = 5
+    SCRATCH_ONLY_SUFFIXES = [".check", ".check_bak", ".castep_bin", ".cst_esp", ".bands"]
+    ENERGY_CUTOFF_DEFAULTS = {
+        "window": 0.5,  # Abort if projected to end more than this above the reference (eV/atom)
+        "percentile": 5,  # Percentile of the enthalpies per atom in the project used as the reference
+        "min_steps": 10,  # Minimum number of ionic steps before applying the cutoff
+        "min_count": 20,  # Minimum number of relaxed structures needed for the reference
+        "per_seed": True,  # Only compare with the structures of the same seed
+        "max_age": 3600,  # Maximum age of the locally cached enthalpies in seconds
+    }
     logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
     SCHEDULER_TIME_OFFSET = 60
     PRIORITY_OFFSET = {"insufficient_time": 15, "continuation": 10}
@@ -305,12 +349,19 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
     run_script_name = "jobscript.sh"
     code_string = "castep_relax"  # Identifier for which code is running
     _param_suffix = ".param"
+    monitor_class = CastepRelaxMonitor  # Class for monitoring the relaxation
+    monitor_suffix = ".castep"  # Suffix of the file to be monitored
+
+    def get_minimum_run_time(self):
+        """Return the remaining walltime (seconds) needed for starting the relaxation"""
+        return self.get("minimum_run_time", self.MINIMUM_RUN_TIME) + self.SCHEDULER_TIME_OFFSET
 
     # pylint: disable=attribute-defined-outside-init
     def _init_parameters(self, fw_spec):
         """Initialise the internal parameters"""
         # Required parameters
         fw_env = fw_spec.get("_fw_env", {})
+        self.blob_store = resolve_blobs(self, fw_spec)
         self.cycles = self["cycles"]
         self.param_content = self["param_content"]
         self.minimum_run_time = self.get("minimum_run_time", self.MINIMUM_RUN_TIME)
@@ -345,6 +396,13 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
 
         self.prepend_command = self.get("prepend_command", fw_env.get(f"{self.code_string}_prepend_command"))
         self.append_command = self.get("append_command", fw_env.get(f"{self.code_string}_append_command"))
+        self.abort_rules = self.get("abort_rules", fw_spec.get("abort_rules", []))
+        self.energy_cutoff = self.get("energy_cutoff", fw_spec.get("energy_cutoff"))
+        self.abort_reason = None
+        self.abort_rule = None
+        self.base_path = fw_spec.get("base_path")
+        self.local_scratch = fw_spec.get("local_scratch", fw_env.get("local_scratch", False))
+        self.local_scratch_exclude = fw_env.get("local_scratch_exclude", self.SCRATCH_ONLY_SUFFIXES)
 
         # Increment the launch_count in the spec
         self.nlaunches = fw_spec.get("launch_count", 0) + 1
@@ -355,8 +413,8 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
         self._sdb = None
         self.db_file = fw_spec.get("db_file", DB_FILE)
 
-        # Set the timeout
-        timeout = fw_spec.get("timeout")
+        # Set the timeout, that of the batch of structures being run takes the precedence
+        timeout = fw_spec.get(AirssBatchSearchTask.TIMEOUT_KEY, fw_spec.get("timeout"))
         if timeout is None:
             self.timeout = self._get_timeout()
         else:
@@ -427,10 +485,21 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
         )
 
     def run_task(self, fw_spec):
-        """Run the task"""
+        """Run the task, in the node-local scratch directory if requested"""
         self._init_parameters(fw_spec)
-        struct_name = self.struct_name
-
+        with self._run_directory():
+            return self._execute(fw_spec)
+
+    def _run_directory(self):
+        """Return the context for running the calculation"""
+        if not self.local_scratch:
+            return contextlib.nullcontext()
+        root = os.environ.get("TMPDIR", tempfile.gettempdir()) if self.local_scratch is True else os.path.expandvars(self.local_scratch)
+        self.logger.info(f"Running in the local scratch directory under {root}")
+        return scratch_directory(root, exclude_suffixes=self.local_scratch_exclude)
+
+    def _execute(self, fw_spec):
+        """Run the relaxation in the current directory and handle its outcome"""
         self._prepare_inputs(self.struct_name)
         cmd = self._get_cmd()
 
@@ -454,20 +523,34 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
             self._retrieve_dot_castep()
             self._delete_dot_castep()
 
-        with create_symlinks(base_path, self.project_name, run_files):
+        # The links would point to the node-local files
+        links = contextlib.nullcontext() if self.local_scratch else create_symlinks(base_path, self.project_name, run_files)
+        with links:
             relax_outcome = self._run_relax(
                 self.struct_name, cmd, actual_timeout, prepend_command=self.prepend_command, append_command=self.append_command
             )
 
+        action = self._handle_relax_outcome(relax_outcome, fw_spec)
+        # Record the timing for estimating the run time of the other structures - only complete
+        # relaxations give the number of steps needed
+        if relax_outcome is RelaxOutcome.FINISHED:
+            action.stored_data.update(self._get_timing_data())
+        return action
+
+    def _handle_relax_outcome(self, relax_outcome, fw_spec):
+        """Construct the FWAction for the outcome of the relaxation"""
         if relax_outcome is RelaxOutcome.FINISHED:
             return self._handle_relax_finshed()
 
+        if relax_outcome in (RelaxOutcome.ABORTED, RelaxOutcome.UNPROMISING):
+            return self._handle_relax_aborted(relax_outcome)
+
         if relax_outcome is RelaxOutcome.TIMEDOUT:
             # Finished with error - now we try to recover it
             self.logger.info("Relaxation timed out: taking the last geometry")
 
             # Do not add new jobs if there are less than 20 cycles
-            completed_cycles = castep_geom_count(struct_name + ".castep")
+            completed_cycles = castep_geom_count(self.struct_name + ".castep")
             reminaing_cycles = self.cycles - completed_cycles
             if (self.cycles != 0) and (reminaing_cycles < 20):
                 return self._handle_too_few_cycle_left(rem_cycles=reminaing_cycles)
@@ -478,6 +561,28 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
         # The relaxation is errorred
         return self._handle_relax_error(fw_spec)
 
+    def _get_timing_data(self):
+        """
+        Return the timing of the relaxation parsed from the output file
+
+        Returns:
+          A dictionary with the `timing` key, or an empty dictionary if the output cannot be parsed.
+        """
+        castep_file = Path(self.struct_name + ".castep")
+        if self.code_string != "castep_relax" or not castep_file.is_file():
+            return {}
+        try:
+            timing = get_castep_summary(str(castep_file))
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.warning(f"Cannot parse the timing of the relaxation: {error}")
+            return {}
+        if timing["ionic_steps"] == 0:
+            return {}
+        with open(castep_file) as fhandle:
+            match = CastepRelaxMonitor.NIONS_LINE.search(fhandle.read())
+        timing["natoms"] = int(match.group(1)) if match else None
+        return {"timing": timing}
+
     def _handle_insufficient_run_time(self, fw_spec):
         """
         Handle the problem there are insufficient run time
@@ -527,6 +632,7 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
             seed_name=self.seed_name,
             existing_spec=new_spec,
         )
+        self._store_blobs(new_fw)
 
         detours = [new_fw]
 
@@ -608,6 +714,7 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
             seed_name=self.seed_name,
             existing_spec=new_spec,
         )
+        self._store_blobs(new_fw)
 
         stored_data = {
             "relax_status": RelaxOutcome.TIMEDOUT.name,
@@ -621,6 +728,24 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
 
         return FWAction(stored_data=stored_data, detours=detours)
 
+    def _store_blobs(self, firework):
+        """Keep the contents of a new Firework in the blob store if the current one uses it"""
+        if getattr(self, "blob_store", None) is not None:
+            store_firework_blobs(self.blob_store, firework)
+        return firework
+
+    def _handle_relax_aborted(self, relax_outcome=RelaxOutcome.ABORTED):
+        """Handle relaxation aborted by the monitor - the structure is not kept"""
+        relax_status = relax_outcome.name
+        stored_data = {
+            "relax_status": relax_status,
+            "struct_name": self.struct_name,
+            "seed_name": self.seed_name,
+            "abort_reason": self.abort_reason,
+        }
+        self.logger.info(f"Relaxation aborted: {self.abort_reason}")
+        return FWAction(stored_data=stored_data, update_spec={"relax_status": relax_status})
+
     def _handle_relax_error(self, fw_spec):
         """Handle relaxation error - store the error status in spec"""
         _ = fw_spec
@@ -696,11 +821,13 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
         self._prepare_run_script(cmd, prepend_command, append_command)
         with transient_file(".realx_stdout", mode="w+") as tmpout:
             try:
-                subprocess.run(f"./{self.run_script_name}", timeout=timeout, check=True, text=True, stdout=tmpout)
+                self._run_script(tmpout, timeout, struct_name)
             except subprocess.TimeoutExpired:
                 outcome = RelaxOutcome.TIMEDOUT
                 self.logger.info("Relaxation timed out")
             else:
+                if self.abort_reason is not None:
+                    return self._get_abort_outcome()
                 tmpout.seek(0)
                 stdout_content = tmpout.read()
                 if "Pressure" in stdout_content and castep_finish_ok(struct_name + ".castep"):
@@ -710,6 +837,105 @@ class AirssCastepRelaxTask(FiretaskBase):  # pylint: disable=too-many-instance-a
 
         return outcome
 
+    def _run_script(self, stdout, timeout, struct_name):
+        """
+        Run the job script with a timeout, while monitoring the output if any abort rule is set
+
+        If the monitor decides to abort, the job script and its child processes are terminated,
+        and the reason is stored as the `abort_reason` attribute.
+
+        Raises:
+          subprocess.TimeoutExpired: If the script does not finish in time, or the worker is draining
+          subprocess.CalledProcessError: If the script finishes with non-zero exit code
+        """
+        monitor = None
+        rules = self._get_abort_rules() if self.monitor_class is not None else []
+        if rules:
+            monitor = self.monitor_class(rules)
+        deadline = time.monotonic() + timeout
+        next_follow = time.monotonic() + self.MONITOR_INTERVAL
+
+        # Run in a new session so the child processes can be terminated together
+        proc = subprocess.Popen(f"./{self.run_script_name}", text=True, stdout=stdout, start_new_session=True)
+        try:
+            while proc.poll() is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                wait = min(self.DRAIN_CHECK_INTERVAL, remaining)
+                if monitor is not None:
+                    wait = min(wait, max(next_follow - time.monotonic(), 0))
+                try:
+                    proc.wait(timeout=wait)
+                except subprocess.TimeoutExpired:
+                    pass
+                if is_draining() and proc.poll() is None:
+                    self.logger.warning("Stopping the relaxation as the worker is draining")
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                if monitor is None or (time.monotonic() < next_follow and proc.poll() is None):
+                    continue
+                next_follow = time.monotonic() + self.MONITOR_INTERVAL
+                if not monitor.follow(struct_name + self.monitor_suffix):
+                    self.abort_reason = monitor.abort_reason
+                    self.abort_rule = monitor.abort_rule
+                    return
+        finally:
+            if proc.poll() is None:
+                terminate_process_group(proc)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def _get_abort_outcome(self):
+        """Return the outcome for an aborted relaxation, depending on the rule that triggered it"""
+        return RelaxOutcome[getattr(self.abort_rule, "relax_status", RelaxOutcome.ABORTED.name)]
+
+    def _get_abort_rules(self):
+        """Construct the abort rules, including the enthalpy cutoff if requested"""
+        rules = build_rules(self.abort_rules)
+        if self.energy_cutoff and self.project_name:
+            options = {**self.ENERGY_CUTOFF_DEFAULTS, **self.energy_cutoff}
+            reference = self._get_reference_enthalpy(options)
+            if reference is not None:
+                self.logger.info(f"Using reference enthalpy {reference:.4f} eV/atom for the energy cutoff")
+                rules.append(EnthalpyCutoff(reference, window=options["window"], min_steps=options["min_steps"]))
+        return rules
+
+    def _get_reference_enthalpy(self, options):
+        """
+        Obtain the reference enthalpy per atom from the structures relaxed so far in the project
+
+        The enthalpies are cached in the project folder so the database is not queried by every task.
+
+        Returns:
+          The reference enthalpy per atom, or None if not enough structures are available.
+        """
+        seed_name = self.seed_name if options["per_seed"] else None
+        project_path = FWPathManager(self.base_path).get_project_path(self.project_name)
+        cache_file = project_path / f".enthalpy_cache_{seed_name or 'all'}.json"
+
+        values = None
+        if cache_file.is_file():
+            try:
+                cached = json.loads(cache_file.read_text())
+                if time.time() - cached["time"] < options["max_age"]:
+                    values = cached["values"]
+            except (ValueError, KeyError):
+                pass
+
+        if values is None:
+            try:
+                values = self.search_db.get_enthalpies_per_atom(self.project_name, seed_name)
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.warning(f"Cannot obtain the enthalpies of the project - energy cutoff disabled: {error}")
+                return None
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{uuid4().hex[:8]}")
+            tmp_file.write_text(json.dumps({"time": time.time(), "values": values}))
+            os.replace(tmp_file, cache_file)
+
+        if len(values) < options["min_count"]:
+            return None
+        return float(np.percentile(values, options["percentile"]))
+
     def _prepare_run_script(self, cmd, prepend_command=None, append_command=None):
         """
         Prepare the run script in the current working directory for running CASTEP
@@ -744,7 +970,7 @@ echo Current PATH: $PATH
         # Write the script content
         script_path.write_text(string)
         # Set the permission
-        subprocess.run(f"chmod +x {self.run_script_name}", shell=True, check=True)
+        os.chmod(script_path, script_path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
     def get_mpi_launch_cmd(self):  # pylint: disable=no-self-use
         """Get the launch command for MPI"""
@@ -772,9 +998,8 @@ class CastepSinglepointTask(AirssCastepRelaxTask):
         self["cycles"] = 0
         super()._init_parameters(fw_spec)
 
-    def run_task(self, fw_spec):
-        """Run the task"""
-        self._init_parameters(fw_spec)
+    def _execute(self, fw_spec):
+        """Run the singlepoint calculation in the current directory and handle its outcome"""
         # Make sure we are doing singlepoint
         new_lines = []
         for line in self.param_content.split("\n"):
@@ -804,6 +1029,9 @@ class CastepSinglepointTask(AirssCastepRelaxTask):
         if relax_outcome is RelaxOutcome.FINISHED:
             return self._handle_relax_finshed()
 
+        if relax_outcome in (RelaxOutcome.ABORTED, RelaxOutcome.UNPROMISING):
+            return self._handle_relax_aborted(relax_outcome)
+
         if relax_outcome is RelaxOutcome.TIMEDOUT:
 
             # Do not add new jobs if there are less than 20 cycles
@@ -839,6 +1067,8 @@ class AirssGulpRelaxTask(AirssCastepRelaxTask):
     logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
     code_string = "gulp_relax"  # Identifier for which code is running
     _param_suffix = ".lib"
+    monitor_class = GulpRelaxMonitor
+    monitor_suffix = ".got"  # Output of GULP written by gulp_relax
 
     def _get_cmd(self):
         """Construct the command line arguments"""
@@ -853,15 +1083,17 @@ class AirssGulpRelaxTask(AirssCastepRelaxTask):
         self._prepare_run_script(cmd, prepend_command, append_command)
         with transient_file(".relax_stdout", mode="w+") as outtmp:
             try:
-                subprocess.run(f"./{self.run_script_name}", timeout=timeout, check=True, text=True, stdout=outtmp)
-
+                self._run_script(outtmp, timeout, struct_name)
             except subprocess.TimeoutExpired:
                 outcome = RelaxOutcome.TIMEDOUT
                 self.logger.info("Relaxation timed out")
             else:
+                if self.abort_reason is not None:
+                    return self._get_abort_outcome()
                 outtmp.seek(0)
                 content = outtmp.read()
-                if gulp_relax_finish_ok(struct_name + ".castep") and "Volume" in content:
+                natoms = count_cell_atoms(struct_name + ".cell") if Path(struct_name + ".cell").is_file() else 0
+                if gulp_relax_finish_ok(struct_name + ".castep", natoms=natoms) and "Volume" in content:
                     outcome = RelaxOutcome.FINISHED
                 else:
                     outcome = RelaxOutcome.ERRORED
@@ -893,7 +1125,7 @@ class AirssGulpRelaxTask(AirssCastepRelaxTask):
             if fw_spec.get("gzip_folder") is True:
                 tasks.append(GzipDir())
 
-            detours = [Firework(tasks, spec=new_spec, name=self.__class__.name + "Restart")]
+            detours = [self._store_blobs(Firework(tasks, spec=new_spec, name=self.__class__.name + "Restart"))]
 
         return FWAction(stored_data=stored_data, detours=detours)
 
@@ -928,6 +1160,7 @@ class AirssPp3RelaxTask(AirssGulpRelaxTask):
     logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
     code_string = "pp3_relax"  # Identifier for which code is running
     _param_suffix = ".pp"
+    monitor_class = None  # Monitoring is not supported
 
     def _get_cmd(self):
         """Construct the command line arguments"""
@@ -983,6 +1216,7 @@ class DbRecordTask(FiretaskBase):
         """
 
         self._init_parameters(fw_spec)
+        resolve_blobs(self, fw_spec)
         struct_name = fw_spec["struct_name"]
         seed_name = fw_spec.get("seed_name")
         seed_content = fw_spec.get("seed_content")
@@ -1028,6 +1262,142 @@ class DbRecordTask(FiretaskBase):
         return FWAction(update_spec={"task_uuid": task_uuid})
 
 
+@explicit_serialize
+class AirssBatchSearchTask(FiretaskBase):
+    """
+    Task for generating and relaxing multiple structures in sequence within a single Firework
+
+    The tasks for each structure (building, relaxation, transfer, recording...) are run in
+    a separate sub-folder of the launch directory, each with its own copy of the spec, in
+    the same way as they would be run inside an `AirssSearchFW`. The remaining walltime is
+    checked before starting each structure, and if it is insufficient a continuation Firework
+    is added for the remaining structures. The structures left after a task asks for stopping,
+    e.g. if the structure generation fails, are recorded as skipped instead. The Firework fails
+    if none of the structures is successful.
+
+    Required parameters:
+
+    - tasks: The tasks to be run for each structure
+    - nstructures: Number of structures to be generated and relaxed
+
+    Optional parameters:
+
+    - minimum_run_time: Minimum remaining time for starting a new structure, defaults to 600 seconds
+    """
+
+    required_params = ["tasks", "nstructures"]
+    optional_params = ["minimum_run_time"]
+    MINIMUM_RUN_TIME = 600
+    SCHEDULER_TIME_OFFSET = 60
+    # Keys of the spec that should not be passed on to the continuation
+    STRUCTURE_KEYS = ["struct_name", "struct_content", "task_uuid", "seed_hash", "relax_status"]
+    # Key of the spec passing the remaining time to the relaxation of each structure
+    TIMEOUT_KEY = "_batch_timeout"
+    logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
+
+    def run_task(self, fw_spec):
+        """Run the tasks for each structure in turn"""
+        nstructures = self["nstructures"]
+        minimum_run_time = self.get("minimum_run_time", self.MINIMUM_RUN_TIME)
+        start = time.monotonic()
+
+        results = []
+        additions = []
+        ndone = 0
+        stopped = False
+        while ndone < nstructures:
+            if is_draining():
+                self.logger.info(f"The worker is draining - stopping after {ndone} structures")
+                break
+            remaining = self._get_remaining_seconds(fw_spec, start)
+            if remaining - self.SCHEDULER_TIME_OFFSET < minimum_run_time:
+                self.logger.info(f"Only {remaining} seconds left - stopping after {ndone} structures")
+                break
+
+            workdir = Path(f"structure-{ndone:04d}")
+            workdir.mkdir(exist_ok=True)
+            spec = copy.deepcopy(dict(fw_spec))
+            # Private key, so it is not carried on to the detours run by other workers
+            spec[self.TIMEOUT_KEY] = remaining
+            with working_directory(workdir):
+                stored_data, structure_additions, stopped = self._run_structure(spec)
+            results.append(stored_data)
+            additions.extend(structure_additions)
+            ndone += 1
+            if stopped:
+                self.logger.error("Stopping the batch as further structures are unlikely to succeed")
+                stored_data["stopped"] = True
+                break
+
+        nfailed = sum(1 for res in results if "error" in res or res.get("stopped"))
+        if results and nfailed == len(results):
+            raise RuntimeError(f"All {nfailed} structures of the batch failed, the last one with: {results[-1]}")
+
+        stored_data = {"structures": results, "nfinished": ndone, "nremaining": 0, "nskipped": 0}
+        if stopped:
+            # Not continued as they are likely to fail in the same way
+            stored_data["nskipped"] = nstructures - ndone
+        elif ndone < nstructures:
+            stored_data["nremaining"] = nstructures - ndone
+            additions.append(self._get_continuation(fw_spec, nstructures - ndone))
+        return FWAction(stored_data=stored_data, additions=additions or None)
+
+    def get_minimum_run_time(self):
+        """Return the remaining walltime (seconds) needed for starting the first structure"""
+        return self.get("minimum_run_time", self.MINIMUM_RUN_TIME) + self.SCHEDULER_TIME_OFFSET
+
+    def _run_structure(self, spec):
+        """
+        Run the tasks for a single structure
+
+        Returns:
+          A tuple of the stored data, the Fireworks to be added and whether the batch should be stopped.
+        """
+        stored_data = {}
+        additions = []
+        for task in self["tasks"]:
+            # Copy so that the tasks carried on to the continuation are left untouched
+            task = copy.deepcopy(task) if isinstance(task, FiretaskBase) else load_object(task)
+            # Pass on the identity of the Firework as set by the Rocket
+            for attr in ["fw_id", "launchpad"]:
+                if hasattr(self, attr):
+                    setattr(task, attr, getattr(self, attr))
+            try:
+                action = task.run_task(spec)
+            except Exception as error:  # pylint: disable=broad-except
+                self.logger.exception(f"Task {task.fw_name} failed")
+                stored_data["error"] = f"{task.fw_name}: {error}"
+                return stored_data, additions, False
+            if action is None:
+                continue
+            stored_data.update(action.stored_data)
+            spec.update(action.update_spec)
+            additions.extend(action.detours + action.additions)
+            if action.defuse_children or action.exit:
+                return stored_data, additions, action.defuse_children
+        return stored_data, additions, False
+
+    def _get_remaining_seconds(self, fw_spec, start):
+        """Return the remaining walltime, the `timeout` in the spec takes precedence over the scheduler"""
+        if fw_spec.get("timeout") is not None:
+            return fw_spec["timeout"] - (time.monotonic() - start)
+        return Scheduler.get_scheduler().get_remaining_seconds()
+
+    def _get_continuation(self, fw_spec, nstructures):
+        """Construct the Firework for the remaining structures"""
+        new_spec = filter_spec(fw_spec)
+        for key in self.STRUCTURE_KEYS + ["timeout"]:
+            new_spec.pop(key, None)
+        for key in ["_priority", "_walltime_seconds", "_add_launchpad_and_fw_id"]:
+            if key in fw_spec:
+                new_spec[key] = fw_spec[key]
+        task = AirssBatchSearchTask(tasks=self["tasks"], nstructures=nstructures)
+        if "minimum_run_time" in self:
+            task["minimum_run_time"] = self["minimum_run_time"]
+        name = f"BatchSearch-{fw_spec.get('project_name')}/{fw_spec.get('seed_name')}"
+        return Firework([task], spec=new_spec, name=name)
+
+
 @explicit_serialize
 class AirssDataTransferTask(FiretaskBase):
     """
@@ -1039,16 +1409,20 @@ class AirssDataTransferTask(FiretaskBase):
 
     Optional parameters:
 
-    - keep: Transfer all data to a separate directory
+    - keep: Transfer all data as an archive of a separate directory
+    - archive_codec: Codec for the archive - `zstd`, `pigz` or `gzip`. The first available
+      one is used by default. Can also be set in the worker env.
     - additional_types: Additional file types to be transferred
     - additional_files: Additional file names to be transferred
     - base_path: Alternative <BASE_PATH>
+    - datastore: `files` (default) for storing each file in the project folder, or `packed` for
+      appending them to the segments of a `PackedDatastore`. Can also be set in the worker env.
 
     All parameter can be override in `fw_spec`.
     """
 
     # _fw_name = 'DataTransferTask'
-    optional_params = ["keep", "additional_types", "base_path", "additional_files"]
+    optional_params = ["keep", "additional_types", "base_path", "additional_files", "archive_codec", "datastore"]
 
     DEFAULT_TYPES = [".res", "-orig.cell"]
     logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
@@ -1063,28 +1437,38 @@ class AirssDataTransferTask(FiretaskBase):
         struct_name = fw_spec["struct_name"]
         cwd = Path(".")
 
+        packed = self._get_param(fw_spec, "datastore", fw_spec.get("_fw_env", {}).get("datastore", "files")) == "packed"
+        store = PackedDatastore(pfolder) if packed else None
+
+        # Note that glob gives the relative path withrespect to the current folder
+        files = []
         types_to_transfer = self.DEFAULT_TYPES + self._get_param(fw_spec, "additional_types", [])
         for suffix in types_to_transfer:
-            for file in cwd.glob(struct_name + suffix):
-                # Note that glob gives the relative path withrespect to the current folder
-                if file.is_file():
-                    shutil.copy2(file, pfolder / file)
+            files.extend(file for file in cwd.glob(struct_name + suffix) if file.is_file())
+        files.extend(fname for fname in map(Path, self._get_param(fw_spec, "additional_files", [])) if fname.is_file())
 
         self.logger.info("Copying the files to the repository")
-        for fname in map(Path, self._get_param(fw_spec, "additional_files", [])):
-            if fname.is_file():
-                shutil.copy2(fname, pfolder / fname)
+        if packed:
+            store.put(struct_name, {str(file): file for file in files})
+        else:
+            for file in files:
+                shutil.copy2(file, pfolder / file)
 
         if self._get_param(fw_spec, "keep", False):
-            # Just copy all files to the <struct_name>_data directory
+            # Stream all files into a single archive of the <struct_name>_data directory
             self.logger.info("Copying raw run data the repository")
-            destination = pfolder / (struct_name + "_data.tar.gz")
             subfolder = Path(struct_name + "_data")
-            with tarfile.open(str(destination), mode="w:gz") as archive:
-                for file in cwd.glob(struct_name + "*"):
-                    archive.add(file, arcname=str(subfolder / file))
-                for file in cwd.glob("FW*"):
-                    archive.add(file, arcname=str(subfolder / file))
+            files = sorted(set(cwd.glob(struct_name + "*")) | set(cwd.glob("FW*")))
+            codec = self._get_param(fw_spec, "archive_codec", fw_spec.get("_fw_env", {}).get("archive_codec"))
+            members = [(file, subfolder / file) for file in files]
+            if packed:
+                # Staged locally as a record cannot be appended before its size is known
+                archive = write_archive(cwd / f".{subfolder}", members, codec=codec)
+                store.put(struct_name, {archive.name[1:]: archive})
+                archive.unlink()
+            else:
+                archive = write_archive(pfolder / subfolder, members, codec=codec)
+            self.logger.info(f"Archive written: {archive.name}")
 
         # Copy the seed file to the project folder
         if "seed_name" in fw_spec:
@@ -1099,7 +1483,10 @@ class AirssDataTransferTask(FiretaskBase):
                     if not filecmp.cmp(seed_file.resolve(), seed_file_pfolder.resolve()):
                         # Two seeds are not the same - something is wrong!!! Backup the seed as '-seed.cell'
                         self.logger.warning("Found seed in the project folder, but it is NOT THE SAME as used here!")
-                        shutil.copy2(seed_file, pfolder / (struct_name + "-seed.cell"))
+                        if packed:
+                            store.put(struct_name, {struct_name + "-seed.cell": seed_file})
+                        else:
+                            shutil.copy2(seed_file, pfolder / (struct_name + "-seed.cell"))
                 else:
                     shutil.copy(seed_file, seed_file_pfolder)
 
@@ -1111,6 +1498,64 @@ class AirssDataTransferTask(FiretaskBase):
         return self.get(name, default)
 
 
+def terminate_process_group(proc, grace_period=10):
+    """Terminate a process started in a new session together with its children"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=grace_period)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+@contextlib.contextmanager
+def scratch_directory(root, exclude_suffixes=()):
+    """
+    Run in a new directory under `root`, e.g. the node-local scratch
+
+    The files of the current directory are copied in. On exit, the new and modified files are copied
+    back in a single pass, except those ending with `exclude_suffixes`, and the directory is removed.
+    """
+    launch_dir = Path.cwd()
+    Path(root).mkdir(parents=True, exist_ok=True)
+    workdir = Path(tempfile.mkdtemp(prefix="disp-", dir=root))
+    staged = {}
+    for entry in os.scandir(launch_dir):
+        if entry.is_file():
+            shutil.copy2(entry.path, workdir / entry.name)
+            staged[entry.name] = _file_signature(workdir / entry.name)
+    os.chdir(workdir)
+    try:
+        yield workdir
+    finally:
+        os.chdir(launch_dir)
+        for entry in os.scandir(workdir):
+            if not entry.is_file() or entry.name.endswith(tuple(exclude_suffixes)):
+                continue
+            if staged.get(entry.name) != _file_signature(entry.path):
+                shutil.copy2(entry.path, launch_dir / entry.name)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _file_signature(path):
+    """Return the size and modification time of a file for detecting changes"""
+    stat_result = os.stat(path)
+    return stat_result.st_size, stat_result.st_mtime_ns
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """Temporarily change the working directory"""
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+
+
 @contextlib.contextmanager
 def transient_file(fname, mode="w+"):
     """Open a temporary file that will be deleted afterwards"""
@@ -1151,6 +1596,8 @@ def filter_spec(fw_spec):
         "_fworker",
         "_category",
         "_preserve_fworker",
+        "_minimum_run_time",
+        "_ncores",
     ]
     new_dict = {}
     for key, value in fw_spec.items():
@@ -3,24 +3,38 @@ Utility Tasks
 """
 import os
 import shutil
+import subprocess
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from gzip import GzipFile
 from pathlib import Path
 
 from fireworks import FiretaskBase, explicit_serialize
 from fireworks.utilities.fw_utilities import get_fw_logger
 
+from disp.fws.blobs import resolve_blobs
+
+# Files that are not worth compressing again
+COMPRESSED_SUFFIXES = (".gz", ".tgz", ".zst", ".bz2", ".xz", ".zip")
+
+# Codecs for the archives in the order of preference, and the suffixes of the archives written
+ARCHIVE_CODECS = ("zstd", "pigz", "gzip")
+ARCHIVE_SUFFIXES = {"zstd": ".tar.zst", "pigz": ".tar.gz", "gzip": ".tar.gz"}
+
 
 @explicit_serialize
 class GzipDir(FiretaskBase):
     """
     Task to gzip the current working directory.
+
+    The files are compressed in parallel, using `pigz` if it is available.
     """
 
     required_params = []
-    optional_params = []
+    optional_params = ["compresslevel"]
 
     def run_task(self, fw_spec=None):
-        gzip_dir(os.getcwd())
+        gzip_dir(os.getcwd(), compresslevel=self.get("compresslevel", 6))
 
 
 @explicit_serialize
@@ -63,6 +77,7 @@ class USPCopyTask(FiretaskBase):
         """
         Run the task
         """
+        resolve_blobs(self, fw_spec)
         pots = set()
 
         def gather_pots(content, pots):
@@ -112,25 +127,121 @@ class USPCopyTask(FiretaskBase):
             self.logger.info(f"Copied potential file: {potname}")
 
 
-def gzip_dir(path, compresslevel=6):
+def gzip_dir(path, compresslevel=6, threads=None):
     """
     Gzips all files in a directory. Note that this is different from
     shutil.make_archive, which creates a tar archive. The aim of this method
     is to create gzipped files that can still be read using common Unix-style
     commands like zless or zcat.
 
-    No action is performed for folders in the directory.
+    No action is performed for folders and files that are already compressed.
+    The files are compressed in parallel - by `pigz` if it is available, otherwise
+    by a pool of threads as zlib releases the GIL.
 
     Args:
         path (str): Path to directory.
         compresslevel (int): Level of compression, 1-9. 9 is default for
             GzipFile, 6 is default for gzip.
+        threads (int): Number of files or blocks compressed at the same time,
+            defaults to the number of CPUs.
     """
-    for fpath in os.listdir(path):
+    threads = threads or os.cpu_count() or 1
+    files = []
+    for fpath in sorted(os.listdir(path)):
         full_f = os.path.join(path, fpath)
         # Make sure we process only non-zipped files
-        if not fpath.lower().endswith("gz") and os.path.isfile(full_f):
-            with open(full_f, "rb") as f_in, GzipFile(f"{full_f}.gz", "wb", compresslevel=compresslevel) as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            shutil.copystat(full_f, f"{full_f}.gz")
-            os.remove(full_f)
+        if not fpath.lower().endswith(COMPRESSED_SUFFIXES) and os.path.isfile(full_f):
+            files.append(full_f)
+    if not files:
+        return
+
+    if shutil.which("pigz"):
+        # pigz replaces the files and keeps their modification times, -f for overwriting any .gz
+        # left by an interrupted run and for compressing symbolic links like the threads below
+        subprocess.run(["pigz", "-f", f"-{compresslevel}", "-p", str(threads), "--"] + files, check=True)
+        return
+    with ThreadPoolExecutor(max_workers=min(threads, len(files))) as pool:
+        # Consume the results so that any exception is raised here
+        list(pool.map(lambda full_f: _gzip_file(full_f, compresslevel), files))
+
+
+def _gzip_file(full_f, compresslevel):
+    """Gzip a single file, replacing the original"""
+    with open(full_f, "rb") as f_in, GzipFile(f"{full_f}.gz", "wb", compresslevel=compresslevel) as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    shutil.copystat(full_f, f"{full_f}.gz")
+    os.remove(full_f)
+
+
+def get_archive_codec(codec=None):
+    """
+    Select the codec used for the archives
+
+    Args:
+        codec (str): The requested codec, the first one available in `ARCHIVE_CODECS` is used if not given.
+
+    Returns:
+        The name of the codec, falling back to the built-in single-threaded gzip if the requested
+        program is not available.
+    """
+    if codec is not None and codec not in ARCHIVE_CODECS:
+        raise ValueError(f"Unknown archive codec: {codec}, must be one of {ARCHIVE_CODECS}")
+    for name in ARCHIVE_CODECS if codec is None else (codec,):
+        if name == "gzip" or shutil.which(name):
+            return name
+    return "gzip"
+
+
+def write_archive(destination, members, codec=None, compresslevel=3, threads=0):
+    """
+    Write a compressed tar archive in a single streaming pass
+
+    The tar stream is piped through a multi-threaded compressor (`zstd -T` or `pigz -p`) straight into
+    the destination, so no uncompressed copy is made. The archive is written under a temporary name
+    and renamed when complete, hence a partial archive is never left in the repository.
+
+    Args:
+        destination: Path of the archive without the suffix, e.g. `<project>/<struct_name>_data`
+        members: Iterable of (path, arcname) tuples of the files to be included
+        codec (str): Codec to be used, see `get_archive_codec`
+        compresslevel (int): Level of compression
+        threads (int): Number of threads used by the compressor, 0 for the number of CPUs
+
+    Returns:
+        The path of the archive written, with the suffix of the codec used
+    """
+    codec = get_archive_codec(codec)
+    destination = Path(str(destination) + ARCHIVE_SUFFIXES[codec])
+    partial = destination.with_name(destination.name + ".part")
+    threads = threads or os.cpu_count() or 1
+
+    try:
+        with open(partial, "wb") as fout:
+            if codec == "gzip":
+                with GzipFile(fileobj=fout, mode="wb", compresslevel=compresslevel) as stream:
+                    _write_tar_stream(stream, members)
+            else:
+                if codec == "zstd":
+                    cmd = ["zstd", "-q", f"-{compresslevel}", f"-T{threads}", "-c"]
+                else:
+                    cmd = ["pigz", f"-{compresslevel}", "-p", str(threads), "-c"]
+                with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fout) as proc:
+                    try:
+                        _write_tar_stream(proc.stdin, members)
+                    finally:
+                        proc.stdin.close()
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, cmd)
+    except BaseException:
+        # Including the interruptions, e.g. by the drain signals
+        partial.unlink(missing_ok=True)
+        raise
+    os.replace(partial, destination)
+    return destination
+
+
+def _write_tar_stream(fileobj, members):
+    """Write the members as an uncompressed tar stream to a file object"""
+    with tarfile.open(fileobj=fileobj, mode="w|") as archive:
+        for path, arcname in members:
+            archive.add(str(path), arcname=str(arcname))
@@ -2,9 +2,13 @@
 Class for specialised worker for selecting jobs with walltime attached
 Select jobs without walltime tags or those with tags and less than the limit.
 """
+import json
+import time
 
 import six
 from fireworks.core.fworker import FWorker
+from fireworks.utilities.fw_serializers import recursive_deserialize
+from fireworks.utilities.fw_utilities import get_fw_logger
 
 from disp.scheduler import Scheduler
 
@@ -15,6 +19,8 @@ class WalltimeAwareFWorker(FWorker):
     """
 
     SECONDS_SAFE_INTERVAL = 60
+    CAMPAIGN_REFILL_INTERVAL = 60  # Minimum interval in seconds between checking the campaigns
+    logger = get_fw_logger(__name__, l_dir=None, stream_level="INFO")
 
     def __init__(self, *args, **kwargs):
         """
@@ -25,10 +31,52 @@ class WalltimeAwareFWorker(FWorker):
         """
         super().__init__(*args, **kwargs)
         self.scheduler = Scheduler.get_scheduler()
+        # LaunchPad used for materialising the Fireworks of search campaigns, if set
+        self.launchpad = None
+        self._last_refill = None
+        self._runtime_factor = None
+
+    @classmethod
+    @recursive_deserialize
+    def from_dict(cls, m_dict):
+        # FWorker.from_dict always constructs the base class
+        return cls(m_dict["name"], m_dict["category"], json.loads(m_dict["query"]), m_dict.get("env"))
+
+    def refill_campaigns(self):
+        """
+        Materialise Fireworks for the search campaigns that are running low
+
+        Only done if a LaunchPad is attached to the worker, and at most once every
+        `CAMPAIGN_REFILL_INTERVAL` seconds. Can be disabled with `campaigns: false` under
+        the `env` of the worker file.
+        """
+        if self.launchpad is None or not self.env.get("campaigns", True):
+            return 0
+        now = time.monotonic()
+        if self._last_refill is not None and now - self._last_refill < self.CAMPAIGN_REFILL_INTERVAL:
+            return 0
+        self._last_refill = now
+
+        from disp.fws.campaign import CampaignManager  # pylint: disable=import-outside-toplevel
+
+        try:
+            nadded = CampaignManager(self.launchpad).refill(self.category)
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.warning(f"Failed to refill the search campaigns: {error}")
+            return 0
+        if nadded:
+            self.logger.info(f"Materialised {nadded} structures from search campaigns")
+        return nadded
 
     @property
     def query(self):
+        # Make sure the campaigns have READY Fireworks before they are queried
+        self.refill_campaigns()
+        return {"$and": [self.base_query, self.get_walltime_condition()]}
 
+    @property
+    def base_query(self):
+        """The query of the worker without the walltime conditions"""
         query = dict(self._query)
         fworker_check = [{"spec._fworker": {"$exists": False}}, {"spec._fworker": None}, {"spec._fworker": self.name}]
         if "$or" in query:
@@ -43,17 +91,64 @@ class WalltimeAwareFWorker(FWorker):
                 query["spec._category"] = self.category
         elif self.category:  # category is list of str
             query["spec._category"] = {"$in": self.category}
+        return query
+
+    def get_walltime_condition(self, seconds_left=None):
+        """
+        Return the query selecting the Fireworks that fit into the remaining walltime
 
-        # Either not having a walltime limit of have a one that is less than the
-        # current limit
-        walltime_condition = {
-            "$or": [
-                {"spec._walltime_seconds": {"$exists": 0}},
-                {"spec._walltime_seconds": {"$lt": self.seconds_left - self.SECONDS_SAFE_INTERVAL}},
+        A Firework fits if its walltime limit (`_walltime_seconds`) is less than the time
+        left and the minimum time it needs to do anything useful (`_minimum_run_time`) is
+        available. Fireworks without these fields are always selected. Both times are for an
+        average worker, hence they are scaled by the relative speed of this one.
+        """
+        if seconds_left is None:
+            seconds_left = self.seconds_left
+        seconds_usable = seconds_left - self.SECONDS_SAFE_INTERVAL
+        # Time left as seen by an average worker
+        seconds_scaled = seconds_usable / self.runtime_factor
+        return {
+            "$and": [
+                {"$or": [{"spec._walltime_seconds": {"$exists": 0}}, {"spec._walltime_seconds": {"$lt": seconds_scaled}}]},
+                {"$or": [{"spec._minimum_run_time": {"$exists": 0}}, {"spec._minimum_run_time": {"$lte": seconds_scaled}}]},
             ]
         }
 
-        return {"$and": [query, walltime_condition]}
+    @property
+    def runtime_factor(self):
+        """
+        Relative speed of this worker, larger is slower
+
+        Taken from `runtime_factor` under the `env` of the worker file, otherwise from the
+        run time model stored in the database (see `disp.fws.runtime`). Defaults to 1.
+        """
+        if self._runtime_factor is None:
+            factor = self.env.get("runtime_factor")
+            if factor is None and self.launchpad is not None:
+                from disp.fws.runtime import RuntimeModel  # pylint: disable=import-outside-toplevel
+
+                try:
+                    model = RuntimeModel.load(self.launchpad)
+                except Exception as error:  # pylint: disable=broad-except
+                    self.logger.warning(f"Failed to load the run time model: {error}")
+                    model = None
+                if model is not None:
+                    factor = model.worker_factors.get(self.name)
+            self._runtime_factor = float(factor) if factor else 1.0
+        return self._runtime_factor
+
+    def is_out_of_time(self, launchpad):
+        """
+        Check if all of the READY Fireworks that this worker could run need more time than is left
+
+        Since the remaining time only decreases, the worker should stop rather than waiting
+        for these Fireworks to become runnable.
+        """
+        ready = {"$and": [self.base_query, {"state": "READY"}]}
+        if launchpad.fireworks.count_documents(ready, limit=1) == 0:
+            return False
+        ready["$and"].append(self.get_walltime_condition())
+        return launchpad.fireworks.count_documents(ready, limit=1) == 0
 
     @property
     def seconds_left(self):
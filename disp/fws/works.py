@@ -1,11 +1,13 @@
 """
 Module with definition of Fireworks
 """
+import re
 from multiprocessing.sharedctypes import Value
 
 from fireworks.core.firework import Firework
 
 from .tasks import (
+    AirssBatchSearchTask,
     AirssBuildcellTask,
     AirssCastepRelaxTask,
     AirssDataTransferTask,
@@ -19,6 +21,31 @@ from .utility_tasks import CleanDir, GzipDir, USPCopyTask
 
 # pylint: disable=too-many-arguments, return-in-init,too-many-locals
 
+NCORES_REGEX = re.compile(r"(?:^|\s)(?:--ntasks|--np|-np|-n)[\s=]*(\d+)(?:\s|$)")
+MPI_LAUNCHER_REGEX = re.compile(r"(?:^|[\s/])(?:mpirun|mpiexec|srun|aprun|ibrun)(?:\s|$)")
+
+
+def get_ncores(executable):
+    """
+    Return the number of cores used by an executable, as given to mpirun/srun
+
+    Returns:
+      The number of cores, 1 for an executable run without an MPI launcher, or None if the
+      launcher does not give the count, e.g. it takes the whole allocation.
+    """
+    executable = executable or ""
+    match = NCORES_REGEX.search(executable)
+    if match:
+        return int(match.group(1))
+    return None if MPI_LAUNCHER_REGEX.search(executable) else 1
+
+
+def set_ncores(spec, executable):
+    """Record the cores to be reserved by the packing launcher, unless they are unknown"""
+    ncores = get_ncores(executable)
+    if ncores is not None:
+        spec.setdefault("_ncores", ncores)
+
 
 class AirssSearchFW(Firework):
     """
@@ -52,60 +79,182 @@ class AirssSearchFW(Firework):
         Initialise a AirssSearchFW instance
         """
 
-        tasks = []
         if spec is None:
             spec = {}
 
-        _default = {
-            "gzip_folder": gzip_folder,
-            "record_db": record_db,
-            "seed_name": seed_name,
-            "project_name": project_name,
-            "_walltime_seconds": walltime_seconds,
-        }
-        spec.update(_default)
-
-        build = AirssBuildcellTask(
-            seed_name=seed_name,
-            seed_content=seed_content,
-            store_content=False,
-            keep_seed=True,
-            deposit_init_structure=True,
-            project_name=project_name,
+        tasks = get_search_tasks(
+            project_name,
+            seed_name,
+            seed_content,
+            param_content,
+            executable,
+            spec,
+            castep_code=castep_code,
+            cycles=cycles,
+            record_db=record_db,
+            keep=keep,
+            gzip_folder=gzip_folder,
+            modcell_content=modcell_content,
+            modcell_name=modcell_name,
+            code=code,
+            walltime_seconds=walltime_seconds,
+            cluster=cluster,
         )
-        tasks.append(build)
-        if modcell_name is not None:
-            mod = AirssModcellTask(func=modcell_name, func_content=modcell_content)
-            tasks.append(mod)
 
-        if code == "castep":
-            relax = AirssCastepRelaxTask(
-                param_content=param_content, executable=executable, cluster=cluster, castep_code=castep_code, cycles=cycles
-            )
-        elif code == "gulp":
-            relax = AirssGulpRelaxTask(param_content=param_content, cluster=cluster, executable=executable, cycles=cycles)
-        elif code == "pp3":
-            relax = AirssPp3RelaxTask(param_content=param_content, cluster=cluster, executable=executable, cycles=cycles)
-        else:
-            raise ValueError(f"Unknown code: {code}")
+        if name is None:
+            name = f"BuildRelax-{project_name}/{seed_name}"
 
-        tasks.append(relax)
+        return super().__init__(tasks=tasks, spec=spec, name=name, **kwargs)
 
-        transfer = AirssDataTransferTask(keep=keep)
-        tasks.append(transfer)
 
-        if name is None:
-            name = f"BuildRelax-{project_name}/{seed_name}"
+class AirssBatchSearchFW(Firework):
+    """
+    Perform multiple AIRSS searches in sequence in a single Firework
 
-        if record_db or spec.get("record_db"):
-            spec["record_db"] = True
-            spec["_add_launchpad_and_fw_id"] = True  # Allow the Firework to access the fw_id
-            tasks.append(DbRecordTask())
-        if gzip_folder or spec.get("gzip_folder"):
-            spec["gzip_folder"] = True
-            tasks.append(GzipDir())
+    The same tasks as `AirssSearchFW` are run for each structure in a sub-folder,
+    until `nstructures` are done or the walltime runs out. This reduces the number of
+    Fireworks and Workflows in the LaunchPad for large searches.
+    """
 
-        return super().__init__(tasks=tasks, spec=spec, name=name, **kwargs)
+    def __init__(
+        self,
+        project_name,
+        seed_name,
+        seed_content,
+        param_content,
+        executable,
+        nstructures,
+        castep_code="default",
+        cycles=200,
+        record_db=False,
+        keep=True,
+        gzip_folder=True,
+        spec=None,
+        name=None,
+        modcell_content=None,
+        modcell_name=None,
+        code="castep",
+        walltime_seconds=600,
+        cluster=False,
+        minimum_run_time=None,
+        **kwargs,
+    ):
+        """
+        Initialise a AirssBatchSearchFW instance
+
+        Args:
+          nstructures: Number of structures to be generated and relaxed
+          minimum_run_time: Minimum remaining time (seconds) for starting a new structure
+
+        The other arguments are the same as `AirssSearchFW`.
+        """
+        if spec is None:
+            spec = {}
+
+        tasks = get_search_tasks(
+            project_name,
+            seed_name,
+            seed_content,
+            param_content,
+            executable,
+            spec,
+            castep_code=castep_code,
+            cycles=cycles,
+            record_db=record_db,
+            keep=keep,
+            gzip_folder=gzip_folder,
+            modcell_content=modcell_content,
+            modcell_name=modcell_name,
+            code=code,
+            walltime_seconds=walltime_seconds,
+            cluster=cluster,
+        )
+        batch = AirssBatchSearchTask(tasks=tasks, nstructures=nstructures)
+        if minimum_run_time is not None:
+            batch["minimum_run_time"] = minimum_run_time
+        spec["_minimum_run_time"] = max(spec["_minimum_run_time"], batch.get_minimum_run_time())
+
+        if name is None:
+            name = f"BatchSearch-{project_name}/{seed_name}"
+
+        return super().__init__(tasks=[batch], spec=spec, name=name, **kwargs)
+
+
+def get_search_tasks(
+    project_name,
+    seed_name,
+    seed_content,
+    param_content,
+    executable,
+    spec,
+    castep_code="default",
+    cycles=200,
+    record_db=False,
+    keep=True,
+    gzip_folder=True,
+    modcell_content=None,
+    modcell_name=None,
+    code="castep",
+    walltime_seconds=600,
+    cluster=False,
+):
+    """
+    Construct the tasks for searching a single structure, the spec is updated in-place
+
+    Returns:
+      A list of the tasks
+    """
+    tasks = []
+    _default = {
+        "gzip_folder": gzip_folder,
+        "record_db": record_db,
+        "seed_name": seed_name,
+        "project_name": project_name,
+        "_walltime_seconds": walltime_seconds,
+    }
+    spec.update(_default)
+
+    build = AirssBuildcellTask(
+        seed_name=seed_name,
+        seed_content=seed_content,
+        store_content=False,
+        keep_seed=True,
+        deposit_init_structure=True,
+        project_name=project_name,
+    )
+    tasks.append(build)
+    if modcell_name is not None:
+        mod = AirssModcellTask(func=modcell_name, func_content=modcell_content)
+        tasks.append(mod)
+
+    if code == "castep":
+        relax = AirssCastepRelaxTask(
+            param_content=param_content, executable=executable, cluster=cluster, castep_code=castep_code, cycles=cycles
+        )
+    elif code == "gulp":
+        relax = AirssGulpRelaxTask(param_content=param_content, cluster=cluster, executable=executable, cycles=cycles)
+    elif code == "pp3":
+        relax = AirssPp3RelaxTask(param_content=param_content, cluster=cluster, executable=executable, cycles=cycles)
+    else:
+        raise ValueError(f"Unknown code: {code}")
+
+    tasks.append(relax)
+    # Workers with less time left will not pick up the Firework
+    spec["_minimum_run_time"] = relax.get_minimum_run_time()
+    # Cores to be reserved by the packing launcher
+    set_ncores(spec, executable)
+
+    transfer = AirssDataTransferTask(keep=keep)
+    tasks.append(transfer)
+
+    if record_db or spec.get("record_db"):
+        spec["record_db"] = True
+        spec["_add_launchpad_and_fw_id"] = True  # Allow the Firework to access the fw_id
+        tasks.append(DbRecordTask())
+    if gzip_folder or spec.get("gzip_folder"):
+        spec["gzip_folder"] = True
+        tasks.append(GzipDir())
+    return tasks
 
 
 class RelaxFW(Firework):
@@ -169,6 +318,8 @@ class RelaxFW(Firework):
         else:
             raise ValueError(f"Unknown code: {code}")
 
+        spec["_minimum_run_time"] = relax.get_minimum_run_time()
+        set_ncores(spec, executable)
         transfer = AirssDataTransferTask(keep=keep)
 
         if name is None:
@@ -235,6 +386,8 @@ class SinglePointFW(Firework):
                 param_content=param_content, executable=executable, castep_code=castep_code, cluster=cluster
             )
             tasks.append(singlepoint)
+            spec["_minimum_run_time"] = singlepoint.get_minimum_run_time()
+            set_ncores(spec, executable)
         else:
             raise ValueError(f"Unsupported code: {code}")
 
@@ -56,17 +56,19 @@ def guarded_gulp(exe="gulp"):
     will be terminated if the energy or Gnorm becomes *****
     """
 
+    from disp.monitor import GnormDivergence, GulpRelaxMonitor  # pylint: disable=import-outside-toplevel
+
     proc = subprocess.Popen([exe], stdin=sys.stdin, stdout=subprocess.PIPE, universal_newlines=True)
 
+    # The monitor only processes each new line once
+    monitor = GulpRelaxMonitor(rules=[GnormDivergence()])
     run_ok = True
-    data_lines = []
     while proc.poll() is None:
         new_line = proc.stdout.readline()
         print(new_line, end="")
-        data_lines.append(new_line)
         # Check if we are OK so far
-        run_ok = check_gulp(data_lines)
-        if run_ok is False:
+        if run_ok and not monitor.feed([new_line]):
+            run_ok = False
             proc.terminate()
     # Print the rest of the stdout
     print(proc.stdout.read(), end="")
@@ -0,0 +1,316 @@
+"""
+Monitoring the progress of relaxations while they run
+
+The monitors consume the output incrementally as it is written and keep running
+statistics of the relaxation: the energy of each ionic step, the force/gradient norms,
+the number of SCF cycles and the time taken for each ionic step. A set of abort rules
+is evaluated after each ionic step, so that hopeless relaxations can be terminated early.
+
+An abort rule is a callable taking the monitor as the only argument, and returns a string
+describing the reason for aborting, or None if the relaxation may continue.
+"""
+import os
+import re
+
+from disp.casteptools import CastepOutputParser, pattern_geom
+from disp.gulptools import GEOM_LINE_PATTERN
+
+__all__ = (
+    "RelaxMonitor",
+    "CastepRelaxMonitor",
+    "GulpRelaxMonitor",
+    "GnormDivergence",
+    "MaxScfPerStep",
+    "EnergyRise",
+    "MaxStepTime",
+    "EnthalpyCutoff",
+    "project_final_energy",
+    "ABORT_RULES",
+    "build_rules",
+)
+
+
+class RelaxMonitor:
+    """
+    Base class for incremental monitoring of relaxations
+
+    Subclasses implement `parse_line` for a specific output format and call `add_step`
+    for each completed ionic step.
+    """
+
+    def __init__(self, rules=None):
+        """
+        Instantiate a monitor
+
+        Args:
+          rules (list): A list of abort rules or their specifications, see `build_rules`.
+        """
+        self.rules = build_rules(rules)
+        self.energies = []
+        self.gnorms = []
+        self.scf_counts = []
+        self.step_times = []
+        self.natoms = None
+        self.abort_reason = None
+        self.abort_rule = None
+        self.offset = 0
+        self._nscf = 0
+        self._last_timer = 0.0
+        self._timer = 0.0
+
+    @property
+    def nsteps(self):
+        """Number of ionic steps completed"""
+        return len(self.energies)
+
+    def parse_line(self, line):
+        """Parse a single line of output"""
+        raise NotImplementedError
+
+    def feed(self, lines):
+        """
+        Consume lines of the output
+
+        Returns:
+          True if the relaxation may continue, False if it should be aborted.
+        """
+        for line in lines:
+            if self.abort_reason is not None:
+                break
+            self.parse_line(line)
+        return self.abort_reason is None
+
+    def follow(self, fname):
+        """
+        Consume the complete lines appended to a file since the last call
+
+        Returns:
+          True if the relaxation may continue, False if it should be aborted.
+        """
+        if not os.path.isfile(fname):
+            return self.abort_reason is None
+        with open(fname, "rb") as fhandle:
+            fhandle.seek(self.offset)
+            lines = []
+            for raw in fhandle:
+                if not raw.endswith(b"\n"):
+                    break
+                self.offset += len(raw)
+                lines.append(raw.decode(errors="replace"))
+        return self.feed(lines)
+
+    def add_step(self, energy, gnorm=None):
+        """Record a completed ionic step and evaluate the abort rules"""
+        self.energies.append(energy)
+        self.gnorms.append(gnorm)
+        self.scf_counts.append(self._nscf)
+        self.step_times.append(self._timer - self._last_timer)
+        self._nscf = 0
+        self._last_timer = self._timer
+        self.evaluate()
+
+    def abort(self, reason, rule=None):
+        """Mark the relaxation to be aborted"""
+        if self.abort_reason is None:
+            self.abort_reason = reason
+            self.abort_rule = rule
+
+    def evaluate(self):
+        """Evaluate the abort rules"""
+        for rule in self.rules:
+            reason = rule(self)
+            if reason:
+                self.abort(reason, rule)
+                return
+
+
+class CastepRelaxMonitor(RelaxMonitor):
+    """
+    Monitor for CASTEP geometry optimisations, consumes the .castep file
+
+    The maximum force `|F|max` is used as the gradient norm.
+    """
+
+    SCF_LINE = CastepOutputParser.SCF_LINE
+    GEOM_LINE = re.compile(pattern_geom, re.VERBOSE)
+    FMAX_LINE = re.compile(r"^\s*\|\s+\|F\|max\s+\|\s+([-+.E0-9]+)")
+    NIONS_LINE = re.compile(r"Total number of ions in cell =\s+([0-9]+)")
+
+    def parse_line(self, line):
+        if self.natoms is None and "Total number of ions" in line:
+            match = self.NIONS_LINE.search(line)
+            if match:
+                self.natoms = int(match.group(1))
+        elif "<-- SCF" in line:
+            match = self.SCF_LINE.match(line)
+            if match:
+                self._nscf += 1
+                self._timer = float(match.group(5))
+        elif ": finished iteration" in line:
+            match = self.GEOM_LINE.match(line)
+            if match:
+                self.add_step(float(match.group("H")))
+        elif "|F|max" in line and self.gnorms:
+            # The convergence table is printed after the enthalpy of the iteration
+            match = self.FMAX_LINE.match(line)
+            if match:
+                self.gnorms[-1] = float(match.group(1))
+                self.evaluate()
+
+
+class GulpRelaxMonitor(RelaxMonitor):
+    """
+    Monitor for GULP optimisations, consumes the GULP output
+
+    The relaxation is always aborted if the energy or gnorm overflows (shown as ****).
+    """
+
+    def parse_line(self, line):
+        match = GEOM_LINE_PATTERN.match(line)
+        if not match:
+            return
+        _, energy, gnorm, cpu = (match.group(i).strip() for i in range(1, 5))
+        if "*" in energy or "*" in gnorm:
+            self.abort("Energy or gnorm overflowed")
+            return
+        self._timer = float(cpu)
+        self.add_step(float(energy), float(gnorm))
+
+
+class GnormDivergence:
+    """Abort if the gradient norm is large and increasing"""
+
+    def __init__(self, min_steps=5, threshold=10.0, lag=3):
+        self.min_steps = min_steps
+        self.threshold = threshold
+        self.lag = lag
+
+    def __call__(self, monitor):
+        gnorms = [gnorm for gnorm in monitor.gnorms if gnorm is not None]
+        if len(gnorms) > self.min_steps and gnorms[-1] > self.threshold and gnorms[-1] > gnorms[-1 - self.lag]:
+            return f"Gnorm diverging: {gnorms[-1]} (was {gnorms[-1 - self.lag]} {self.lag} steps ago)"
+        return None
+
+
+class MaxScfPerStep:
+    """Abort if the SCF takes too many cycles for several consecutive ionic steps"""
+
+    def __init__(self, max_scf=100, patience=3):
+        self.max_scf = max_scf
+        self.patience = patience
+
+    def __call__(self, monitor):
+        counts = monitor.scf_counts[-self.patience :]
+        if len(counts) == self.patience and min(counts) >= self.max_scf:
+            return f"SCF took at least {self.max_scf} cycles for {self.patience} consecutive steps"
+        return None
+
+
+class EnergyRise:
+    """Abort if the energy has risen over a window of ionic steps"""
+
+    def __init__(self, window=10, tolerance=0.0):
+        self.window = window
+        self.tolerance = tolerance
+
+    def __call__(self, monitor):
+        energies = monitor.energies
+        if len(energies) > self.window and energies[-1] - energies[-1 - self.window] > self.tolerance:
+            return f"Energy rose by {energies[-1] - energies[-1 - self.window]} in the last {self.window} steps"
+        return None
+
+
+class MaxStepTime:
+    """Abort if an ionic step takes too long"""
+
+    def __init__(self, max_seconds):
+        self.max_seconds = max_seconds
+
+    def __call__(self, monitor):
+        if monitor.step_times and monitor.step_times[-1] > self.max_seconds:
+            return f"Ionic step took {monitor.step_times[-1]} seconds"
+        return None
+
+
+class EnthalpyCutoff:
+    """
+    Abort if the projected final enthalpy per atom is too far above a reference value
+
+    The reference is typically taken from the low energy structures found so far in the
+    same project, so that relaxations that are not going to be useful are stopped early.
+    """
+
+    # Relaxations stopped by this rule are recorded with a dedicated status
+    relax_status = "UNPROMISING"
+
+    def __init__(self, reference, window=0.5, min_steps=10):
+        """
+        Args:
+          reference (float): Reference enthalpy per atom
+          window (float): Relaxations projected to end above `reference + window` are aborted
+          min_steps (int): Minimum number of ionic steps before the rule applies
+        """
+        self.reference = reference
+        self.window = window
+        self.min_steps = min_steps
+
+    def __call__(self, monitor):
+        if not monitor.natoms or monitor.nsteps < self.min_steps:
+            return None
+        projected = project_final_energy(monitor.energies) / monitor.natoms
+        if projected > self.reference + self.window:
+            return f"Projected enthalpy {projected:.4f} eV/atom is more than {self.window} eV/atom above the reference {self.reference:.4f}"
+        return None
+
+
+def project_final_energy(energies, max_ratio=0.9):
+    """
+    Project the final energy of a relaxation from its trajectory
+
+    The decrease of the energy is assumed to slow down geometrically, with the ratio
+    estimated from the last three steps and capped at `max_ratio` so that the projection is
+    conservative. The lowest energy seen so far is used if the energy is not decreasing.
+    """
+    if len(energies) < 2:
+        return energies[-1]
+    last_drop = energies[-2] - energies[-1]
+    if last_drop <= 0:
+        return min(energies)
+    ratio = max_ratio
+    if len(energies) > 2 and energies[-3] - energies[-2] > 0:
+        ratio = min(last_drop / (energies[-3] - energies[-2]), max_ratio)
+    return energies[-1] - last_drop * ratio / (1 - ratio)
+
+
+ABORT_RULES = {
+    "gnorm_divergence": GnormDivergence,
+    "max_scf_per_step": MaxScfPerStep,
+    "energy_rise": EnergyRise,
+    "max_step_time": MaxStepTime,
+    "enthalpy_cutoff": EnthalpyCutoff,
+}
+
+
+def build_rules(specs):
+    """
+    Construct abort rules from their specifications
+
+    Args:
+      specs (list): Each item is either a callable, or a dictionary with the name of the
+        rule under the `rule` key and the keyword arguments for constructing it, e.g.
+        `{"rule": "gnorm_divergence", "threshold": 20}`.
+
+    Returns:
+      A list of callable abort rules
+    """
+    rules = []
+    for spec in specs or []:
+        if callable(spec):
+            rules.append(spec)
+            continue
+        kwargs = dict(spec)
+        name = kwargs.pop("rule")
+        if name not in ABORT_RULES:
+            raise ValueError(f"Unknown abort rule: {name}, available rules: {list(ABORT_RULES)}")
+        rules.append(ABORT_RULES[name](**kwargs))
+    return rules
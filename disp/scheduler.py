@@ -1,25 +1,48 @@
 """
 Module based on getting information from scontrol
+
+The queries of the queue go through `CachedQuery`, which runs each `squeue`/`qstat`/`bjobs`
+command at most once per polling interval and parses the output in memory. The per-job and
+per-state methods filter the same listing of the queue instead of querying it again.
+
+For testing without a cluster, the `Simulated` scheduler takes the walltime of the job from a
+file or the environment, and the SLURM commands can be run against a `SimulatedSlurmQueue`
+stored in a file instead of the real `scontrol`, `squeue` and `sbatch`.
 """
+import json
 import logging
 import os
 import re
 import subprocess
-import tempfile
+import time
 from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Environmental variable for passing the end time of the job to the child processes
+END_TIME_ENV_VAR = "DISP_JOB_END_TIME"
+# Environmental variable for the settings of the simulated job (path to a JSON file)
+SIM_ENV_VAR = "DISP_SIM_SCHEDULER"
+# Environmental variable for the file of the simulated SLURM queue
+SIM_QUEUE_ENV_VAR = "DISP_SIM_SLURM_QUEUE"
+SLURM_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+PBS_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+# States of the finished (sub)jobs
+PBS_FINISHED_STATES = ("X", "F")
+
 
 class Scheduler:
     """Scheduler object"""
 
+    _instance = None  # Process-level instance returned by `get_scheduler`
+
     def __init__(self, *args, **kwargs):
         """Scheduler object for accessing information from the scheduler"""
         del args
         del kwargs
         self._job_id = None
         self._ncpus = None
+        self._end_monotonic = None
 
     def get_n_cpus(self):
         """Return the number of CPUS in this job"""
@@ -30,10 +53,33 @@ class Scheduler:
         """Return the name of the current user"""
         return os.environ["USER"]
 
-    def get_remaining_seconds(self):
-        """Get the reminaing time before this job gets killed"""
+    def get_end_time(self):
+        """Return the time when the job is expected to finish"""
         raise NotImplementedError
 
+    def get_remaining_seconds(self):
+        """
+        Get the reminaing time before this job gets killed
+
+        The end time is obtained from the scheduler only once per job - it is exported
+        to the child processes using the DISP_JOB_END_TIME environmental variable. The
+        remaining time is computed using the monotonic clock.
+        """
+        if self._end_monotonic is None:
+            end_timestamp = self._get_exported_end_timestamp()
+            if end_timestamp is None:
+                end_timestamp = self.get_end_time().timestamp()
+                os.environ[END_TIME_ENV_VAR] = f"{self.job_id}:{end_timestamp}"
+            self._end_monotonic = time.monotonic() + end_timestamp - time.time()
+        return int(self._end_monotonic - time.monotonic())
+
+    def _get_exported_end_timestamp(self):
+        """Return the end time exported by the parent process, if it is for the same job"""
+        job_id, _, end_timestamp = os.environ.get(END_TIME_ENV_VAR, "").rpartition(":")
+        if job_id and job_id == str(self.job_id):
+            return float(end_timestamp)
+        return None
+
     @property
     def is_in_job(self):
         """Return wether I am in a remote job"""
@@ -45,26 +91,93 @@ class Scheduler:
     def job_id(self):
         raise NotImplementedError
 
+    def get_queue(self, user_name=None):
+        """
+        Return the jobs of a user in the queue
+
+        Returns:
+          A list of dictionaries with the job id, array id, task id, name, state ("R" for running,
+          "PD" for pending, other states as reported by SLURM), reason for pending and whether the
+          job is held.
+        """
+        raise NotImplementedError
+
+    def get_array_tasks(self, user_name=None, job_name=None):
+        """
+        Return the tasks of the array jobs in the queue, as returned by `get_queue`
+
+        Args:
+          user_name: Name of the user, defaults to the current user
+          job_name: Only include the jobs with this name
+        """
+        return [task for task in self.get_queue(user_name) if task["array_id"] and (not job_name or task["name"] == job_name)]
+
+    def hold_arrays(self, array_ids):
+        """Hold the given arrays"""
+        raise NotImplementedError
+
+    def release_arrays(self, array_ids):
+        """Release the given arrays"""
+        raise NotImplementedError
+
+    def hold_tasks(self, tasks):
+        """Hold individual tasks of the arrays, as returned by `get_array_tasks`"""
+        raise NotImplementedError
+
+    def release_tasks(self, tasks):
+        """Release individual tasks of the arrays, as returned by `get_array_tasks`"""
+        raise NotImplementedError
+
+    def submit_array(self, script, ntasks, job_name=None):
+        """
+        Submit a job script as an array
+
+        Returns:
+          The ID of the submitted array
+        """
+        raise NotImplementedError
+
     @classmethod
-    def get_scheduler(cls):
+    def get_scheduler(cls, refresh=False):
         """
         Return a valid scheduler instance for the current environment.
+
+        The instance is shared within the process, so the scheduler is only queried once.
+
+        Args:
+          refresh: Query the scheduler again, for example, after the time limit is changed
         """
-        for trial in [Slurm, SGE, Dummy]:
+        if refresh:
+            os.environ.pop(END_TIME_ENV_VAR, None)
+        elif Scheduler._instance is not None and Scheduler._instance.job_id == Scheduler._get_current_job_id():
+            return Scheduler._instance
+        Scheduler._instance = None
+        for trial in [Simulated, Slurm, PBS, LSF, SGE, Dummy]:
             obj = trial()
             if obj.is_in_job:
+                Scheduler._instance = obj
                 return obj
         return None
 
+    @staticmethod
+    def _get_current_job_id():
+        """Return the ID of the job this process runs in according to the environment"""
+        for trial in [Simulated, Slurm, PBS, LSF, SGE]:
+            job_id = trial.get_env_job_id()
+            if job_id:
+                return job_id
+        return Dummy.JOB_ID
+
 
 class Dummy(Scheduler):
     """Dummy scheduler for running locally"""
 
     DEFAULT_REMAINING_TIME = 3600 * 24 * 30
+    JOB_ID = "0"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._job_id = "0"
+        self._job_id = self.JOB_ID
 
     def get_n_cpus(self):
         return 4
@@ -82,12 +195,80 @@ class Dummy(Scheduler):
         return True
 
 
+class Simulated(Scheduler):
+    """
+    Simulated scheduler for testing the walltime handling on a single machine
+
+    It is used whenever DISP_SIM_SCHEDULER is set. The settings are read from the JSON file it
+    points to, if any, and can be overridden by the DISP_SIM_<KEY> environmental variables:
+
+    - job_id: ID of the job, defaults to "sim"
+    - ncpus: Number of CPUs of the job, defaults to 4
+    - walltime: Walltime of the job in seconds, defaults to 3600
+    - start_time: Start time as a UNIX timestamp, defaults to the first time it is needed.
+      It is exported so that the child processes share the same start time.
+    - end_time: End time as a UNIX timestamp, takes precedence over the walltime
+    """
+
+    DEFAULTS = {"job_id": "sim", "ncpus": 4, "walltime": 3600}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.settings = self.read_settings()
+
+    @classmethod
+    def read_settings(cls):
+        """Read the settings from the file and the environment"""
+        settings = dict(cls.DEFAULTS)
+        path = os.environ.get(SIM_ENV_VAR)
+        if path and os.path.isfile(path):
+            with open(path) as fhandle:
+                settings.update(json.load(fhandle))
+        for key in ["job_id", "ncpus", "walltime", "start_time", "end_time"]:
+            value = os.environ.get(f"DISP_SIM_{key.upper()}")
+            if value:
+                settings[key] = value
+        return settings
+
+    @staticmethod
+    def get_env_job_id():
+        """Return the ID of the simulated job, None if not simulating"""
+        if not os.environ.get(SIM_ENV_VAR):
+            return None
+        return str(Simulated.read_settings()["job_id"])
+
+    @property
+    def is_in_job(self):
+        return bool(os.environ.get(SIM_ENV_VAR))
+
+    @property
+    def job_id(self):
+        return str(self.settings["job_id"])
+
+    def get_n_cpus(self):
+        return int(self.settings["ncpus"])
+
+    def get_start_time(self):
+        """Return the start time of the job, exported to the child processes if not set"""
+        if self.settings.get("start_time") is None:
+            self.settings["start_time"] = time.time()
+            os.environ["DISP_SIM_START_TIME"] = str(self.settings["start_time"])
+        return datetime.fromtimestamp(float(self.settings["start_time"]))
+
+    def get_end_time(self):
+        """Return the time when the job is expected to finish"""
+        if self.settings.get("end_time") is not None:
+            return datetime.fromtimestamp(float(self.settings["end_time"]))
+        return self.get_start_time() + timedelta(seconds=float(self.settings["walltime"]))
+
+
 class SGE(Scheduler):
     """Scheduler object for SGE scheduler"""
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, runner=None, **kwargs):
         """Initialise the SGE scheulder object"""
         super().__init__(*args, **kwargs)
+        self.query = CachedQuery(runner or run_command)
         if self.is_in_job:
             self._readtask_info()
         self._start_time = None
@@ -96,19 +277,24 @@ class SGE(Scheduler):
     def job_id(self):
         """ID of the job"""
         if self._job_id is None:
-            job_id = os.environ.get("JOB_ID")
-            task_id = os.environ.get("SGE_TASK_ID")
-            if task_id and task_id != "undefined":
-                job_id = job_id + "." + task_id
+            job_id = self.get_env_job_id()
+            if job_id and "." in job_id:
                 logger.warning("WARNING: REMAINING TIME IS NOT CORRECT FOR TASK ARRAY")
             self._job_id = job_id
         return self._job_id
 
+    @staticmethod
+    def get_env_job_id():
+        """Return the ID of the job from the environmental variables"""
+        job_id = os.environ.get("JOB_ID")
+        task_id = os.environ.get("SGE_TASK_ID")
+        if job_id and task_id and task_id != "undefined":
+            job_id = job_id + "." + task_id
+        return job_id
+
     def _readtask_info(self):
         """Read more detailed task infomation"""
-        raw_data = subprocess.check_output(
-            ["qstat", "-j", f"{self.job_id}"], universal_newlines=True  # pylint: disable=unexpected-keyword-arg
-        )
+        raw_data = self.query(["qstat", "-j", f"{self.job_id}"])
         raw_data = raw_data.split("\n")
         task_info = {}
         for line in raw_data[1:]:
@@ -142,9 +328,7 @@ class SGE(Scheduler):
 
     def get_start_time(self):
         """Return the start time of this job"""
-        output = subprocess.check_output(  # pylint: disable=unexpected-keyword-arg
-            ["qstat", "-j", str(self.job_id), "-xml"], universal_newlines=True
-        )
+        output = self.query(["qstat", "-j", str(self.job_id), "-xml"])
         match = re.search(r"<JAT_start_time>(.+)</JAT_start_time>", output)
         if match:
             raw = match.group(1)
@@ -154,12 +338,6 @@ class SGE(Scheduler):
             self._start_time = start_time
         return start_time
 
-    def get_remaining_seconds(self):
-        """Return the remaining time in seconds"""
-        # Everything much be time zone aware to work with BST
-        tdelta = self.get_end_time() - datetime.now().astimezone()
-        return int(tdelta.total_seconds())
-
 
 class Slurm(Scheduler):
     """Slurm object for storing and extracting information in slurm"""
@@ -167,9 +345,17 @@ class Slurm(Scheduler):
     _task_info = None
     _warning = 0
 
-    def __init__(self):
-        """Initialise and Slurm instance"""
+    def __init__(self, runner=None):
+        """
+        Initialise and Slurm instance
+
+        Args:
+          runner: Callable running a SLURM command given as a list and returning its output,
+            defaults to `get_slurm_runner()`
+        """
         super().__init__()
+        self.runner = runner if runner is not None else get_slurm_runner()
+        self.query = CachedQuery(self.runner)
         self.task_info = {}
         if self._task_info is None:
             self._readtask_info()
@@ -185,15 +371,19 @@ class Slurm(Scheduler):
     @property
     def job_id(self):
         if self._job_id is None:
-            self._job_id = os.environ.get("SLURM_JOB_ID")
+            self._job_id = self.get_env_job_id()
         return self._job_id
 
+    @staticmethod
+    def get_env_job_id():
+        """Return the ID of the job from the environmental variables"""
+        return os.environ.get("SLURM_JOB_ID")
+
     def _readtask_info(self):
         """A function to extract information from environmental varibles
         SLURM_JOB_ID unique to each job
         Return an dictionnary contain job information.
         If not in slurm, return None
-        TODO Refector avoid saving intermediate file
         """
         sinfo_dict = {}
         if not self.is_in_job:
@@ -204,21 +394,18 @@ class Slurm(Scheduler):
             return
 
         # Read information from scontrol commend
-        # Temporary file for storing output
-        with tempfile.TemporaryFile(mode="w+") as tmp_file:
-            subprocess.run(f"scontrol show jobid={self.job_id:s}", shell=True, check=True, stdout=tmp_file)
-            # Iterate through lines
-            tmp_file.seek(0)
-            for line in tmp_file:
-                # Iterate through each pair
-                for pair in line.split():
-                    # Parse each pair
-                    pair_s = pair.split("=", maxsplit=2)
-                    if len(pair_s) == 2:
-                        sinfo_dict[pair_s[0]] = pair_s[1]
-                    # Empty field - put None
-                    elif len(pair_s) == 1:
-                        sinfo_dict[pair_s[0]] = None
+        output = self.query(["scontrol", "show", f"jobid={self.job_id:s}"])
+        # Iterate through lines
+        for line in output.split("\n"):
+            # Iterate through each pair
+            for pair in line.split():
+                # Parse each pair
+                pair_s = pair.split("=", maxsplit=2)
+                if len(pair_s) == 2:
+                    sinfo_dict[pair_s[0]] = pair_s[1]
+                # Empty field - put None
+                elif len(pair_s) == 1:
+                    sinfo_dict[pair_s[0]] = None
         type(self)._task_info = sinfo_dict
         self.task_info = sinfo_dict
         return
@@ -229,15 +416,11 @@ class Slurm(Scheduler):
         Return a datetime object
         """
         if self.task_info:
-            end_time = datetime.strptime(self.task_info["EndTime"], "%Y-%m-%dT%H:%M:%S")
+            end_time = datetime.strptime(self.task_info["EndTime"], SLURM_TIME_FORMAT)
         else:
             end_time = None
         return end_time
 
-    def get_remaining_seconds(self):
-        """Return the reminaing time in seconds"""
-        return int((self.get_end_time() - datetime.now()).total_seconds())
-
     def get_user_name(self):
         """
         Parse the user name from task info
@@ -291,11 +474,12 @@ class Slurm(Scheduler):
         else:
             array = None
         if array is not None:
-            proc = subprocess.run(f"scontrol hold {array}", shell=True, check=True)
-            if proc.returncode == 0:
-                logger.info("Successfully hold the array %d", array)
+            try:
+                self.hold_arrays([str(array)])
+            except subprocess.CalledProcessError:
+                logger.error("Cannot hold array %s", array)
             else:
-                logger.error("Cannot hold array %d", array)
+                logger.info("Successfully hold the array %s", array)
         else:
             logger.error("Cannot found the array to hold")
 
@@ -306,8 +490,7 @@ class Slurm(Scheduler):
             logger.warning("No array found to be hold")
             return
         logger.info("Trying to hold all arrays in pending state")
-        array_list = ",".join(arrays)
-        subprocess.run(["scontrol", "hold", array_list], check=True)
+        self.hold_arrays(arrays)
 
     def release_all_pd_arrays(self, user_name=None):
         """
@@ -317,29 +500,86 @@ class Slurm(Scheduler):
         if not arrays:
             logger.warning("No array found to be released")
             return
-        array_list = ",".join(arrays)
-        subprocess.run(["scontrol", "release", array_list], check=True)
+        self.release_arrays(arrays)
+
+    def hold_arrays(self, array_ids):
+        """Hold the given arrays"""
+        if array_ids:
+            self.runner(["scontrol", "hold", ",".join(array_ids)])
+            self.query.invalidate()
+
+    def release_arrays(self, array_ids):
+        """Release the given arrays"""
+        if array_ids:
+            self.runner(["scontrol", "release", ",".join(array_ids)])
+            self.query.invalidate()
+
+    def hold_tasks(self, tasks):
+        """Hold individual tasks of the arrays"""
+        self.hold_arrays([f"{task['array_id']}_{task['task_id']}" for task in tasks])
+
+    def release_tasks(self, tasks):
+        """Release individual tasks of the arrays"""
+        self.release_arrays([f"{task['array_id']}_{task['task_id']}" for task in tasks])
+
+    def get_queue(self, user_name=None):
+        """Return the jobs of a user in the queue, see `Scheduler.get_queue`"""
+        output = self.query(["squeue", "-h", "-r", "-u", user_name or self.user_name, "-o", "%A|%F|%K|%j|%t|%r"])
+        jobs = []
+        for line in output.split("\n"):
+            sline = line.split("|", maxsplit=5)
+            if len(sline) < 6:
+                continue
+            job_id, array_id, task_id, name, state, reason = sline
+            jobs.append(
+                {
+                    "job_id": job_id,
+                    # %F gives the job ID of jobs that are not part of an array
+                    "array_id": None if task_id == "N/A" else array_id,
+                    "task_id": None if task_id == "N/A" else task_id,
+                    "name": name,
+                    "state": state,
+                    "reason": reason,
+                    "held": reason in ("JobHeldUser", "JobHeldAdmin"),
+                }
+            )
+        return jobs
+
+    def submit_array(self, script, ntasks, job_name=None):
+        """
+        Submit a job script as an array
+
+        Returns:
+          The ID of the submitted array
+        """
+        cmd = ["sbatch", "--parsable", f"--array=0-{ntasks - 1}"]
+        if job_name:
+            cmd.append(f"--job-name={job_name}")
+        cmd.append(str(script))
+        output = self.runner(cmd)
+        self.query.invalidate()
+        return output.strip().split(";")[0]
 
     def get_running_jobs(self, user_name=None):
         """
         Return a list of running jobs of the current user
         NOTE: in string format
         """
-        ids = self._get_id_of_state("R", "%A %t", user_name)
+        ids = self._get_id_of_state("R", "job_id", user_name)
         return ids
 
     def get_pd_arrays(self, user_name=None):
         """
         Return a list of pending array jobs
         """
-        ids = self._get_id_of_state("PD", "%F %t", user_name)
+        ids = self._get_id_of_state("PD", "array_id", user_name)
         return ids
 
-    def _get_id_of_state(self, criteria, fmt_str, user_name=None):
+    def _get_id_of_state(self, criteria, key, user_name=None):
         """
         Get ids for jobs satisfying certain criteria
         criteria : string of the criteria
-        fmt_str : format string should be used in sequence
+        key : the id to be returned, "job_id" or "array_id"
         user_name : assign specific user name
         """
         if not self.task_info and not user_name:
@@ -347,15 +587,10 @@ class Slurm(Scheduler):
 
         if not user_name:
             user_name = self.get_user_name()
-        res = tempfile.TemporaryFile(mode="w+")
-        subprocess.run(f'squeue -u {user_name:s} -o"{fmt_str}"', shell=True, check=True, stdout=res)
-        res.seek(0)
         task_ids = []
-        for line in res:
-            sline = line.split()
-            if sline[1] == criteria:
-                task_ids.append(sline[0])
-        res.close()
+        for job in self.get_queue(user_name):
+            if job["state"] == criteria and job[key] and job[key] not in task_ids:
+                task_ids.append(job[key])
         return task_ids
 
     def __bool__(self):
@@ -370,3 +605,452 @@ class Slurm(Scheduler):
 
     def __contains__(self, key):
         return key in self.task_info
+
+
+class PBS(Scheduler):
+    """Scheduler object for PBS Pro"""
+
+    def __init__(self, *args, runner=None, **kwargs):
+        """
+        Initialise the PBS scheduler object
+
+        Args:
+          runner: Callable running a PBS command given as a list and returning its output
+        """
+        super().__init__(*args, **kwargs)
+        self.runner = runner or run_command
+        self.query = CachedQuery(self.runner)
+
+    @property
+    def is_in_job(self):
+        return "PBS_JOBID" in os.environ
+
+    @property
+    def job_id(self):
+        if self._job_id is None:
+            self._job_id = self.get_env_job_id()
+        return self._job_id
+
+    @staticmethod
+    def get_env_job_id():
+        """Return the ID of the job from the environmental variables"""
+        return os.environ.get("PBS_JOBID")
+
+    def get_job_info(self, job_id=None):
+        """Return the full status of a job as reported by `qstat -f`"""
+        job_id = job_id or self.job_id
+        jobs = json.loads(self.query(["qstat", "-f", "-F", "json", job_id])).get("Jobs", {})
+        return jobs.get(job_id) or next(iter(jobs.values()), {})
+
+    def get_n_cpus(self):
+        """Return the number of CPUs allocated"""
+        ncpus = os.environ.get("NCPUS")
+        if ncpus:
+            return int(ncpus)
+        return self.get_job_info().get("Resource_List", {}).get("ncpus")
+
+    def get_end_time(self):
+        """Return the time when the job is expected to finish"""
+        info = self.get_job_info()
+        start_time = datetime.strptime(info["stime"], PBS_TIME_FORMAT)
+        return start_time + timedelta(seconds=_parse_duration(info["Resource_List"]["walltime"]))
+
+    def get_queue(self, user_name=None):
+        """Return the jobs of a user in the queue, see `Scheduler.get_queue`"""
+        user_name = user_name or self.user_name
+        jobs = []
+        output = self.query(["qstat", "-t", "-f", "-F", "json"])
+        for job_id, info in json.loads(output).get("Jobs", {}).items():
+            # Array parents are listed together with their subjobs
+            if info.get("Job_Owner", "").split("@")[0] != user_name or info.get("array") == "True":
+                continue
+            state = info.get("job_state")
+            # Finished subjobs are still listed by `qstat -t`
+            if state in PBS_FINISHED_STATES:
+                continue
+            match = re.match(r"(\d+)\[(\d*)\](.*)", job_id)
+            jobs.append(
+                {
+                    "job_id": job_id,
+                    "array_id": f"{match.group(1)}[]{match.group(3)}" if match else None,
+                    "task_id": match.group(2) if match else None,
+                    "name": info.get("Job_Name"),
+                    "state": "R" if state in ("R", "E") else "PD",
+                    "reason": info.get("comment", ""),
+                    "held": state == "H",
+                }
+            )
+        return jobs
+
+    def hold_arrays(self, array_ids):
+        """Hold the given arrays"""
+        if array_ids:
+            self.runner(["qhold"] + list(array_ids))
+            self.query.invalidate()
+
+    def release_arrays(self, array_ids):
+        """Release the given arrays"""
+        if array_ids:
+            self.runner(["qrls"] + list(array_ids))
+            self.query.invalidate()
+
+    def hold_tasks(self, tasks):
+        """Hold individual tasks of the arrays by their subjob IDs"""
+        self.hold_arrays([task["job_id"] for task in tasks])
+
+    def release_tasks(self, tasks):
+        """Release individual tasks of the arrays by their subjob IDs"""
+        self.release_arrays([task["job_id"] for task in tasks])
+
+    def submit_array(self, script, ntasks, job_name=None):
+        """Submit a job script as an array, returns the ID of the array"""
+        cmd = ["qsub", "-J", f"0-{ntasks - 1}"]
+        if job_name:
+            cmd.extend(["-N", job_name])
+        cmd.append(str(script))
+        output = self.runner(cmd)
+        self.query.invalidate()
+        return output.strip()
+
+
+class LSF(Scheduler):
+    """Scheduler object for IBM Spectrum LSF"""
+
+    BJOBS_FIELDS = "jobid jobindex stat job_name pend_reason time_left"
+
+    def __init__(self, *args, runner=None, **kwargs):
+        """
+        Initialise the LSF scheduler object
+
+        Args:
+          runner: Callable running a LSF command given as a list and returning its output
+        """
+        super().__init__(*args, **kwargs)
+        self.runner = runner or run_command
+        self.query = CachedQuery(self.runner)
+
+    @property
+    def is_in_job(self):
+        return "LSB_JOBID" in os.environ
+
+    @property
+    def job_id(self):
+        if self._job_id is None:
+            self._job_id = self.get_env_job_id()
+        return self._job_id
+
+    @staticmethod
+    def get_env_job_id():
+        """Return the ID of the job from the environmental variables, including the index for arrays"""
+        job_id = os.environ.get("LSB_JOBID")
+        index = os.environ.get("LSB_JOBINDEX")
+        if job_id and index and index != "0":
+            job_id = f"{job_id}[{index}]"
+        return job_id
+
+    def get_n_cpus(self):
+        """Return the number of CPUs allocated"""
+        nproc = os.environ.get("LSB_DJOB_NUMPROC")
+        return int(nproc) if nproc else None
+
+    def _bjobs(self, args):
+        """Run `bjobs` with JSON output, returns the records"""
+        output = self.query(["bjobs", "-json", "-o", self.BJOBS_FIELDS] + args)
+        return json.loads(output).get("RECORDS", [])
+
+    def get_end_time(self):
+        """Return the time when the job is expected to finish, from the time left reported by `bjobs`"""
+        records = self._bjobs([self.job_id])
+        match = re.match(r"(\d+):(\d+)", records[0].get("TIME_LEFT", "")) if records else None
+        if match is None:
+            raise ValueError(f"Cannot find the time left for job {self.job_id}")
+        return datetime.now() + timedelta(hours=int(match.group(1)), minutes=int(match.group(2)))
+
+    def get_queue(self, user_name=None):
+        """Return the jobs of a user in the queue, see `Scheduler.get_queue`"""
+        jobs = []
+        for record in self._bjobs(["-u", user_name or self.user_name]):
+            index = record.get("JOBINDEX", "0")
+            is_array = index not in ("", "0")
+            jobs.append(
+                {
+                    "job_id": f"{record['JOBID']}[{index}]" if is_array else record["JOBID"],
+                    "array_id": record["JOBID"] if is_array else None,
+                    "task_id": index if is_array else None,
+                    # The name of an array task includes the index range
+                    "name": re.sub(r"\[.*\]$", "", record.get("JOB_NAME", "")),
+                    "state": "R" if record.get("STAT") in ("RUN", "USUSP", "SSUSP") else "PD",
+                    "reason": record.get("PEND_REASON", ""),
+                    "held": record.get("STAT") == "PSUSP",
+                }
+            )
+        return jobs
+
+    def hold_arrays(self, array_ids):
+        """
+        Hold (suspend) the pending tasks of the given arrays
+
+        `bstop` on a whole array would suspend its running tasks as well, hence only the pending
+        elements are given.
+        """
+        tasks = self.get_array_tasks() if array_ids else []
+        self.hold_tasks([task for task in tasks if task["array_id"] in array_ids and task["state"] == "PD" and not task["held"]])
+
+    def release_arrays(self, array_ids):
+        """Release (resume) the given arrays"""
+        if array_ids:
+            self.runner(["bresume"] + list(array_ids))
+            self.query.invalidate()
+
+    def hold_tasks(self, tasks):
+        """Hold (suspend) individual tasks of the arrays"""
+        self._control_tasks("bstop", tasks)
+
+    def release_tasks(self, tasks):
+        """Release (resume) individual tasks of the arrays"""
+        self._control_tasks("bresume", tasks)
+
+    def _control_tasks(self, command, tasks):
+        """Run a command on the tasks, given as `<array>[<index>,...]` for each array"""
+        indices = {}
+        for task in tasks:
+            indices.setdefault(task["array_id"], []).append(task["task_id"])
+        for array_id, array_indices in indices.items():
+            self.runner([command, f"{array_id}[{','.join(array_indices)}]"])
+        if indices:
+            self.query.invalidate()
+
+    def submit_array(self, script, ntasks, job_name=None):
+        """Submit a job script as an array, returns the ID of the array"""
+        output = self.runner(["bsub", "-J", f"{job_name or 'disp'}[1-{ntasks}]", str(script)])
+        self.query.invalidate()
+        match = re.search(r"Job <(\d+)>", output)
+        return match.group(1) if match else output.strip()
+
+
+class CachedQuery:
+    """
+    Run the queries of the queue through a cache shared within the process
+
+    The output of each command is reused for `interval` seconds, so that the scheduler is polled
+    at most once per interval however many places ask for the state of the queue. The cache should
+    be invalidated after commands changing the queue.
+    """
+
+    INTERVAL = 30
+    _cache = {}  # (runner, command) -> (time of the query, output)
+
+    def __init__(self, runner, interval=None, clock=time.monotonic):
+        """
+        Instantiate a CachedQuery
+
+        Args:
+          runner: Callable running a command given as a list and returning its output
+          interval: Seconds for which the output is reused, defaults to `INTERVAL`
+          clock: Function returning the current time in seconds
+        """
+        self.runner = runner
+        self.interval = self.INTERVAL if interval is None else interval
+        self.clock = clock
+
+    def __call__(self, cmd):
+        """Run a command, or return the cached output"""
+        key = (self.runner, tuple(cmd))
+        now = self.clock()
+        cached = self._cache.get(key)
+        if cached is not None and now - cached[0] < self.interval:
+            return cached[1]
+        output = self.runner(list(cmd))
+        self._cache[key] = (now, output)
+        return output
+
+    def invalidate(self):
+        """Remove the cached outputs of the runner"""
+        for key in [key for key in self._cache if key[0] is self.runner]:
+            del self._cache[key]
+
+
+def _parse_duration(value):
+    """Parse a duration in the HH:MM:SS format into seconds"""
+    seconds = 0
+    for part in value.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def run_command(cmd):
+    """Run a command and return its output"""
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def get_slurm_runner():
+    """Return the runner for the SLURM commands, the simulated queue if DISP_SIM_SLURM_QUEUE is set"""
+    path = os.environ.get(SIM_QUEUE_ENV_VAR)
+    if path:
+        return SimulatedSlurmQueue(path)
+    return run_command
+
+
+class SimulatedSlurmQueue:
+    """
+    Stand-in for the SLURM commands, acting on a queue stored in a JSON file
+
+    Only the commands and options used by the `Slurm` class are supported. Each time a command
+    is run, the running tasks past their walltime are removed, and the pending tasks that are not
+    held are started as long as fewer than `max_running` tasks are running.
+    """
+
+    HELD_REASON = "JobHeldUser"
+
+    def __init__(self, path, max_running=4, walltime=3600, ncpus=4, clock=time.time):
+        """
+        Instantiate a SimulatedSlurmQueue
+
+        Args:
+          path: Path to the JSON file storing the queue, created if it does not exist
+          max_running, walltime, ncpus: Settings for a new queue, those in the file take precedence
+          clock: Function returning the current time as a UNIX timestamp
+        """
+        self.path = path
+        self.clock = clock
+        self.defaults = {"max_running": max_running, "walltime": walltime, "ncpus": ncpus, "next_id": 1000, "jobs": []}
+
+    def load(self):
+        """Load the state of the queue"""
+        if not os.path.isfile(self.path):
+            return dict(self.defaults, jobs=[])
+        with open(self.path) as fhandle:
+            return dict(self.defaults, **json.load(fhandle))
+
+    def save(self, state):
+        """Save the state of the queue"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fhandle:
+            json.dump(state, fhandle)
+        os.replace(tmp_path, self.path)
+
+    def tick(self, state):
+        """Remove the tasks that have used up their walltime, and start the pending ones"""
+        now = self.clock()
+        state["jobs"] = [job for job in state["jobs"] if job["state"] != "R" or job["start_time"] + job["walltime"] > now]
+        nrunning = sum(1 for job in state["jobs"] if job["state"] == "R")
+        for job in state["jobs"]:
+            if nrunning >= state["max_running"]:
+                break
+            if job["state"] == "PD" and job["reason"] != self.HELD_REASON:
+                job.update(state="R", reason="None", start_time=now)
+                nrunning += 1
+
+    def __call__(self, cmd):
+        """Run a command, returns the output"""
+        handler = {"squeue": self._squeue, "scontrol": self._scontrol, "sbatch": self._sbatch}.get(cmd[0])
+        if handler is None:
+            raise ValueError(f"Command {cmd[0]} is not supported")
+        state = self.load()
+        self.tick(state)
+        output = handler(state, cmd[1:])
+        self.save(state)
+        return output
+
+    def _squeue(self, state, args):  # pylint: disable=no-self-use
+        """Emulate `squeue` with the -h, -r, -u, -n and -o options"""
+        opts = _parse_options(args, flags=["-h", "-r"])
+        jobs = state["jobs"]
+        if "-n" in opts:
+            jobs = [job for job in jobs if job["name"] == opts["-n"]]
+        if "-u" in opts:
+            jobs = [job for job in jobs if job["user"] == opts["-u"]]
+        fields = {
+            "%A": lambda job: job["array_id"],
+            "%F": lambda job: job["array_id"],
+            "%K": lambda job: job["task_id"],
+            "%i": lambda job: f"{job['array_id']}_{job['task_id']}",
+            "%j": lambda job: job["name"],
+            "%t": lambda job: job["state"],
+            "%r": lambda job: job["reason"],
+        }
+        fmt = opts.get("-o", "%i %j %t %r").strip('"')
+        lines = [] if "-h" in opts else [fmt.replace("%", "")]
+        seen = set()
+        for job in jobs:
+            # Pending tasks of the same array are shown in a single line unless -r is given
+            if "-r" not in opts and job["state"] == "PD":
+                if (job["array_id"], job["reason"]) in seen:
+                    continue
+                seen.add((job["array_id"], job["reason"]))
+            line = fmt
+            for key, func in fields.items():
+                line = line.replace(key, str(func(job)))
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+    def _scontrol(self, state, args):
+        """Emulate `scontrol hold`, `scontrol release` and `scontrol show jobid=`"""
+        if args[0] in ("hold", "release"):
+            job_ids = args[1].split(",")
+            for job in state["jobs"]:
+                if (job["array_id"] in job_ids or f"{job['array_id']}_{job['task_id']}" in job_ids) and job["state"] == "PD":
+                    job["reason"] = self.HELD_REASON if args[0] == "hold" else "Priority"
+            return ""
+        if args[0] == "show":
+            job_id = args[1].split("=", 1)[1]
+            for job in state["jobs"]:
+                if job_id in (job["job_id"], f"{job['array_id']}_{job['task_id']}"):
+                    return self._show_job(job)
+            raise subprocess.CalledProcessError(1, ["scontrol"] + list(args))
+        raise ValueError(f"scontrol {args[0]} is not supported")
+
+    @staticmethod
+    def _show_job(job):
+        """Format the information of a job as `scontrol show jobid=` does"""
+        pairs = {
+            "JobId": job["job_id"],
+            "ArrayJobId": job["array_id"],
+            "ArrayTaskId": job["task_id"],
+            "JobName": job["name"],
+            "UserId": f"{job['user']}(1000)",
+            "JobState": "RUNNING" if job["state"] == "R" else "PENDING",
+            "Reason": job["reason"],
+            "NumCPUs": job["ncpus"],
+        }
+        if job["start_time"] is not None:
+            pairs["StartTime"] = datetime.fromtimestamp(job["start_time"]).strftime(SLURM_TIME_FORMAT)
+            pairs["EndTime"] = datetime.fromtimestamp(job["start_time"] + job["walltime"]).strftime(SLURM_TIME_FORMAT)
+        return " ".join(f"{key}={value}" for key, value in pairs.items()) + "\n"
+
+    def _sbatch(self, state, args):
+        """Emulate `sbatch --parsable --array=N-M --job-name=NAME SCRIPT`"""
+        opts = dict(arg.split("=", 1) for arg in args if arg.startswith("--") and "=" in arg)
+        first, last = opts.get("--array", "0-0").split("-")
+        array_id = str(state["next_id"])
+        for task_id in range(int(first), int(last) + 1):
+            state["jobs"].append(
+                {
+                    "job_id": str(state["next_id"]),
+                    "array_id": array_id,
+                    "task_id": task_id,
+                    "name": opts.get("--job-name", os.path.basename(args[-1])),
+                    "user": os.environ.get("USER", "user"),
+                    "state": "PD",
+                    "reason": "Priority",
+                    "start_time": None,
+                    "walltime": state["walltime"],
+                    "ncpus": state["ncpus"],
+                }
+            )
+            state["next_id"] += 1
+        self.tick(state)
+        return array_id + "\n"
+
+
+def _parse_options(args, flags=()):
+    """Parse the command line options of the form `-x value`"""
+    opts = {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in flags:
+            opts[arg] = True
+        elif arg.startswith("-") and args:
+            opts[arg] = args.pop(0)
+    return opts
@@ -2,6 +2,7 @@
 Utility Module - contains useful routines
 """
 import io
+import os
 import re
 
 import numpy as np
@@ -66,6 +67,38 @@ def filter_out_stream(stream, start, end):
     return out_stream
 
 
+def read_tail(fname, nlines=20, block_size=4096):
+    """
+    Read the last few lines of a file
+
+    The file is read backwards from the end in blocks, so the cost does not
+    depend on the size of the file.
+
+    Args:
+        fname: Path to the file
+        nlines: Number of lines to read
+        block_size: Number of bytes in each read
+
+    Returns:
+        A list of the last `nlines` lines without the line endings
+    """
+    if nlines <= 0:
+        return []
+    with open(fname, "rb") as fhandle:
+        pos = fhandle.seek(0, os.SEEK_END)
+        data = b""
+        # An extra line break is needed for the first line to be complete
+        while pos > 0 and data.count(b"\n") <= nlines:
+            step = min(block_size, pos)
+            pos -= step
+            fhandle.seek(pos)
+            data = fhandle.read(step) + data
+    lines = data.decode(errors="replace").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines[-nlines:]
+
+
 def calc_kpt_tuple_recip(structure, mp_spacing=0.05, rounding="up"):
     """Calculate reciprocal-space sampling with real-space parameter"""
 
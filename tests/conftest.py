@@ -6,6 +6,7 @@ import os
 import tempfile
 from pathlib import Path
 
+import mongomock
 import pytest
 from fireworks import fw_config
 from fireworks.core.launchpad import LaunchPad
@@ -87,6 +88,27 @@ def launchpad():
     lpd.connection.drop_database(TESTDB_NAME)
 
 
+class MockLaunchPad:
+    """A minimal LaunchPad backed by mongomock, for testing code writing to the collections directly"""
+
+    def __init__(self):
+        self.db = mongomock.MongoClient().db
+        self.fireworks = self.db.fireworks
+        self.workflows = self.db.workflows
+        self.launches = self.db.launches
+        self.fw_id_assigner = self.db.fw_id_assigner
+        self.fw_id_assigner.insert_one({"next_fw_id": 1, "next_launch_id": 1})
+
+    def get_new_fw_id(self, quantity=1):
+        return LaunchPad.get_new_fw_id(self, quantity)
+
+
+@pytest.fixture
+def mock_launchpad():
+    """A LaunchPad backed by mongomock"""
+    return MockLaunchPad()
+
+
 @pytest.fixture
 def clean_launchpad(launchpad):
     """Get a launchpad in clean state"""
@@ -0,0 +1,142 @@
+"""
+Test the content-addressed storage of the contents
+"""
+import subprocess
+from collections import OrderedDict
+
+import pytest
+
+from disp.database import get_hash
+from disp.fws import blobs
+from disp.fws.blobs import BlobStore, extract_blobs, is_blob_ref, resolve_blobs, store_firework_blobs
+from disp.fws.bulk import bulk_add_from_template
+from disp.fws.tasks import AirssBatchSearchTask, AirssBuildcellTask
+from disp.fws.works import AirssBatchSearchFW, AirssSearchFW, RelaxFW, SinglePointFW
+
+# pylint: disable=redefined-outer-name, protected-access
+
+PARAM = "task : geometryoptimisation\n" * 5
+CELL = "%block lattice_cart\n10 0 0\n0 10 0\n0 0 10\n%endblock lattice_cart\n"
+
+
+@pytest.fixture
+def store(mock_launchpad, tmp_path, monkeypatch):
+    """A BlobStore with an empty memory cache"""
+    monkeypatch.setattr(blobs, "_MEMORY_CACHE", OrderedDict())
+    return BlobStore(mock_launchpad, cache_dir=tmp_path / "cache")
+
+
+def test_extract_blobs():
+    """Test replacing the contents with references"""
+    obj = {"param_content": PARAM, "seed_content": "#short", "_tasks": [{"struct_content": CELL}]}
+    found = extract_blobs(obj, {})
+    assert found == {get_hash(PARAM): PARAM, get_hash(CELL): CELL}
+    assert obj["param_content"] == {"_blob": get_hash(PARAM)}
+    assert obj["_tasks"][0]["struct_content"] == {"_blob": get_hash(CELL)}
+    # Short contents are kept inline
+    assert obj["seed_content"] == "#short"
+
+
+def test_blob_store(store, monkeypatch):
+    """Test storing and fetching blobs"""
+    assert store.put({get_hash(PARAM): PARAM}) == 1
+    assert store.put({get_hash(PARAM): PARAM}) == 0
+    assert store.get(get_hash(PARAM)) == PARAM
+    assert (store.cache_dir / get_hash(PARAM)).read_text() == PARAM
+    with pytest.raises(KeyError):
+        store.get("foo")
+
+    # Fetched from the disk cache without accessing the database
+    monkeypatch.setattr(blobs, "_MEMORY_CACHE", OrderedDict())
+    store.collection.delete_many({})
+    assert store.get(get_hash(PARAM)) == PARAM
+
+
+def test_memory_cache_size(store, monkeypatch):
+    """Test that only the most recently used contents are kept in memory"""
+    monkeypatch.setattr(blobs, "_MEMORY_CACHE_SIZE", 2)
+    contents = [PARAM + f"# {idx}" for idx in range(3)]
+    store.put({get_hash(content): content for content in contents})
+    store.get(get_hash(contents[0]))
+    store.get(get_hash(contents[1]))
+    store.get(get_hash(contents[0]))
+    store.get(get_hash(contents[2]))
+    assert list(blobs._MEMORY_CACHE) == [get_hash(contents[0]), get_hash(contents[2])]
+
+
+def test_bulk_add_with_blobs(store):
+    """Test inserting fireworks referencing the blobs and resolving them in the tasks"""
+    template = RelaxFW(
+        project_name="test",
+        struct_name="S-0",
+        struct_content=CELL,
+        param_content=PARAM,
+        executable="castep",
+        seed_name="C2",
+        name="S-0-relax",
+    )
+    cells = [CELL + f"# {idx}" * 40 for idx in range(3)]
+    entries = [(f"S-{idx}-relax", {"struct_name": f"S-{idx}", "struct_content": cells[idx]}, None) for idx in range(3)]
+    bulk_add_from_template(store.lpad, template, entries, blob_store=store)
+    assert store.collection.count_documents({}) == 5
+
+    doc = store.lpad.fireworks.find_one({"name": "S-2-relax"})
+    assert doc["spec"]["struct_content"] == {"_blob": get_hash(cells[2])}
+    assert doc["spec"]["_add_launchpad_and_fw_id"] is True
+    task = template.tasks[0]
+    assert task["param_content"] == {"_blob": get_hash(PARAM)}
+
+    task.launchpad = store.lpad
+    spec = dict(doc["spec"], _fw_env={"blob_cache": str(store.cache_dir)})
+    assert resolve_blobs(task, spec) is not None
+    assert task["param_content"] == PARAM
+    assert spec["struct_content"] == cells[2]
+    # Nothing left to resolve
+    assert resolve_blobs(task, spec) is None
+    assert resolve_blobs(AirssBuildcellTask(seed_content="#SEED", seed_name="C2", project_name="test"), {}) is None
+
+
+class ExternalCall(Exception):
+    """Raised in place of running an external program"""
+
+
+def _fireworks_with_blobs():
+    """Fireworks of each type, with the contents referenced by their hashes"""
+    kwargs = dict(project_name="test", seed_name="C2", param_content=PARAM, executable="castep")
+    seed = CELL + "#SPECIES=C\n" * 10
+    return [
+        AirssSearchFW(seed_content=seed, **kwargs),
+        AirssBatchSearchFW(seed_content=seed, nstructures=2, **kwargs),
+        RelaxFW(struct_name="C2-1", struct_content=CELL + "C 0 0 0\n" * 10, **kwargs),
+        SinglePointFW(struct_name="C2-1", struct_content=CELL + "C 0 0 0\n" * 10, record_db=False, **kwargs),
+    ]
+
+
+@pytest.mark.parametrize("idx", range(4))
+def test_tasks_resolve_blobs(store, tmp_path, monkeypatch, idx):
+    """Test that every task of the fireworks deployed with blobs runs with the contents resolved"""
+
+    def external_call(*args, **kwargs):
+        raise ExternalCall(args)
+
+    monkeypatch.setattr(subprocess, "Popen", external_call)
+    monkeypatch.setattr(subprocess, "run", external_call)
+    monkeypatch.chdir(tmp_path)
+    firework = store_firework_blobs(store, _fireworks_with_blobs()[idx])
+    tasks = firework.tasks
+    if isinstance(tasks[0], AirssBatchSearchTask):
+        tasks = tasks[0]["tasks"]
+    assert any(is_blob_ref(value) for value in firework.spec.values()) or any(
+        is_blob_ref(value) for task in tasks for value in task.values()
+    )
+    # The spec is shared by the tasks, with the structure left by the build task
+    spec = dict(firework.spec, _fw_env={"blob_cache": str(store.cache_dir)})
+    spec.setdefault("struct_name", "C2-1")
+    (tmp_path / "C2-1.cell").write_text(CELL)
+    for task in tasks:
+        task.launchpad = store.lpad
+        # The tasks may stop at running the programs or at the missing outputs of the previous tasks
+        try:
+            task.run_task(spec)
+        except (ExternalCall, FileNotFoundError):
+            pass
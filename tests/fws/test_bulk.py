@@ -0,0 +1,62 @@
+"""
+Test the bulk insertion of workflows
+"""
+from fireworks.core.firework import Workflow
+from fireworks.core.launchpad import LaunchPad
+
+from disp.fws.bulk import bulk_add_from_template
+from disp.fws.works import RelaxFW
+
+# pylint: disable=protected-access
+
+
+def make_relax_fw(idx):
+    """Construct a RelaxFW for testing"""
+    return RelaxFW(
+        project_name="test",
+        struct_name=f"S-{idx}",
+        struct_content=f"CELL {idx}",
+        param_content="PARAM",
+        executable="castep",
+        seed_name="C2",
+        record_db=True,
+        existing_spec={"_priority": 3},
+        name=f"S-{idx}-relax",
+    )
+
+
+def strip(doc):
+    """Remove the fields that are expected to differ"""
+    return {key: value for key, value in doc.items() if key not in ("_id", "created_on", "updated_on")}
+
+
+def test_bulk_add_from_template(mock_launchpad):
+    """Test that the documents are the same as those inserted by LaunchPad.bulk_add_wfs"""
+    metadata = {"project_name": "test", "disp_type": "relax"}
+    workflows = []
+    for idx in range(5):
+        wflow = Workflow([make_relax_fw(idx)], name=f"S-{idx}-relax")
+        wflow.metadata.update(metadata, struct_name=f"S-{idx}")
+        workflows.append(wflow)
+    LaunchPad.bulk_add_wfs(mock_launchpad, workflows)
+
+    entries = [
+        (f"S-{idx}-relax", {"struct_name": f"S-{idx}", "struct_content": f"CELL {idx}"}, {"struct_name": f"S-{idx}"}) for idx in range(5)
+    ]
+    fw_ids = bulk_add_from_template(mock_launchpad, make_relax_fw(0), entries, metadata=metadata, chunk_size=2)
+    assert fw_ids == [6, 7, 8, 9, 10]
+    assert mock_launchpad.fw_id_assigner.find_one()["next_fw_id"] == 11
+
+    for idx in range(5):
+        expected = strip(mock_launchpad.fireworks.find_one({"fw_id": idx + 1}))
+        expected["fw_id"] += 5
+        assert strip(mock_launchpad.fireworks.find_one({"fw_id": idx + 6})) == expected
+
+        expected = strip(mock_launchpad.workflows.find_one({"nodes": idx + 1}))
+        inserted = strip(mock_launchpad.workflows.find_one({"nodes": idx + 6}))
+        assert inserted["nodes"] == [idx + 6]
+        assert inserted["fw_states"] == {str(idx + 6): "READY"}
+        for key in ["metadata", "name", "state", "parent_links"]:
+            assert inserted[key] == expected[key]
+
+    assert bulk_add_from_template(mock_launchpad, make_relax_fw(0), []) == []
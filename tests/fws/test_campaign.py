@@ -0,0 +1,115 @@
+"""
+Test the search campaigns
+"""
+import time
+
+import pytest
+
+from disp.fws.campaign import CampaignManager, category_match
+
+# pylint: disable=redefined-outer-name, import-outside-toplevel
+
+
+@pytest.fixture
+def manager(mock_launchpad):
+    """A CampaignManager with a mock LaunchPad"""
+    return CampaignManager(mock_launchpad)
+
+
+def test_campaign_refill(manager):
+    """Test materialising the fireworks of a campaign"""
+    fw_kwargs = {"executable": "castep"}
+    manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 25, fw_kwargs=fw_kwargs, priority=5, refill_size=10, low_water=3)
+    with pytest.raises(ValueError):
+        manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 25)
+
+    assert manager.refill() == 10
+    assert manager.count_ready("C2-test") == 10
+    fw = manager.lpad.fireworks.find_one({"name": "C2-test-0"})
+    assert fw["spec"]["_priority"] == 5
+    assert fw["spec"]["_campaign"] == "C2-test"
+    # Enough READY fireworks
+    assert manager.refill() == 0
+
+    manager.lpad.fireworks.update_many({}, {"$set": {"state": "COMPLETED"}})
+    assert manager.refill() == 10
+    manager.lpad.fireworks.update_many({}, {"$set": {"state": "COMPLETED"}})
+    assert manager.refill() == 5
+    assert manager.list()[0]["state"] == "COMPLETED"
+    assert manager.refill() == 0
+
+
+def test_campaign_update(manager):
+    """Test updating campaigns"""
+    manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 20, fw_kwargs={"executable": "castep"}, batch_size=4, category=["A"])
+    assert manager.refill(category="B") == 0
+    assert manager.refill(category="A") == 20
+    assert manager.count_ready("C2-test") == 5
+    assert manager.lpad.fireworks.find_one({"name": "C2-test-16"})["spec"]["_tasks"][0]["nstructures"] == 4
+
+    assert manager.update("C2-test", priority=10) == 5
+    assert manager.lpad.fireworks.count_documents({"spec._priority": 10}) == 5
+    assert manager.update("C2-test", target=30, state="PAUSED") == 0
+    assert manager.refill() == 0
+    with pytest.raises(ValueError):
+        manager.update("foo", priority=1)
+
+
+def test_campaign_target_raised(manager):
+    """Test raising the target of a completed campaign"""
+    manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 10, fw_kwargs={"executable": "castep"}, refill_size=10)
+    assert manager.refill() == 10
+    assert manager.list()[0]["state"] == "COMPLETED"
+    manager.update("C2-test", target=5)
+    assert manager.list()[0]["state"] == "COMPLETED"
+    manager.update("C2-test", target=15)
+    assert manager.list()[0]["state"] == "ACTIVE"
+    assert manager.refill() == 5
+    assert manager.list()[0]["state"] == "COMPLETED"
+
+
+def test_campaign_refill_takeover(manager):
+    """Test taking over the chunk of a worker that died while materialising it"""
+    from disp.fws.campaign import add_workflows
+
+    manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 20, fw_kwargs={"executable": "castep"}, refill_size=10)
+    doc = manager.collection.find_one({"name": "C2-test"})
+    # The worker died after reserving the chunk and adding some of the workflows
+    manager.collection.update_one({"_id": doc["_id"]}, {"$set": {"lock_until": time.time() + 60}})
+    add_workflows(manager.lpad, doc, 0, 4)
+    assert manager.refill() == 0
+
+    # Taken over once the lock expires, without adding the workflows again
+    manager.collection.update_one({"_id": doc["_id"]}, {"$set": {"lock_until": time.time() - 1}})
+    assert manager.refill() == 10
+    assert manager.count_ready("C2-test") == 10
+    assert manager.lpad.fireworks.count_documents({"name": "C2-test-0"}) == 1
+    assert manager.collection.find_one({"_id": doc["_id"]})["created"] == 10
+
+
+@pytest.mark.parametrize(
+    "campaign,worker,expected",
+    [(None, None, True), (["A"], "", True), (["A"], "A", True), (["A"], ["B"], False), (None, "A", False), (["A"], "__none__", False)],
+)
+def test_category_match(campaign, worker, expected):
+    """Test matching the categories of campaigns and workers"""
+    assert category_match(campaign, worker) is expected
+
+
+def test_worker_refill(manager):
+    """Test the worker materialising fireworks when queried"""
+    from disp.fws.worker import WalltimeAwareFWorker
+
+    manager.create("C2-test", "test", "C2", "#SEED", "PARAM", 25, fw_kwargs={"executable": "castep"}, refill_size=10)
+    worker = WalltimeAwareFWorker("test")
+    assert worker.query
+    assert manager.count_ready("C2-test") == 0
+
+    worker.launchpad = manager.lpad
+    assert worker.query
+    assert manager.count_ready("C2-test") == 10
+    # Not refilled again within the interval
+    manager.lpad.fireworks.delete_many({})
+    assert worker.refill_campaigns() == 0
+    worker.CAMPAIGN_REFILL_INTERVAL = 0
+    assert worker.refill_campaigns() == 10
@@ -138,6 +138,52 @@ BLA
     assert results[0].init_structure_file.content
 
 
+def test_iter_project_records(clean_db, seed, param):
+    """Test retrieving the records of a project in batches"""
+    for i in range(3):
+        clean_db.insert_initial_structure(
+            project_name="test/run1", struct_name=f"C10-TEST-{i}", seed_name="C10", struct_content=f"INIT{i}", seed_content=seed
+        )
+        clean_db.insert_search_record(
+            project_name="test/run1",
+            struct_name=f"C10-TEST-{i}",
+            res_content=f"TITL {i}",
+            param_content=param,
+            seed_name="C10",
+            seed_content=seed,
+        )
+
+    batches = list(
+        clean_db.iter_project_records("test/run1", include_seed=True, include_param=True, include_initial_structure=True, batch_size=2)
+    )
+    assert [len(batch) for batch in batches] == [2, 1]
+    records = sorted(batches[0] + batches[1], key=lambda x: x["struct_name"])
+    assert records[2]["content"] == "TITL 2"
+    assert records[2]["init_structure"] == "INIT2"
+    assert records[0]["seed"] == seed
+    assert records[1]["param"] == param
+
+    records = next(clean_db.iter_project_records("test/run1", additional_filters={"struct_name": "C10-TEST-1"}))
+    assert records == [{"struct_name": "C10-TEST-1", "content": "TITL 1"}]
+
+
+def test_get_enthalpies_per_atom(clean_db, seed, param):
+    """Test obtaining the enthalpies per atom of a project"""
+    for i, seed_name in enumerate(["C10", "C10", "C8"]):
+        clean_db.insert_search_record(
+            project_name="test/run1",
+            struct_name=f"{seed_name}-TEST-{i}",
+            res_content=f"TITL {seed_name}-TEST-{i} 0.0 10.0 {-10.0 * (i + 1)} 0 0 {2 * (i + 1)} (P1) n - 1\nBLA\n",
+            param_content=param,
+            seed_name=seed_name,
+            seed_content=seed + seed_name,
+        )
+
+    assert sorted(clean_db.get_enthalpies_per_atom("test/run1")) == [-5.0, -5.0, -5.0]
+    assert len(clean_db.get_enthalpies_per_atom("test/run1", seed_name="C8")) == 1
+    assert clean_db.get_enthalpies_per_atom("test/run2") == []
+
+
 def test_upoad_dot_castep(clean_db, temp_workdir):
     """Test upload the downloading .castep files"""
     content = "CASTEP 19"
@@ -0,0 +1,92 @@
+"""
+Test draining the worker on the pre-termination signals
+"""
+import os
+import signal
+import subprocess
+import time
+
+import pytest
+
+from disp.fws import drain
+from disp.fws.drain import install_drain_handlers, is_draining
+from disp.fws.launcher import rapidfire
+from disp.fws.tasks import AirssBatchSearchTask, AirssCastepRelaxTask
+
+# pylint: disable=protected-access
+
+
+@pytest.fixture(autouse=True)
+def drain_handlers():
+    """Install the handlers and restore the original ones afterwards"""
+    original = {signum: signal.getsignal(signum) for signum in drain.DRAIN_SIGNALS}
+    drain.reset_drain()
+    install_drain_handlers()
+    yield
+    drain.reset_drain()
+    for signum, handler in original.items():
+        signal.signal(signum, handler)
+
+
+def test_signal_handler():
+    """Test that the signals are recorded"""
+    assert not is_draining()
+    os.kill(os.getpid(), signal.SIGUSR1)
+    assert is_draining()
+
+
+def test_relaxation_stopped(tmp_path, monkeypatch):
+    """Test that a running relaxation is stopped as if it timed out"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "jobscript.sh").write_text("#!/bin/bash\nkill -USR1 $PPID\nsleep 30\n")
+    (tmp_path / "jobscript.sh").chmod(0o755)
+
+    task = AirssCastepRelaxTask(cycles=10, param_content="", executable="castep")
+    task.DRAIN_CHECK_INTERVAL = 0.1
+    task.abort_rules = []
+    task.energy_cutoff = None
+    start = time.monotonic()
+    with open("stdout", "w") as stdout:
+        with pytest.raises(subprocess.TimeoutExpired):
+            task._run_script(stdout, 60, "test")
+    assert time.monotonic() - start < 15
+
+
+def test_batch_stopped(monkeypatch):
+    """Test that the batch search stops and adds the continuation for the remaining structures"""
+    monkeypatch.setattr(drain, "_STATE", {"signum": signal.SIGTERM})
+    task = AirssBatchSearchTask(tasks=[], nstructures=3)
+    action = task.run_task({"timeout": 3600, "project_name": "test", "seed_name": "C2"})
+    assert action.stored_data["nremaining"] == 3
+    assert action.additions[0].tasks[0]["nstructures"] == 3
+
+
+def test_rapidfire_stops(mock_launchpad, tmp_path, monkeypatch):
+    """Test that no new Rockets are launched once draining"""
+
+    def run_exists(fworker):
+        raise AssertionError("Should not look for new Fireworks")
+
+    monkeypatch.setattr(mock_launchpad, "run_exists", run_exists, raising=False)
+    monkeypatch.setattr(mock_launchpad, "get_logdir", lambda: None, raising=False)
+    monkeypatch.setattr(drain, "_STATE", {"signum": signal.SIGTERM})
+    assert rapidfire(mock_launchpad, m_dir=str(tmp_path), nlaunches="infinite") == 0
+
+
+def test_buildcell_pool_stopped(tmp_path, monkeypatch):
+    """Test that the pool process started after installing the handlers exits on SIGTERM"""
+    from disp.buildpool import POOL_ENV_VAR, BuildcellPool
+    from disp.cli.trlaunch import start_buildcell_pool
+
+    def run(self, nworkers):
+        while True:
+            time.sleep(0.1)
+
+    monkeypatch.setattr(BuildcellPool, "run", run)
+    monkeypatch.setenv(POOL_ENV_VAR, "")
+    proc = start_buildcell_pool(tmp_path, 1, 1)
+    time.sleep(0.5)
+    proc.terminate()
+    proc.join(5)
+    assert not proc.is_alive()
+    assert proc.exitcode == -signal.SIGTERM
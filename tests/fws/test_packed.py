@@ -0,0 +1,147 @@
+"""
+Test the packed datastore
+"""
+import fcntl
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from disp.cli.cmd_disp import main
+from disp.fws.packed import PACKED_DIRNAME, PackedDatastore
+from disp.fws.tasks import AirssDataTransferTask
+from disp.fws.utils import DATASTORE_NAME
+
+# pylint: disable=redefined-outer-name, protected-access
+
+
+@pytest.fixture
+def store(tmp_path):
+    """A datastore written by a single worker process"""
+    return PackedDatastore(tmp_path / "project", writer_id="node1-100")
+
+
+def test_put_get(store, tmp_path):
+    """Test storing and fetching the files of structures"""
+    (tmp_path / "C2-1.res").write_text("TITL C2-1")
+    assert store.put("C2-1", {"C2-1.res": tmp_path / "C2-1.res", "C2-1-orig.cell": "CELL"}) == 2
+    PackedDatastore(store.project_path, writer_id="node2-100").put("C2-2", {"C2-2.res": b"TITL C2-2"})
+
+    assert store.list_structures() == ["C2-1", "C2-2"]
+    assert store.list_files("C2-1") == ["C2-1-orig.cell", "C2-1.res"]
+    assert store.get("C2-1", "C2-1.res") == b"TITL C2-1"
+    assert store.get("C2-2", "C2-2.res") == b"TITL C2-2"
+    with pytest.raises(KeyError):
+        store.get("C2-3", "C2-3.res")
+    assert len(store.get_segments()) == 2
+
+    # Files stored again supersede the previous ones
+    store.put("C2-1", {"C2-1.res": "TITL C2-1 NEW"})
+    assert store.get("C2-1", "C2-1.res") == b"TITL C2-1 NEW"
+
+    paths = store.extract("C2-1", tmp_path / "out")
+    assert sorted(path.name for path in paths) == ["C2-1-orig.cell", "C2-1.res"]
+    assert (tmp_path / "out" / "C2-1.res").read_text() == "TITL C2-1 NEW"
+
+
+def test_segment_rollover(tmp_path):
+    """Test starting new segments once the size limit is reached"""
+    store = PackedDatastore(tmp_path, writer_id="node1-100", max_segment_size=100)
+    for idx in range(3):
+        store.put(f"S-{idx}", {f"S-{idx}.res": "x" * 80})
+    assert [path.name for path in store.get_segments()] == [f"node1-100-000{idx}.pack" for idx in range(3)]
+    assert store.get("S-2", "S-2.res") == b"x" * 80
+
+
+def test_corrupted_record(store):
+    """Test that corrupted records are detected"""
+    segment = store.path / "node1-100-0000.pack"
+    store.put("C2-1", {"C2-1.res": "TITL C2-1"})
+    segment.write_bytes(segment.read_bytes()[:-1] + b"X")
+    with pytest.raises(ValueError):
+        store.get("C2-1", "C2-1.res")
+
+
+def test_compact(store, tmp_path):
+    """Test compacting the segments and packing the loose files"""
+    other = PackedDatastore(store.project_path, writer_id="node2-100")
+    store.put("C2-1", {"C2-1.res": "OLD", "C2-1-orig.cell": "CELL"})
+    other.put("C2-1", {"C2-1.res": "NEW"})
+    store.put("C2-2", {"C2-2.res": "TITL C2-2"})
+    (store.project_path / "C2-3.res").write_text("TITL C2-3")
+    (store.project_path / "C2-3_data.tar.gz").write_text("ARCHIVE")
+    (store.project_path / "C2.cell").write_text("SEED")
+
+    # The segment being written to is left alone
+    with open(other.path / "node2-100-0000.pack", "rb") as fhandle:
+        fcntl.flock(fhandle, fcntl.LOCK_EX)
+        stats = store.compact(pack_loose=True)
+    assert stats == {"segments": 1, "kept": 2, "dropped": 1, "loose": 2}
+    assert sorted(os.listdir(store.project_path)) == ["C2.cell", PACKED_DIRNAME]
+
+    reader = PackedDatastore(store.project_path)
+    assert reader.get("C2-1", "C2-1.res") == b"NEW"
+    assert reader.get("C2-1", "C2-1-orig.cell") == b"CELL"
+    assert reader.get("C2-3", "C2-3_data.tar.gz") == b"ARCHIVE"
+    assert reader.list_structures() == ["C2-1", "C2-2", "C2-3"]
+
+    # The writer of a compacted segment starts it again
+    store.put("C2-4", {"C2-4.res": "TITL C2-4"})
+    assert (store.path / "node1-100-0000.pack").is_file()
+    stats = reader.compact()
+    assert stats["segments"] == 3
+    assert stats["kept"] == 6
+    assert len(reader.get_segments()) == 1
+    assert reader.get("C2-4", "C2-4.res") == b"TITL C2-4"
+
+
+def test_compact_concurrent_write(store, monkeypatch):
+    """Test that a write made while the compaction removes the segment is not lost"""
+    store.put("A", {"A.res": "TITL A"})
+    segment = store.path / "node1-100-0000.pack"
+    unlink = Path.unlink
+
+    def unlink_and_write(path, missing_ok=False):
+        unlink(path, missing_ok=missing_ok)
+        if path == segment:
+            # The writer creates the segment again straight away
+            store.put("B", {"B.res": "TITL B"})
+
+    monkeypatch.setattr(Path, "unlink", unlink_and_write)
+    store.compact()
+    monkeypatch.undo()
+
+    reader = PackedDatastore(store.project_path)
+    assert reader.list_structures() == ["A", "B"]
+    assert reader.get("B", "B.res") == b"TITL B"
+    reader.compact()
+    assert reader.list_structures() == ["A", "B"]
+
+
+def test_transfer_task(tmp_path, monkeypatch):
+    """Test transfering the data of a relaxation into the packed datastore"""
+    monkeypatch.chdir(tmp_path)
+    for name in ["C2-TEST.res", "C2-TEST-orig.cell", "C2-TEST.castep", "FW.json", "C2.cell"]:
+        (tmp_path / name).write_text(name)
+    task = AirssDataTransferTask(base_path=str(tmp_path / "base"), keep=True, archive_codec="gzip")
+    task.run_task({"struct_name": "C2-TEST", "project_name": "C2/run1", "seed_name": "C2", "_fw_env": {"datastore": "packed"}})
+
+    project_path = tmp_path / "base" / DATASTORE_NAME / "C2/run1"
+    assert sorted(os.listdir(project_path)) == ["C2.cell", PACKED_DIRNAME]
+    assert not list(tmp_path.glob(".C2-TEST_data*"))
+
+    store = PackedDatastore(project_path)
+    assert store.list_files("C2-TEST") == ["C2-TEST-orig.cell", "C2-TEST.res", "C2-TEST_data.tar.gz"]
+    store.extract("C2-TEST", tmp_path / "out")
+    with tarfile.open(tmp_path / "out" / "C2-TEST_data.tar.gz") as archive:
+        assert len(archive.getnames()) == 4
+
+    runner = CliRunner()
+    output = runner.invoke(main, ["tools", "get-structure", "C2/run1", "--base-path", str(tmp_path / "base")])
+    assert output.exit_code == 0
+    assert "C2-TEST: C2-TEST-orig.cell C2-TEST.res C2-TEST_data.tar.gz" in output.output
+    output = runner.invoke(main, ["tools", "compact-datastore", "C2/run1", "--base-path", str(tmp_path / "base")])
+    assert output.exit_code == 0
+    assert "3 records kept, 0 dropped" in output.output
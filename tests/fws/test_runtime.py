@@ -0,0 +1,115 @@
+"""
+Test the run time model
+"""
+import shutil
+
+import pytest
+
+from disp.fws.bulk import bulk_add_from_template
+from disp.fws.runtime import RuntimeModel, collect_samples, count_atoms, update_ready_fireworks
+from disp.fws.tasks import AirssCastepRelaxTask
+from disp.fws.worker import WalltimeAwareFWorker
+from disp.fws.works import AirssBatchSearchFW, AirssSearchFW, RelaxFW
+
+# pylint: disable=redefined-outer-name
+
+CELL = "%block positions_frac\nC 0 0 0\nC 0.5 0.5 0.5\n%endblock positions_frac\n"
+
+
+def add_launches(lpad, seed_name, step_time, nlaunches, worker="test", batch=False):
+    """Add completed search fireworks and launches with timing data"""
+    if batch:
+        template = AirssBatchSearchFW("test", seed_name, "#SEED", "PARAM", "castep", 2)
+    else:
+        template = AirssSearchFW("test", seed_name, "#SEED", "PARAM", "castep")
+    fw_ids = bulk_add_from_template(lpad, template, [(f"{seed_name}-{idx}", None, None) for idx in range(nlaunches)])
+    for idx, fw_id in enumerate(fw_ids):
+        steps = 50 + idx
+        natoms = 4 if seed_name == "C4" else 8
+        timing = {"avg_ionic_time": step_time, "ionic_steps": steps, "total_time": step_time * steps, "natoms": natoms}
+        stored_data = {"structures": [{"timing": timing}]} if batch else {"timing": timing}
+        lpad.launches.insert_one(
+            {
+                "fw_id": fw_id,
+                "state": "COMPLETED",
+                "runtime_secs": step_time * steps + 20,
+                "fworker": {"name": worker},
+                "action": {"stored_data": stored_data},
+            }
+        )
+
+
+def test_timing_data(datapath, tmp_path, monkeypatch):
+    """Test recording the timing of a relaxation"""
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(datapath / "LFO.castep", "LFO.castep")
+    task = AirssCastepRelaxTask(cycles=100, param_content="", executable="castep")
+    task.struct_name = "LFO"
+    timing = task._get_timing_data()["timing"]  # pylint: disable=protected-access
+    assert timing["natoms"] == 5
+    assert timing["ionic_steps"] > 0
+    task.struct_name = "foo"
+    assert task._get_timing_data() == {}  # pylint: disable=protected-access
+
+
+def test_runtime_model(mock_launchpad):
+    """Test fitting the model and updating the READY fireworks"""
+    add_launches(mock_launchpad, "C4", 10.0, 6, worker="fast")
+    add_launches(mock_launchpad, "C8", 40.0, 6, worker="slow", batch=True)
+    # Timed out relaxations have truncated steps and are not used
+    launch = mock_launchpad.launches.find_one({"action.stored_data.timing": {"$exists": True}}, {"_id": 0})
+    launch["action"]["stored_data"]["relax_status"] = "TIMEDOUT"
+    mock_launchpad.launches.insert_one(launch)
+    # Continuations only run the remaining steps and are not used either
+    continuation = RelaxFW("test", "C4-0", CELL, "PARAM", "castep", "C4", existing_spec={"launch_count": 1})
+    (fw_id,) = bulk_add_from_template(mock_launchpad, continuation, [("C4-0-relax", None, None)])
+    launch = {key: value for key, value in launch.items() if key != "_id"}
+    launch["fw_id"] = fw_id
+    launch["action"]["stored_data"]["relax_status"] = "FINISHED"
+    mock_launchpad.launches.insert_one(launch)
+    mock_launchpad.fireworks.update_many({}, {"$set": {"state": "COMPLETED"}})
+
+    samples = collect_samples(mock_launchpad)
+    assert len(samples) == 12
+    model = RuntimeModel.fit(samples, percentile=50)
+    assert model.predict("C4", "castep") == pytest.approx(20 + 52.5 * 10)
+    assert model.predict("C4", "castep", cycles=10) == pytest.approx(120)
+    assert model.predict("C8", "castep") == pytest.approx(52.5 * 40)
+    assert model.predict("C2", "castep") is None
+    # The time per step of an unknown seed follows from the number of atoms
+    assert model.predict("C2", "castep", natoms=2) < model.predict("C4", "castep")
+    assert model.worker_factors == {"fast": 1.0, "slow": 1.0}
+
+    model.save(mock_launchpad)
+    model = RuntimeModel.load(mock_launchpad)
+    assert model.predict("C4", "castep") == pytest.approx(545)
+
+    bulk_add_from_template(mock_launchpad, AirssSearchFW("test", "C4", "#SEED", "PARAM", "castep"), [("C4-new", None, None)])
+    template = RelaxFW("test", "S", CELL, "PARAM", "castep", "C2")
+    bulk_add_from_template(mock_launchpad, template, [("S-relax", None, None)])
+    assert update_ready_fireworks(mock_launchpad, model, margin=2.0) == 2
+    spec = mock_launchpad.fireworks.find_one({"name": "C4-new"})["spec"]
+    assert spec["_expected_runtime"] == 545
+    assert spec["_walltime_seconds"] == 1090
+    assert mock_launchpad.fireworks.find_one({"name": "S-relax"})["spec"]["_expected_runtime"] > 0
+
+
+def test_worker_runtime_factor(mock_launchpad):
+    """Test scaling the walltime by the speed of the worker"""
+    RuntimeModel(worker_factors={"slow": 2.0}).save(mock_launchpad)
+    worker = WalltimeAwareFWorker("slow")
+    assert worker.runtime_factor == 1.0
+    worker = WalltimeAwareFWorker("slow")
+    worker.launchpad = mock_launchpad
+    assert worker.runtime_factor == 2.0
+    condition = worker.get_walltime_condition(seconds_left=1060)
+    assert condition["$and"][0]["$or"][1]["spec._walltime_seconds"]["$lt"] == 500
+    assert condition["$and"][1]["$or"][1]["spec._minimum_run_time"]["$lte"] == 500
+    assert WalltimeAwareFWorker("fast", env={"runtime_factor": 0.5}).runtime_factor == 0.5
+
+
+def test_count_atoms():
+    """Test counting the atoms in a cell"""
+    assert count_atoms(CELL) == 2
+    assert count_atoms("") is None
+    assert count_atoms({"_blob": "abc"}) is None
@@ -0,0 +1,128 @@
+"""
+Test matching the queued array jobs to the backlog
+"""
+import pytest
+
+from disp.fws.bulk import bulk_add_from_template
+from disp.fws.campaign import CAMPAIGN_COLLECTION
+from disp.fws.scaling import ArrayScaler
+from disp.fws.worker import WalltimeAwareFWorker
+from disp.fws.works import RelaxFW
+from disp.scheduler import SimulatedSlurmQueue, Slurm
+
+# pylint: disable=redefined-outer-name
+
+
+class FakeSlurm:
+    """Slurm with a fixed queue, recording the actions"""
+
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.held = []
+        self.released = []
+        self.submitted = []
+
+    def get_array_tasks(self, user_name=None, job_name=None):
+        return self.tasks
+
+    def hold_tasks(self, tasks):
+        self.held.extend(f"{task['array_id']}_{task['task_id']}" for task in tasks)
+
+    def release_tasks(self, tasks):
+        self.released.extend(f"{task['array_id']}_{task['task_id']}" for task in tasks)
+
+    def submit_array(self, script, ntasks, job_name=None):
+        self.submitted.append((script, ntasks, job_name))
+        return "300"
+
+
+def queue(running=0, pending=0, held=0):
+    """Construct the array tasks in the queue"""
+    tasks = [{"array_id": "100", "task_id": str(idx), "state": "R", "held": False} for idx in range(running)]
+    tasks += [{"array_id": "100", "task_id": str(idx), "state": "PD", "held": False} for idx in range(running, running + pending)]
+    tasks += [{"array_id": "200", "task_id": str(idx), "state": "PD", "held": True} for idx in range(held)]
+    return tasks
+
+
+@pytest.fixture
+def backlog(mock_launchpad):
+    """Add fireworks of two categories and a campaign"""
+    for category, count, priority in [("relax", 25, 10), ("other", 40, 10), ("relax", 5, 1)]:
+        template = RelaxFW("test", "S", "CELL", "PARAM", "castep", "C2", existing_spec={"_category": category, "_priority": priority})
+        bulk_add_from_template(mock_launchpad, template, [(f"S-{idx}", None, None) for idx in range(count)])
+    mock_launchpad.db[CAMPAIGN_COLLECTION].insert_one(
+        {"name": "camp", "state": "ACTIVE", "category": ["relax"], "priority": 10, "created": 20, "target": 50, "batch_size": 3}
+    )
+    return mock_launchpad
+
+
+def get_scaler(lpad, tasks, **kwargs):
+    """Construct the scaler for the relax category"""
+    return ArrayScaler(lpad, FakeSlurm(tasks), WalltimeAwareFWorker("test", category="relax"), "disp-relax", **kwargs)
+
+
+def test_count_backlog(backlog):
+    """Test counting the READY fireworks and the campaign structures"""
+    assert get_scaler(backlog, []).count_backlog() == {10: 35, 1: 5}
+    assert get_scaler(backlog, [], min_priority=5).count_backlog() == {10: 35}
+
+
+@pytest.mark.parametrize(
+    "tasks,hold,release,submit",
+    [
+        (queue(running=4, pending=2), ["100_5", "100_4"], [], 0),
+        (queue(running=2, pending=5), ["100_6", "100_5", "100_4"], [], 0),
+        (queue(running=5, pending=1), ["100_5"], [], 0),
+        (queue(running=2, pending=2, held=3), [], [], 0),
+        (queue(running=1, pending=1, held=3), [], ["200_0", "200_1"], 0),
+        (queue(running=3, held=100), [], ["200_0"], 0),
+        (queue(running=1, held=1), [], ["200_0"], 2),
+    ],
+)
+def test_step(backlog, tasks, hold, release, submit):
+    """Test holding, releasing and submitting array tasks for the 4 jobs wanted"""
+    scaler = get_scaler(backlog, tasks, submit_script="job.sh")
+    _, _, actions = scaler.step()
+    assert actions["wanted"] == 4
+    assert scaler.scheduler.held == hold
+    assert scaler.scheduler.released == release
+    assert scaler.scheduler.submitted == ([("job.sh", submit, "disp-relax")] if submit else [])
+
+
+def test_step_dryrun(backlog):
+    """Test that nothing is changed in dryrun mode"""
+    scaler = get_scaler(backlog, queue(held=2), max_jobs=1)
+    _, queued, actions = scaler.step(dryrun=True)
+    assert queued["held_tasks"] == queue(held=2)
+    assert actions == {"wanted": 1, "hold": [], "release": queue(held=1), "submit": 0}
+    assert not scaler.scheduler.released
+
+
+def test_step_max_jobs(backlog):
+    """Test that the tasks released and submitted do not exceed the maximum number of jobs"""
+    scaler = get_scaler(backlog, queue(running=1, held=10), max_jobs=3, submit_script="job.sh")
+    _, _, actions = scaler.step()
+    assert actions["wanted"] == 3
+    assert scaler.scheduler.released == ["200_0", "200_1"]
+    assert not scaler.scheduler.submitted
+
+
+def test_simulated_queue(backlog, tmp_path, monkeypatch):
+    """Test controlling the arrays of the simulated SLURM queue"""
+    monkeypatch.setenv("USER", "user")
+    now = [1.0e9]
+    slurm = Slurm(runner=SimulatedSlurmQueue(tmp_path / "queue.json", max_running=2, walltime=100, clock=lambda: now[0]))
+    scaler = ArrayScaler(backlog, slurm, WalltimeAwareFWorker("test", category="relax"), "disp-relax", submit_script="job.sh")
+    _, _, actions = scaler.step()
+    assert actions["submit"] == 4
+    queued = scaler.get_queue()
+    assert (queued["running"], queued["pending"], queued["held"]) == (2, 2, 0)
+    assert [(task["array_id"], task["task_id"]) for task in queued["pending_tasks"]] == [("1000", "2"), ("1000", "3")]
+
+    # The backlog is cleared while the first jobs run
+    backlog.fireworks.update_many({}, {"$set": {"state": "COMPLETED"}})
+    backlog.db[CAMPAIGN_COLLECTION].update_many({}, {"$set": {"state": "COMPLETED"}})
+    _, _, actions = scaler.step()
+    assert [task["task_id"] for task in actions["hold"]] == ["3", "2"]
+    now[0] += 200
+    assert scaler.get_queue()["held"] == 2
@@ -9,11 +9,13 @@ import tarfile
 from pathlib import Path
 
 import pytest
-from fireworks.core.firework import Firework, Workflow
+from fireworks import explicit_serialize
+from fireworks.core.firework import Firework, FiretaskBase, FWAction, Workflow
 from fireworks.core.fworker import FWorker
 from fireworks.core.rocket_launcher import launch_rocket
 
 from disp.fws.tasks import (
+    AirssBatchSearchTask,
     AirssBuildcellTask,
     AirssCastepRelaxTask,
     AirssGulpRelaxTask,
@@ -22,8 +24,9 @@ from disp.fws.tasks import (
     CastepSinglepointTask,
     DbRecordTask,
     RelaxOutcome,
+    scratch_directory,
 )
-from disp.fws.utility_tasks import CleanDir
+from disp.fws.utility_tasks import CleanDir, get_archive_codec, gzip_dir, write_archive
 from disp.scheduler import Dummy
 
 # pylint: disable=redefined-outer-name, too-many-instance-attributes, import-outside-toplevel, unused-argument, protected-access
@@ -341,8 +344,11 @@ def test_data_transfer(clean_launchpad, temp_workdir):
     ftmp = fman.get_project_path("tests/c2/run2")
 
     assert (ftmp / "C2-TEST.castep").is_file()
-    assert (ftmp / "C2-TEST_data.tar.gz").is_file()
-    with tarfile.open(ftmp / "C2-TEST_data.tar.gz", mode="r:gz") as archive:
+    archives = list(ftmp.glob("C2-TEST_data.tar.*"))
+    assert [path.name for path in archives] == ["C2-TEST_data" + {"zstd": ".tar.zst"}.get(get_archive_codec(), ".tar.gz")]
+    if archives[0].suffix == ".zst":
+        return
+    with tarfile.open(archives[0], mode="r:gz") as archive:
         objs = archive.getmembers()
         assert len(objs) == 5
 
@@ -623,6 +629,32 @@ def test_castep_relax_script(clean_launchpad, temp_workdir, get_data_dir):
     assert content[2] == "module load essential"
     assert content[3] == "echo Current PATH: $PATH"
     assert content[4] == "'castep_relax' '100' 'mpirun -np 2 castep.mpi' '0' '0' 'C2-TEST'"
+    assert os.access(btask.run_script_name, os.X_OK)
+
+
+def test_scratch_directory(tmp_path, monkeypatch):
+    """Test running in the scratch directory and copying back the outputs"""
+    launch_dir = tmp_path / "launch"
+    launch_dir.mkdir()
+    monkeypatch.chdir(launch_dir)
+    (launch_dir / "C2.cell").write_text("CELL")
+    (launch_dir / "C2.param").write_text("PARAM")
+
+    with scratch_directory(tmp_path / "scratch", exclude_suffixes=[".check"]) as workdir:
+        assert Path.cwd() == workdir
+        assert (workdir / "C2.cell").read_text() == "CELL"
+        (workdir / "C2.cell").write_text("CELL-OUT")
+        (workdir / "C2.castep").write_text("OUTPUT")
+        (workdir / "C2.check").write_text("BINARY")
+        # Not touched - should not be copied back
+        (launch_dir / "C2.param").write_text("PARAM-NEW")
+
+    assert Path.cwd() == launch_dir
+    assert not workdir.exists()
+    assert (launch_dir / "C2.cell").read_text() == "CELL-OUT"
+    assert (launch_dir / "C2.castep").read_text() == "OUTPUT"
+    assert (launch_dir / "C2.param").read_text() == "PARAM-NEW"
+    assert not (launch_dir / "C2.check").exists()
 
 
 @need_castep
@@ -668,3 +700,155 @@ def test_castep_timeout(clean_db, clean_launchpad, temp_workdir, get_data_dir, d
     Dummy.DEFAULT_REMAINING_TIME = 9999
     AirssCastepRelaxTask.MINIMUM_RUN_TIME = 600
     AirssCastepRelaxTask.SCHEDULER_TIME_OFFSET = 60
+
+
+@explicit_serialize
+class FakeBuildTask(FiretaskBase):
+    """Pretend to build a structure"""
+
+    def run_task(self, fw_spec):
+        struct_name = f"S-{len(list(Path('..').glob('structure-*')))}"
+        Path(struct_name + ".cell").write_text("cell")
+        return FWAction(update_spec={"struct_name": struct_name}, stored_data={"struct_name": struct_name})
+
+
+@explicit_serialize
+class FakeRelaxTask(FiretaskBase):
+    """Pretend to relax a structure, times out for the structure named in the spec"""
+
+    optional_params = ["sleep"]
+
+    def run_task(self, fw_spec):
+        import time
+
+        time.sleep(self.get("sleep", 0))
+        if fw_spec["struct_name"] == fw_spec.get("timeout_struct"):
+            return FWAction(stored_data={"relax_status": "TIMEDOUT"}, detours=[Firework([FakeRelaxTask()])])
+        return FWAction(stored_data={"relax_status": "FINISHED"})
+
+
+def test_batch_search_task(tmp_path, monkeypatch):
+    """Test running multiple structures in a single task"""
+    monkeypatch.chdir(tmp_path)
+    task = AirssBatchSearchTask(tasks=[FakeBuildTask(), FakeRelaxTask()], nstructures=3, minimum_run_time=0.3)
+    action = task.run_task({"timeout": 1000, "timeout_struct": "S-2", "project_name": "test", "seed_name": "C"})
+    results = action.stored_data["structures"]
+    assert [res["struct_name"] for res in results] == ["S-1", "S-2", "S-3"]
+    assert [res["relax_status"] for res in results] == ["FINISHED", "TIMEDOUT", "FINISHED"]
+    assert (tmp_path / "structure-0002/S-3.cell").is_file()
+    # The continuation of the timed out relaxation is added
+    assert len(action.additions) == 1
+    assert action.stored_data["nremaining"] == 0
+
+    # Not enough time for all structures - the remaining ones are continued
+    monkeypatch.chdir(tmp_path / "structure-0000")
+    task = AirssBatchSearchTask(tasks=[FakeBuildTask(), FakeRelaxTask(sleep=0.3)], nstructures=3, minimum_run_time=0.3)
+    action = task.run_task({"timeout": task.SCHEDULER_TIME_OFFSET + 0.5, "project_name": "test", "_priority": 5, "struct_name": "X"})
+    assert action.stored_data["nfinished"] == 1
+    assert action.stored_data["nremaining"] == 2
+    continuation = action.additions[0]
+    assert continuation.tasks[0]["nstructures"] == 2
+    assert continuation.tasks[0]["minimum_run_time"] == 0.3
+    assert continuation.spec == {"project_name": "test", "_priority": 5}
+
+
+@explicit_serialize
+class FailingBuildTask(FiretaskBase):
+    """Pretend to fail building a structure, either by raising or by asking to stop"""
+
+    optional_params = ["stop_at"]
+
+    def run_task(self, fw_spec):
+        index = len(list(Path("..").glob("structure-*")))
+        if self.get("stop_at") is None:
+            raise RuntimeError("buildcell is missing")
+        if index == self["stop_at"]:
+            return FWAction(defuse_children=True, stored_data={"message": "timedout"})
+        return FWAction(update_spec={"struct_name": f"S-{index}"}, stored_data={"struct_name": f"S-{index}"})
+
+
+@explicit_serialize
+class InsufficientTimeRelaxTask(FiretaskBase):
+    """Run the insufficient time handler of the CASTEP relaxation task"""
+
+    def run_task(self, fw_spec):
+        relax = AirssCastepRelaxTask(param_content="PARAM", cycles=10, executable="castep")
+        relax._init_parameters(fw_spec)
+        Path(relax.struct_name + ".cell").write_text("CELL")
+        action = relax._handle_insufficient_run_time(fw_spec)
+        action.stored_data["timeout"] = relax.timeout
+        return action
+
+
+def test_batch_search_stopped(tmp_path, monkeypatch):
+    """Test the structures skipped after stopping and the batch where all structures fail"""
+    monkeypatch.chdir(tmp_path)
+    task = AirssBatchSearchTask(tasks=[FailingBuildTask(stop_at=3), FakeRelaxTask()], nstructures=5, minimum_run_time=0)
+    action = task.run_task({"timeout": 1000, "project_name": "test", "seed_name": "C"})
+    assert action.stored_data["nfinished"] == 3
+    assert action.stored_data["nskipped"] == 2
+    assert action.stored_data["nremaining"] == 0
+    assert not action.additions
+
+    monkeypatch.chdir(tmp_path / "structure-0000")
+    task = AirssBatchSearchTask(tasks=[FailingBuildTask(), FakeRelaxTask()], nstructures=3, minimum_run_time=0)
+    with pytest.raises(RuntimeError, match="All 3 structures"):
+        task.run_task({"timeout": 1000, "project_name": "test", "seed_name": "C"})
+
+
+def test_batch_search_detour_spec(tmp_path, monkeypatch):
+    """Test that the remaining time of the batch is not passed on to the detours"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Dummy, "DEFAULT_REMAINING_TIME", 5000)
+    task = AirssBatchSearchTask(tasks=[FakeBuildTask(), InsufficientTimeRelaxTask()], nstructures=1, minimum_run_time=0)
+    action = task.run_task({"project_name": "test", "seed_name": "C", "struct_content": "CELL"})
+    result = action.stored_data["structures"][0]
+    assert 4000 < result["timeout"] <= 5000
+    detour = action.additions[0]
+    assert "timeout" not in detour.spec
+    assert AirssBatchSearchTask.TIMEOUT_KEY not in detour.spec
+
+
+@pytest.mark.parametrize("codec", ["zstd", "pigz", "gzip"])
+def test_write_archive(tmp_path, monkeypatch, codec):
+    """Test streaming the files into a compressed archive"""
+    if codec != "gzip" and not has_exe(codec):
+        pytest.skip(f"{codec} is not available")
+    monkeypatch.chdir(tmp_path)
+    Path("C2-TEST.castep").write_text("OUTPUT\n" * 1000)
+    Path("FW.json").write_text("{}")
+    destination = write_archive(
+        tmp_path / "C2-TEST_data", [(Path(name), Path("C2-TEST_data") / name) for name in ["C2-TEST.castep", "FW.json"]], codec=codec
+    )
+    assert destination.name == "C2-TEST_data" + (".tar.zst" if codec == "zstd" else ".tar.gz")
+    assert not list(tmp_path.glob("*.part"))
+    if codec == "zstd":
+        subprocess.run(["zstd", "-d", "-q", str(destination), "-o", "archive.tar"], check=True)
+        archive = tarfile.open("archive.tar")
+    else:
+        archive = tarfile.open(destination, mode="r:gz")
+    with archive:
+        assert archive.getnames() == ["C2-TEST_data/C2-TEST.castep", "C2-TEST_data/FW.json"]
+        assert archive.extractfile("C2-TEST_data/C2-TEST.castep").read() == b"OUTPUT\n" * 1000
+
+
+@pytest.mark.parametrize("codec", ["zstd", "pigz", "gzip"])
+def test_write_archive_error(tmp_path, monkeypatch, codec):
+    """Test that no partial archive is left when writing fails"""
+    if codec != "gzip" and not has_exe(codec):
+        pytest.skip(f"{codec} is not available")
+    monkeypatch.chdir(tmp_path)
+    Path("FW.json").write_text("{}")
+    with pytest.raises(FileNotFoundError):
+        write_archive(tmp_path / "C2-TEST_data", [(Path("FW.json"), "FW.json"), (Path("C2-TEST.castep"), "C2-TEST.castep")], codec=codec)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["FW.json"]
+
+
+def test_gzip_dir(tmp_path):
+    """Test compressing the files in a directory"""
+    for name in ["C2.castep", "C2.check", "C2-data.tar.zst", "C2.res.gz"]:
+        (tmp_path / name).write_text(name)
+    (tmp_path / "sub").mkdir()
+    gzip_dir(tmp_path, threads=2)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["C2-data.tar.zst", "C2.castep.gz", "C2.check.gz", "C2.res.gz", "sub"]
+    assert (tmp_path / "C2-data.tar.zst").read_text() == "C2-data.tar.zst"
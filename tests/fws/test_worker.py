@@ -0,0 +1,198 @@
+"""
+Test the walltime aware worker
+"""
+import pytest
+
+from disp.fws.bulk import bulk_add_from_template
+from disp.fws.launcher import find_fitting_firework, pack_launch, rapidfire
+from disp.fws.worker import WalltimeAwareFWorker
+from disp.fws.works import AirssBatchSearchFW, RelaxFW, get_ncores
+
+# pylint: disable=redefined-outer-name
+
+
+class FakeScheduler:
+    """Scheduler with a fixed remaining time"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_remaining_seconds(self):
+        return self.seconds
+
+
+@pytest.fixture
+def worker():
+    """A worker not refilling any campaigns"""
+    fworker = WalltimeAwareFWorker("test")
+    fworker.scheduler = FakeScheduler(3600)
+    return fworker
+
+
+def add_relax(lpad, code="castep", count=2):
+    """Add relaxation fireworks"""
+    template = RelaxFW("test", "S", "CELL", "PARAM", "castep", "C2", code=code, walltime_seconds=60)
+    return bulk_add_from_template(lpad, template, [(f"S-{idx}", None, None) for idx in range(count)])
+
+
+def test_minimum_run_time_spec():
+    """Test the minimum run times recorded in the spec"""
+    assert RelaxFW("test", "S", "CELL", "PARAM", "castep", "C2").spec["_minimum_run_time"] == 660
+    assert RelaxFW("test", "S", "CELL", "PARAM", "gulp", "C2", code="gulp").spec["_minimum_run_time"] == 20
+    batch = AirssBatchSearchFW("test", "C2", "#SEED", "PARAM", "castep", 4, minimum_run_time=1200)
+    assert batch.spec["_minimum_run_time"] == 1260
+
+
+def test_walltime_condition(worker, mock_launchpad):
+    """Test selecting the fireworks fitting into the remaining time"""
+    add_relax(mock_launchpad)
+    add_relax(mock_launchpad, code="gulp")
+
+    def count():
+        return mock_launchpad.fireworks.count_documents({"$and": [worker.base_query, worker.get_walltime_condition()]})
+
+    assert count() == 4
+    assert not worker.is_out_of_time(mock_launchpad)
+    worker.scheduler.seconds = 600
+    assert count() == 2
+    assert not worker.is_out_of_time(mock_launchpad)
+
+    mock_launchpad.fireworks.update_many({"spec._minimum_run_time": 20}, {"$set": {"state": "COMPLETED"}})
+    assert worker.is_out_of_time(mock_launchpad)
+    worker.scheduler.seconds = 3600
+    assert not worker.is_out_of_time(mock_launchpad)
+    mock_launchpad.fireworks.update_many({}, {"$set": {"state": "COMPLETED"}})
+    assert not worker.is_out_of_time(mock_launchpad)
+
+
+def test_rapidfire_exits(worker, mock_launchpad, tmp_path, monkeypatch):
+    """Test that rapidfire exits without sleeping if nothing fits into the remaining time"""
+
+    def run_exists(fworker):
+        return mock_launchpad.fireworks.count_documents({"$and": [fworker.query, {"state": "READY"}]}) > 0
+
+    def sleep(seconds):
+        raise AssertionError(f"Should not sleep for {seconds} seconds")
+
+    monkeypatch.setattr(mock_launchpad, "run_exists", run_exists, raising=False)
+    monkeypatch.setattr(mock_launchpad, "get_logdir", lambda: None, raising=False)
+    monkeypatch.setattr("disp.fws.launcher.time.sleep", sleep)
+    add_relax(mock_launchpad)
+    worker.scheduler.seconds = 600
+    assert rapidfire(mock_launchpad, worker, m_dir=str(tmp_path), nlaunches="infinite") == 0
+
+
+@pytest.mark.parametrize(
+    "executable,ncores",
+    [
+        ("mpirun -np 16 castep.mpi", 16),
+        ("mpirun -np16 castep.mpi", 16),
+        ("srun -N1 -n32 --exclusive --mem-per-cpu=1600M castep.mpi", 32),
+        ("srun --ntasks=8 castep.mpi", 8),
+        ("mpirun castep.mpi", None),
+        ("/opt/bin/srun castep.mpi", None),
+        ("castep.serial", 1),
+        ("ggulp", 1),
+    ],
+)
+def test_get_ncores(executable, ncores):
+    """Test parsing the number of cores from the launcher"""
+    assert get_ncores(executable) == ncores
+
+
+def test_find_fitting_firework(worker, mock_launchpad):
+    """Test picking fireworks by the number of cores"""
+    wide = RelaxFW("test", "S", "CELL", "PARAM", "mpirun -np 16 castep.mpi", "C2", existing_spec={"_priority": 5})
+    bulk_add_from_template(mock_launchpad, wide, [("wide", None, None)])
+    narrow = RelaxFW("test", "S", "CELL", "PARAM", "ggulp", "C2", code="gulp")
+    bulk_add_from_template(mock_launchpad, narrow, [(f"narrow-{idx}", None, None) for idx in range(2)])
+    assert mock_launchpad.fireworks.find_one({"name": "wide"})["spec"]["_ncores"] == 16
+
+    # Larger than the node, but the node is free
+    assert find_fitting_firework(mock_launchpad, worker, 8, 8) == (1, 8)
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8) == (2, 1)
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8, exclude=[2]) == (3, 1)
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8, exclude=[2, 3]) == (None, 0)
+
+    # Without a count given to the launcher the whole node is reserved
+    unknown = RelaxFW("test", "S", "CELL", "PARAM", "mpirun castep.mpi", "C2")
+    assert "_ncores" not in unknown.spec
+    bulk_add_from_template(mock_launchpad, unknown, [("unknown", None, None)])
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8, exclude=[2, 3]) == (None, 0)
+    assert find_fitting_firework(mock_launchpad, worker, 8, 8, exclude=[1, 2, 3]) == (4, 8)
+
+
+def test_worker_ncores(worker, mock_launchpad, monkeypatch):
+    """Test resolving the cores from the command line run by the worker"""
+    monkeypatch.delenv("MPI_LAUNCH_CMD", raising=False)
+    wide = RelaxFW("test", "S", "CELL", "PARAM", "mpirun -np 8 castep.mpi", "C2", castep_code="fast", existing_spec={"_priority": 5})
+    bulk_add_from_template(mock_launchpad, wide, [("wide", None, None)])
+    batch = AirssBatchSearchFW("test", "C2", "SEED", "PARAM", "mpirun -np 2 castep.mpi", nstructures=2)
+    bulk_add_from_template(mock_launchpad, batch, [("batch", None, None)])
+    narrow = RelaxFW("test", "S", "CELL", "PARAM", "ggulp", "C2", code="gulp")
+    bulk_add_from_template(mock_launchpad, narrow, [("narrow", None, None)])
+
+    # The launcher of the worker takes the whole allocation
+    monkeypatch.setenv("MPI_LAUNCH_CMD", "srun")
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8) == (3, 1)
+    assert find_fitting_firework(mock_launchpad, worker, 8, 8) == (1, 8)
+    monkeypatch.setenv("MPI_LAUNCH_CMD", "mpirun -np 4")
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8) == (1, 4)
+    monkeypatch.delenv("MPI_LAUNCH_CMD")
+
+    # Executables of the worker env
+    worker.env = {"castep_codes": {"fast": "mpirun -np 3 castep.mpi"}}
+    assert find_fitting_firework(mock_launchpad, worker, 3, 8) == (1, 3)
+    worker.env = {"castep_executable": "mpirun -np 6 castep.mpi"}
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8) == (3, 1)
+    assert find_fitting_firework(mock_launchpad, worker, 6, 8, exclude=[1, 3]) == (2, 6)
+
+    # Counts given explicitly
+    worker.env = {"ncores": {"fast": 2, "castep": 5, "gulp": 4}}
+    assert find_fitting_firework(mock_launchpad, worker, 2, 8) == (1, 2)
+    assert find_fitting_firework(mock_launchpad, worker, 4, 8, exclude=[1]) == (3, 4)
+    assert find_fitting_firework(mock_launchpad, worker, 5, 8, exclude=[1]) == (2, 5)
+
+
+def test_pack_launch(worker, mock_launchpad, tmp_path, monkeypatch):
+    """Test filling the cores of the node"""
+
+    class FakeProcess:
+        """Process finishing after being polled a few times"""
+
+        def __init__(self, fw_id):
+            self.fw_id = fw_id
+            self.polls = 0
+
+        def is_alive(self):
+            self.polls += 1
+            if self.polls > 2:
+                mock_launchpad.fireworks.update_one({"fw_id": self.fw_id}, {"$set": {"state": "COMPLETED"}})
+                return False
+            return True
+
+        def join(self):
+            pass
+
+    started = []
+
+    def start_rocket(launchpad, fworker, fw_id, *args):
+        nrunning = sum(1 for proc in started if proc.polls <= 2)
+        started.append(FakeProcess(fw_id))
+        started[-1].nrunning = nrunning
+        return started[-1]
+
+    monkeypatch.setattr("disp.fws.launcher._start_rocket", start_rocket)
+    monkeypatch.setattr("disp.fws.launcher.time.sleep", lambda seconds: None)
+    monkeypatch.setattr(mock_launchpad, "get_logdir", lambda: None, raising=False)
+    monkeypatch.setattr(mock_launchpad, "future_run_exists", lambda fworker: False, raising=False)
+    wide = RelaxFW("test", "S", "CELL", "PARAM", "mpirun -np 6 castep.mpi", "C2", existing_spec={"_priority": 5})
+    bulk_add_from_template(mock_launchpad, wide, [("wide", None, None)])
+    narrow = RelaxFW("test", "S", "CELL", "PARAM", "mpirun -np 2 castep.mpi", "C2")
+    bulk_add_from_template(mock_launchpad, narrow, [(f"narrow-{idx}", None, None) for idx in range(3)])
+
+    assert pack_launch(mock_launchpad, worker, 8, m_dir=str(tmp_path)) == 4
+    assert [proc.fw_id for proc in started] == [1, 2, 3, 4]
+    # A narrow job runs alongside the wide one
+    assert started[1].nrunning == 1
+    assert mock_launchpad.fireworks.count_documents({"state": "COMPLETED"}) == 4
@@ -0,0 +1,142 @@
+"""
+Tests for the airssutils module
+"""
+import tarfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from disp.analysis.airssutils import RESCollection, RESFile, _format_fixed, collect_res_in_df, format_res_entries
+
+# pylint: disable=redefined-outer-name
+
+RES_PATH = Path(__file__).parent / "db_test/data/2L2FS/2L2FS-200625-100846-0e5188.res"
+
+
+@pytest.fixture
+def packed_res(tmp_path):
+    """A packed file containing three SHELX entries"""
+    packed = tmp_path / "packed.res"
+    packed.write_text(RES_PATH.read_text() * 3)
+    return packed
+
+
+def test_collection_from_packed(packed_res):
+    """Test constructing RESCollection from a packed file"""
+    coll = RESCollection.from_packed(packed_res)
+    res = RESFile.from_file(RES_PATH)
+    assert len(coll) == 3
+    assert coll.natoms.tolist() == [16, 16, 16]
+    assert coll.data["enthalpy"][0] == res.enthalpy
+
+    view = coll[1]
+    assert view.label == res.label
+    assert view.spins == res.spins
+    assert view.rem == res.rem
+    assert np.allclose(view.structure.lattice.matrix, res.structure.lattice.matrix)
+    assert np.allclose(view.structure.frac_coords, res.structure.frac_coords)
+
+    # Construct from RESFile objects should give the same arrays
+    other = RESCollection.from_res_files([res, res, res])
+    assert np.allclose(other.positions, coll.positions)
+    assert np.all(other.symbols[other.species] == coll.symbols[coll.species])
+
+
+def test_collection_slicing(packed_res):
+    """Test selection of the structures"""
+    coll = RESCollection.from_packed(packed_res)
+    sliced = coll[1:]
+    assert len(sliced) == 2
+    assert np.shares_memory(sliced.positions, coll.positions)
+    assert sliced.offsets.tolist() == [0, 16, 32]
+
+    taken = coll[[2, 0]]
+    assert len(taken) == 2
+    assert np.allclose(taken.positions, coll.positions[:32])
+    assert len(coll[np.array([True, False, True])]) == 2
+    assert len(coll[::2]) == 2
+
+
+@pytest.mark.parametrize("mmap_mode", [None, "r"])
+def test_collection_save_load(packed_res, tmp_path, mmap_mode):
+    """Test saving and loading the collection"""
+    coll = RESCollection.from_packed(packed_res)
+    fname = tmp_path / "collection.npz"
+    coll.save(fname)
+    loaded = RESCollection.load(fname, mmap_mode=mmap_mode)
+    assert len(loaded) == 3
+    assert np.allclose(loaded.positions, coll.positions)
+    assert loaded[2].rem == coll[2].rem
+    assert loaded[2].label == coll[2].label
+
+
+def test_collection_dataframe(packed_res):
+    """Test collecting RESCollection into a dataframe"""
+    coll = RESCollection.from_packed(packed_res)
+    dframe = collect_res_in_df(coll)
+    assert "res" not in dframe.columns
+    assert dframe["res_index"].tolist() == [0, 1, 2]
+    assert dframe["reduced_formula"].iloc[0] == "Li2FeSiO4"
+    assert dframe["nform"].iloc[0] == 2
+    assert dframe["H"].iloc[0] == pytest.approx(coll.data["enthalpy"][0] / 16)
+
+
+def test_format_res_entries(packed_res):
+    """Test the vectorised SHELX writer against RESFile.to_res_lines"""
+    res = RESFile.from_file(RES_PATH)
+    coll = RESCollection.from_res_files([res, res])
+    entries = format_res_entries(coll)
+    assert entries == ["\n".join(res.to_res_lines())] * 2
+
+    # Entries without spins and with species beyond the fixed field widths
+    coll = RESCollection.from_packed(packed_res)
+    coll.data["has_spins"][1] = False
+    coll.symbols = np.array(["Fe", "Li", "O", "Siabcd"])
+    entries = format_res_entries(coll)
+    lines = entries[1].split("\n")
+    site_line = lines[[i for i, line in enumerate(lines) if line.startswith("SFAC")][0] + 1]
+    assert site_line.split()[:2] == ["Li", "1"]
+    assert len(site_line.split()) == 6
+    assert any(line.startswith("Siabcd ") for line in entries[0].split("\n"))
+
+
+def test_format_res_entries_no_spin():
+    """Test that missing TITL fields are written as by RESFile.to_res_lines"""
+    res = RESFile.from_file(RES_PATH)
+    data = {key: value for key, value in res.data.items() if key not in ("spin", "spin_abs", "spins")}
+    res = RESFile(res.structure, data)
+    entries = format_res_entries(RESCollection.from_res_files([res]))
+    assert entries == ["\n".join(res.to_res_lines())]
+    assert "nan" not in entries[0]
+    assert RESFile.from_string(entries[0]).spin == 0.0
+
+
+@pytest.mark.parametrize("values", [[0.5, -0.25, -1e-20, 0.0, 12.99999999999999], np.linspace(-3, 3, 1001)])
+def test_format_fixed(values):
+    """Test the vectorised fixed-point formatting"""
+    formatted = _format_fixed(values, 20, 13).view("S20").ravel().astype(str).tolist()
+    assert formatted == ["%20.13f" % value for value in values]
+    assert _format_fixed([1e10], 8, 3) is None
+
+
+@pytest.mark.parametrize("fname", ["export.res", "export.tar", "export.tar.gz"])
+def test_collection_write(packed_res, tmp_path, fname):
+    """Test writing the collection in bulk"""
+    coll = RESCollection.from_packed(packed_res)
+    output = tmp_path / fname
+    if fname.endswith(".res"):
+        coll.write_packed(output)
+        assert output.read_text() == "".join(format_res_entries(coll))
+        loaded = RESCollection.from_packed(output)
+        assert len(loaded) == 3
+        assert np.allclose(loaded.positions, coll.positions)
+        assert loaded[1].rem == coll[1].rem
+    else:
+        coll.write_tar(output)
+        with tarfile.open(output) as archive:
+            members = archive.getmembers()
+            # Repeated labels are made unique
+            label = coll[0].label
+            assert [member.name for member in members] == [label + ".res", label + "-1.res", label + "-2.res"]
+            assert archive.extractfile(members[0]).read().decode() == format_res_entries(coll)[0]
@@ -0,0 +1,70 @@
+"""
+Tests for the pool of pre-generated structures
+"""
+import os
+import subprocess
+
+import pytest
+
+from disp.buildpool import BuildcellPool, run_buildcell
+
+# pylint: disable=redefined-outer-name
+
+SEED = "#SPECIES=C\n#NATOM=2\n"
+
+
+@pytest.fixture
+def fake_buildcell(tmp_path, monkeypatch):
+    """A fake buildcell executable that echos the seed after its process id"""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    exe = bin_dir / "buildcell"
+    exe.write_text('#!/bin/bash\necho "GENERATED $$"\ncat\nif [ -f slow ]; then exec sleep 5; fi\n')
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    return exe
+
+
+def test_run_buildcell(fake_buildcell, tmp_path):
+    """Test running buildcell"""
+    _ = fake_buildcell
+    output = run_buildcell(SEED)
+    assert output.startswith("GENERATED")
+    assert SEED in output
+
+    (tmp_path / "slow").touch()
+    with pytest.raises(subprocess.TimeoutExpired):
+        run_buildcell(SEED, timeout=0.5, cwd=str(tmp_path))
+
+
+def test_pool(fake_buildcell, tmp_path):
+    """Test topping up and taking structures from the pool"""
+    _ = fake_buildcell
+    pool = BuildcellPool(tmp_path / "pool", depth=3)
+    assert pool.fill() == 0
+
+    # The seed is registered by the first request
+    assert pool.pop(SEED) is None
+    assert pool.fill(nworkers=2) == 3
+    seed_dir = pool.seed_dir(SEED)
+    assert pool.count(seed_dir) == 3
+    assert pool.fill() == 0
+
+    structures = {pool.pop(SEED) for _ in range(3)}
+    assert len(structures) == 3
+    assert all(SEED in structure for structure in structures)
+    assert pool.pop(SEED) is None
+    assert not list(seed_dir.glob(".*"))
+
+    # Idle seeds are not topped up
+    pool.max_idle = 0
+    assert pool.fill() == 0
+
+
+def test_pool_from_env(tmp_path, monkeypatch):
+    """Test configuring the pool"""
+    monkeypatch.delenv("DISP_BUILDCELL_POOL", raising=False)
+    assert BuildcellPool.from_env({}) is None
+    monkeypatch.setenv("DISP_BUILDCELL_POOL", str(tmp_path))
+    assert BuildcellPool.from_env(None).pool_dir == tmp_path
+    assert BuildcellPool.from_env({"buildcell_pool": "foo"}).pool_dir.name == "foo"
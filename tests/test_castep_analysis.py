@@ -0,0 +1,41 @@
+"""
+Test the castep_analysis module
+"""
+import json
+import shutil
+
+import pytest
+
+from disp.castep_analysis import SCFInfo, get_castep_summaries
+
+
+def test_scf_info(datapath):
+    """Test parsing the SCF information"""
+    scf = SCFInfo(datapath / "LFO.castep")
+    summary = scf.get_summary()
+    assert summary["ionic_steps"] == len(scf)
+    assert summary["total_time"] == pytest.approx(sum(scf.conv_data["durations"]))
+
+
+@pytest.mark.parametrize("nproc", [1, 2])
+def test_get_castep_summaries(datapath, tmp_path, nproc):
+    """Test obtaining summaries with caching"""
+    files = []
+    for name in ["a", "b"]:
+        shutil.copy2(datapath / "LFO.castep", tmp_path / f"{name}.castep")
+        files.append(str(tmp_path / f"{name}.castep"))
+    cache_file = str(tmp_path / "cache.json")
+    summaries = get_castep_summaries(files, cache_file=cache_file, nproc=nproc)
+    assert summaries[0] == summaries[1] == SCFInfo(files[0]).get_summary()
+
+    # Cached results are used unless the file has changed
+    with open(cache_file) as fhandle:
+        cache = json.load(fhandle)
+    cache[files[0]]["summary"]["ionic_steps"] = -1
+    with open(cache_file, "w") as fhandle:
+        json.dump(cache, fhandle)
+    with open(files[1], "a") as fhandle:
+        fhandle.write("\n")
+    summaries = get_castep_summaries(files, cache_file=cache_file, nproc=nproc)
+    assert summaries[0]["ionic_steps"] == -1
+    assert summaries[1]["ionic_steps"] == 1
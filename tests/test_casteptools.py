@@ -0,0 +1,109 @@
+"""
+Tests for the casteptools module
+"""
+import pytest
+
+from disp.casteptools import (
+    CastepOutputParser,
+    castep_finish_ok,
+    castep_geom_count,
+    count_cell_atoms,
+    get_castep_output,
+    gulp_relax_finish_ok,
+    parse_dot_castep,
+)
+
+GEOM_OUTPUT = """
+ Starting BFGS iteration          1 ...
+ BFGS: starting iteration         1 with trial guess (lambda=  1.000000)
+      1  -2.15000000E+002  0.00000000E+000   0.00000000E+000       1.50  <-- SCF
+      2  -2.15400000E+002  0.00000000E+000   0.00000000E+000       2.50  <-- SCF
+ BFGS: finished iteration     1 with enthalpy= -2.15498529E+002 eV
+Writing model to C2.check
+ Starting BFGS iteration          2 ...
+ BFGS: starting iteration         2 with trial guess (lambda=  1.000000)
+      1  -2.15500000E+002  0.00000000E+000   0.00000000E+000       3.50  <-- SCF
+ BFGS: finished iteration     2 with enthalpy= -2.15598529E+002 eV
+ BFGS: Geometry optimization completed successfully.
+Total time          =      9.53 s
+"""
+
+
+def test_parser_feed():
+    """Test parsing the lines of a geometry optimisation"""
+    parser = CastepOutputParser().feed(GEOM_OUTPUT.split("\n"))
+    assert parser.iter_started == 2
+    assert parser.geom_count == 2
+    assert parser.finished_iterations == 2
+    assert parser.geom_status == "completed"
+    assert [len(loop.loops) for loop in parser.scf_loops] == [2, 1]
+
+    out = parse_dot_castep(GEOM_OUTPUT.split("\n"))
+    assert out["H"] == [-2.15498529e2, -2.15598529e2]
+    assert out["time"] == [2.5, 3.5]
+    assert out["save_iter"] == [1]
+    assert out["name"] == "BFGS"
+
+
+def test_parser_update(datapath, tmp_path):
+    """Test incremental parsing of a growing file"""
+    content = (datapath / "LFO.castep").read_text()
+    full = CastepOutputParser().feed(content.split("\n")[:-1])
+
+    dot_castep = tmp_path / "LFO.castep"
+    # Write the first part with a partial line
+    split = content.index("<-- SCF", len(content) // 2) - 10
+    dot_castep.write_text(content[:split])
+    parser = CastepOutputParser(dot_castep).update()
+    assert parser.offset == content.rindex("\n", 0, split) + 1
+    assert not castep_finish_ok(dot_castep)
+
+    with open(dot_castep, "a") as fhandle:
+        fhandle.write(content[split:])
+    parser.update()
+    assert parser.nlines == full.nlines
+    assert parser.scf_loops == full.scf_loops
+    assert castep_finish_ok(dot_castep)
+    assert get_castep_output(dot_castep).nlines == full.nlines
+
+    # Truncated file should be parsed from the start
+    dot_castep.write_text(GEOM_OUTPUT)
+    assert castep_geom_count(dot_castep) == 2
+
+
+@pytest.mark.parametrize("aggregate", [True, False])
+def test_parse_dot_castep_file(datapath, aggregate):
+    """Test parse_dot_castep on a file handle"""
+    with open(datapath / "LFO.castep") as fhandle:
+        out = parse_dot_castep(fhandle, aggregate=aggregate)
+    assert out["save_iter"] == [0, 0]
+    assert len(out["H"]) == 0
+
+
+def test_gulp_relax_finish_ok(tmp_path):
+    """Test checking the output of gulp_relax, including long final structures"""
+    dot_castep = tmp_path / "C2.castep"
+    assert not gulp_relax_finish_ok(dot_castep)
+    lines = ["  Cycle:      1 Enthalpy:     -15.123456 eV"] * 10
+    dot_castep.write_text("\n".join(lines) + "\n")
+    assert not gulp_relax_finish_ok(dot_castep)
+
+    lines.append("  Final Enthalpy = -15.234567 eV")
+    dot_castep.write_text("\n".join(lines) + "\n")
+    assert gulp_relax_finish_ok(dot_castep)
+
+    # The final structure printed after the enthalpy
+    lines.extend(f"  {idx:5d} C   c   0.100000   0.200000   0.300000" for idx in range(200))
+    dot_castep.write_text("\n".join(lines) + "\n")
+    assert not gulp_relax_finish_ok(dot_castep, nlines=50)
+    assert gulp_relax_finish_ok(dot_castep, nlines=50, natoms=200)
+
+
+def test_count_cell_atoms(tmp_path):
+    """Test counting the atoms of a cell file"""
+    cell = tmp_path / "C2.cell"
+    cell.write_text(
+        "%BLOCK LATTICE_CART\n10 0 0\n0 10 0\n0 0 10\n%ENDBLOCK LATTICE_CART\n"
+        "%BLOCK POSITIONS_ABS\nang\n# comment\nC 0 0 0\nC 1 1 1 # C1\n%ENDBLOCK POSITIONS_ABS\n"
+    )
+    assert count_cell_atoms(cell) == 2
@@ -132,6 +132,15 @@ def test_deploy_search(isolated_project_dir, new_db):
     output = runner.invoke(main, args)
     assert output.exit_code == 0
 
+    # Batched search
+    args = ["--db-file", "disp_db.yaml", "--lpad-file", "my_launchpad.yaml", "deploy", "search"]
+    args.extend(["--seed", "Si2", "--num", "5", "--project", "testproject", "--batch-size", "2"])
+    output = runner.invoke(main, args)
+    assert output.exit_code == 0
+    lpad = LaunchPad.from_file("my_launchpad.yaml")
+    batches = lpad.fireworks.find({"spec._tasks.0.nstructures": {"$exists": True}})
+    assert sorted(fw["spec"]["_tasks"][0]["nstructures"] for fw in batches) == [1, 2, 2]
+
     # PP3 search
     args = ["--db-file", "disp_db.yaml", "--lpad-file", "my_launchpad.yaml", "deploy", "search", "--code", "pp3"]
     args.extend(["--seed", "Al", "--num", "5", "--project", "testproject"])
@@ -287,3 +296,57 @@ def test_admin(deploy_and_run, new_db, clean_launchpad):
     sdb = SearchDB.from_db_file("disp_db.yaml")
     assert ResFile.objects.count() == 0
     assert InitialStructureFile.objects.count() == 0
+
+
+def test_plan_pull_jobs(tmp_path):
+    """Test grouping launch directories for pulling"""
+    from collections import namedtuple
+
+    from disp.cli.cmd_db import (
+        get_rsync_command,
+        load_pull_manifest,
+        plan_pull_jobs,
+        save_pull_manifest,
+    )
+
+    info = namedtuple("FWInfo", ["fw_id", "seed_name", "project_name", "state", "launch_dir"])
+    data = [info(i, "C", "C/test", "COMPLETED", f"/home/user1/run/launcher_{i}") for i in range(5)]
+    data.append(info(5, "C", "C/test", "RUNNING", "/home/user1/run2/launcher_5"))
+    data.append(info(6, "C", "C/test", "RUNNING", "/home/user2/run/launcher_6"))
+    data.append(info(7, "C", "C/test", "READY", None))
+
+    jobs, nskipped = plan_pull_jobs(data, {"user1": "remote1"}, {}, chunk_size=2)
+    assert nskipped == 0
+    assert [(machine, parent, len(infos)) for machine, parent, infos in jobs] == [
+        ("remote1", "/home/user1/run", 2),
+        ("remote1", "/home/user1/run", 2),
+        ("remote1", "/home/user1/run", 1),
+        ("remote1", "/home/user1/run2", 1),
+    ]
+    assert get_rsync_command(*jobs[0]) == [
+        "rsync",
+        "-a",
+        "--include=launcher_0/***",
+        "--include=launcher_1/***",
+        "--exclude=*",
+        "remote1:/home/user1/run/",
+        "./",
+    ]
+
+    # Finished launch directories recorded in the manifest are skipped
+    fname = str(tmp_path / "manifest.json")
+    save_pull_manifest({item.launch_dir: item.state for item in data[:3] + data[5:6]}, fname)
+    jobs, nskipped = plan_pull_jobs(data, {"user1": "remote1"}, load_pull_manifest(fname), chunk_size=10)
+    assert nskipped == 3
+    assert [len(infos) for _, _, infos in jobs] == [2, 1]
+
+
+def test_retrieve_project_output_name():
+    """Test that output names of unknown formats are rejected before retrieving any data"""
+    from disp.cli.cmd_db import retrieve_project
+
+    runner = CliRunner()
+    for name in ["structures.zip", "structures", "res.tar.d/structures.res.gz"]:
+        output = runner.invoke(retrieve_project, ["--project", "testproject", "--output", name])
+        assert output.exit_code == 2
+        assert "Cannot infer the output format" in output.output
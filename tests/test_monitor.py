@@ -0,0 +1,169 @@
+"""
+Tests for the relaxation monitors
+"""
+import time
+
+import pytest
+
+from disp.fws.tasks import AirssCastepRelaxTask, RelaxOutcome
+from disp.monitor import (
+    CastepRelaxMonitor,
+    EnergyRise,
+    EnthalpyCutoff,
+    GnormDivergence,
+    GulpRelaxMonitor,
+    MaxScfPerStep,
+    build_rules,
+    project_final_energy,
+)
+
+# pylint: disable=protected-access
+
+CASTEP_STEP = """
+      1  -2.15000000E+002  0.00000000E+000   0.00000000E+000      {t1:.2f}  <-- SCF
+      2  -2.15400000E+002  0.00000000E+000   0.00000000E+000      {t2:.2f}  <-- SCF
+ BFGS: finished iteration {step:5d} with enthalpy= {enthalpy:.8E} eV
+ +-----------+-----------------+-----------------+------------+-----+ <-- BFGS
+ |  dE/ion   |   8.135442E-003 |   2.000000E-005 |         eV | No  | <-- BFGS
+ |  |F|max   |   {fmax:.6E} |   5.000000E-002 |       eV/A | No  | <-- BFGS
+"""
+
+
+def castep_steps(enthalpies, fmaxs):
+    """Generate the CASTEP output of a few ionic steps"""
+    return "".join(
+        CASTEP_STEP.format(t1=10.0 * i + 5, t2=10.0 * i + 10, step=i + 1, enthalpy=enthalpy, fmax=fmax)
+        for i, (enthalpy, fmax) in enumerate(zip(enthalpies, fmaxs))
+    )
+
+
+def gulp_lines(gnorms):
+    """Generate the GULP optimisation lines"""
+    return [
+        f"  Cycle:{i:6d} Energy:{-100.0 - i:17.6f}  Gnorm:{gnorm:14.6f}  CPU:{0.1 * i:9.3f}\n" for i, gnorm in enumerate(gnorms)
+    ]
+
+
+def test_castep_monitor():
+    """Test monitoring CASTEP output"""
+    monitor = CastepRelaxMonitor(rules=[EnergyRise(window=2)])
+    assert monitor.feed(castep_steps([-10.0, -11.0, -12.0], [1.0, 0.5, 0.2]).split("\n"))
+    assert monitor.nsteps == 3
+    assert monitor.gnorms == [1.0, 0.5, 0.2]
+    assert monitor.scf_counts == [2, 2, 2]
+    assert monitor.step_times == [10.0, 10.0, 10.0]
+
+    monitor = CastepRelaxMonitor(rules=[EnergyRise(window=2)])
+    assert not monitor.feed(castep_steps([-10.0, -11.0, -9.0, -12.0], [1.0, 0.5, 0.2, 0.1]).split("\n"))
+    assert monitor.nsteps == 3
+    assert "Energy rose" in monitor.abort_reason
+
+
+def test_gulp_monitor():
+    """Test monitoring GULP output"""
+    monitor = GulpRelaxMonitor(rules=[GnormDivergence()])
+    assert monitor.feed(gulp_lines([20, 15, 12, 11, 11, 10.5]))
+    assert not monitor.feed(gulp_lines([12]))
+    assert "Gnorm diverging" in monitor.abort_reason
+
+    monitor = GulpRelaxMonitor()
+    lines = gulp_lines([1.0])
+    assert not monitor.feed([lines[0].replace("-100.000000", "***********")])
+    assert monitor.abort_reason
+
+
+def test_build_rules():
+    """Test constructing the abort rules"""
+    rules = build_rules([{"rule": "max_scf_per_step", "max_scf": 10}, GnormDivergence()])
+    assert isinstance(rules[0], MaxScfPerStep)
+    assert rules[0].max_scf == 10
+    with pytest.raises(ValueError):
+        build_rules([{"rule": "foo"}])
+
+
+def test_enthalpy_cutoff():
+    """Test aborting relaxations projected to end with high enthalpy"""
+    assert project_final_energy([-10.0, -11.0, -11.5]) == pytest.approx(-12.0)
+    assert project_final_energy([-10.0, -11.0, -10.5]) == -11.0
+    assert project_final_energy([-10.0, -10.1, -10.3]) == pytest.approx(-10.3 - 0.2 * 9)
+
+    header = "                       Total number of ions in cell =    2\n"
+    enthalpies = [-12.0 + 2 * 0.5**i for i in range(6)]
+    lines = (header + castep_steps(enthalpies, [0.1] * 6)).split("\n")
+    # Projected to end at -6.0 eV/atom
+    monitor = CastepRelaxMonitor(rules=[EnthalpyCutoff(-6.2, window=0.5, min_steps=3)])
+    assert monitor.feed(lines)
+    assert monitor.natoms == 2
+
+    rule = EnthalpyCutoff(-6.6, window=0.5, min_steps=3)
+    monitor = CastepRelaxMonitor(rules=[rule])
+    assert not monitor.feed(lines)
+    assert monitor.nsteps == 3
+    assert monitor.abort_rule is rule
+    assert "Projected enthalpy" in monitor.abort_reason
+
+
+class FakeSearchDB:
+    """Stand-in for SearchDB returning a fixed set of enthalpies"""
+
+    def __init__(self, values):
+        self.values = values
+        self.ncalls = 0
+
+    def get_enthalpies_per_atom(self, project_name, seed_name=None):
+        _ = project_name, seed_name
+        self.ncalls += 1
+        return self.values
+
+
+def test_reference_enthalpy(tmp_path):
+    """Test obtaining the reference enthalpy with local caching"""
+    task = AirssCastepRelaxTask(cycles=10, param_content="", executable="castep")
+    task.energy_cutoff = {"min_count": 3, "percentile": 0}
+    task.base_path = tmp_path
+    task.project_name = "project/test"
+    task.seed_name = "C"
+    task.abort_rules = []
+    task._sdb = FakeSearchDB([-1.0, -2.0])
+
+    assert task._get_abort_rules() == []
+    task._sdb.values.append(-3.0)
+    # The cached values are used
+    assert task._get_abort_rules() == []
+    assert task._sdb.ncalls == 1
+
+    task.ENERGY_CUTOFF_DEFAULTS = dict(task.ENERGY_CUTOFF_DEFAULTS, max_age=0)
+    rules = task._get_abort_rules()
+    assert task._sdb.ncalls == 2
+    assert rules[0].reference == -3.0
+    assert (tmp_path / "airss-datastore/project/test/.enthalpy_cache_C.json").is_file()
+
+    task.abort_rule = rules[0]
+    assert task._get_abort_outcome() is RelaxOutcome.UNPROMISING
+    task.abort_rule = None
+    assert task._get_abort_outcome() is RelaxOutcome.ABORTED
+
+
+@pytest.mark.parametrize("abort_rules,expected", [([], None), ([{"rule": "energy_rise", "window": 1}], "Energy rose")])
+def test_run_script_monitored(tmp_path, monkeypatch, abort_rules, expected):
+    """Test running the job script while monitoring the output"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "steps.txt").write_text(castep_steps([-10.0, -9.0], [1.0, 1.0]))
+    (tmp_path / "jobscript.sh").write_text("#!/bin/bash\ncat steps.txt > test.castep\nsleep 2\n")
+    (tmp_path / "jobscript.sh").chmod(0o755)
+
+    task = AirssCastepRelaxTask(cycles=10, param_content="", executable="castep")
+    task.MONITOR_INTERVAL = 0.1
+    task.abort_rules = abort_rules
+    task.energy_cutoff = None
+    task.abort_reason = None
+    task.abort_rule = None
+    start = time.monotonic()
+    with open("stdout", "w") as stdout:
+        task._run_script(stdout, 10, "test")
+    if expected is None:
+        assert task.abort_reason is None
+        assert time.monotonic() - start > 2
+    else:
+        assert expected in task.abort_reason
+        assert time.monotonic() - start < 2
@@ -0,0 +1,272 @@
+"""
+Tests for the scheduler interface
+"""
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from disp.scheduler import (
+    END_TIME_ENV_VAR,
+    LSF,
+    PBS,
+    SIM_ENV_VAR,
+    SIM_QUEUE_ENV_VAR,
+    CachedQuery,
+    Dummy,
+    Scheduler,
+    Simulated,
+    SimulatedSlurmQueue,
+    Slurm,
+)
+
+# pylint: disable=protected-access
+
+
+class FakeScheduler(Scheduler):
+    """Scheduler counting the queries of the end time"""
+
+    nqueries = 0
+
+    @property
+    def job_id(self):
+        return "123"
+
+    def get_end_time(self):
+        type(self).nqueries += 1
+        return datetime.now() + timedelta(seconds=1000)
+
+
+@pytest.fixture(autouse=True)
+def clean_env(monkeypatch):
+    """Remove the cached scheduler and end time"""
+    monkeypatch.setenv(END_TIME_ENV_VAR, "")
+    monkeypatch.delenv("SLURM_JOB_ID", raising=False)
+    monkeypatch.delenv("JOB_ID", raising=False)
+    for name in [SIM_ENV_VAR, SIM_QUEUE_ENV_VAR, "DISP_SIM_START_TIME", "DISP_SIM_WALLTIME", "PBS_JOBID", "LSB_JOBID"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(Scheduler, "_instance", None)
+    monkeypatch.setattr(CachedQuery, "_cache", {})
+    FakeScheduler.nqueries = 0
+
+
+def test_remaining_seconds_cached():
+    """Test that the end time is queried only once and passed on to the child processes"""
+    sched = FakeScheduler()
+    assert 995 < sched.get_remaining_seconds() <= 1000
+    assert 995 < sched.get_remaining_seconds() <= 1000
+    assert FakeScheduler.nqueries == 1
+    assert os.environ[END_TIME_ENV_VAR].startswith("123:")
+
+    # A new instance, e.g. in a child process, uses the exported end time
+    assert 995 < FakeScheduler().get_remaining_seconds() <= 1000
+    assert FakeScheduler.nqueries == 1
+
+
+def test_exported_end_time_other_job(monkeypatch):
+    """Test that the end time exported for another job is ignored"""
+    monkeypatch.setenv(END_TIME_ENV_VAR, "456:0.0")
+    assert FakeScheduler().get_remaining_seconds() > 995
+    assert FakeScheduler.nqueries == 1
+
+
+def test_get_scheduler_cached(monkeypatch):
+    """Test that the scheduler instance is shared within the process"""
+    sched = Scheduler.get_scheduler()
+    assert isinstance(sched, Dummy)
+    assert Scheduler.get_scheduler() is sched
+    assert Scheduler.get_scheduler(refresh=True) is not sched
+
+    # A different job gives a new instance
+    monkeypatch.setenv("JOB_ID", "42")
+    monkeypatch.setattr("disp.scheduler.SGE._readtask_info", lambda self: None)
+    assert Scheduler.get_scheduler().job_id == "42"
+
+
+def test_slurm_array_tasks(monkeypatch):
+    """Test parsing the array tasks in the queue and submitting arrays"""
+    calls = []
+
+    class Completed:
+        stdout = (
+            "101|100|0|disp|R|None\n102|100|1|disp|PD|Priority\n103|200|0|disp|PD|JobHeldUser\n"
+            "104|104|N/A|disp|R|None\n105|105|N/A|disp|PD|Priority\n"
+        )
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return Completed()
+
+    monkeypatch.setattr("disp.scheduler.subprocess.run", run)
+    slurm = Slurm()
+    tasks = slurm.get_array_tasks(user_name="user", job_name="disp")
+    assert len(tasks) == 3
+    assert tasks[2] == {
+        "job_id": "103",
+        "array_id": "200",
+        "task_id": "0",
+        "name": "disp",
+        "state": "PD",
+        "reason": "JobHeldUser",
+        "held": True,
+    }
+    # The other queries use the same listing of the queue
+    # Jobs that are not part of an array are not array tasks
+    assert slurm.get_queue(user_name="user")[3]["array_id"] is None
+    assert slurm.get_running_jobs(user_name="user") == ["101", "104"]
+    assert slurm.get_pd_arrays(user_name="user") == ["100", "200"]
+    assert len(calls) == 1
+
+    Completed.stdout = "300;cluster\n"
+    assert slurm.submit_array("job.sh", 4, job_name="disp") == "300"
+    assert calls[-1] == ["sbatch", "--parsable", "--array=0-3", "--job-name=disp", "job.sh"]
+
+
+def test_cached_query():
+    """Test that the output of the queries is reused within the interval"""
+    now = [0.0]
+    calls = []
+
+    def runner(cmd):
+        calls.append(cmd)
+        return f"output {len(calls)}"
+
+    query = CachedQuery(runner, interval=30, clock=lambda: now[0])
+    assert query(["squeue"]) == "output 1"
+    now[0] = 29
+    assert query(["squeue"]) == "output 1"
+    assert query(["squeue", "-u", "user"]) == "output 2"
+    now[0] = 31
+    assert query(["squeue"]) == "output 3"
+    query.invalidate()
+    assert query(["squeue"]) == "output 4"
+
+
+def test_pbs(monkeypatch):
+    """Test the PBS Pro backend"""
+    jobs = {
+        "Jobs": {
+            "10[].server": {"Job_Owner": "user@host", "Job_Name": "disp", "job_state": "B", "array": "True"},
+            "10[0].server": {"Job_Owner": "user@host", "Job_Name": "disp", "job_state": "R"},
+            "10[1].server": {"Job_Owner": "user@host", "Job_Name": "disp", "job_state": "Q"},
+            "10[2].server": {"Job_Owner": "user@host", "Job_Name": "disp", "job_state": "X"},
+            "11[0].server": {"Job_Owner": "user@host", "Job_Name": "disp", "job_state": "H"},
+            "12.server": {"Job_Owner": "other@host", "Job_Name": "disp", "job_state": "Q"},
+            "13.server": {
+                "Job_Owner": "user@host",
+                "Job_Name": "single",
+                "job_state": "R",
+                "stime": "Sun Oct 18 10:00:00 2026",
+                "Resource_List": {"walltime": "02:00:00", "ncpus": 16},
+            },
+        }
+    }
+    calls = []
+
+    def runner(cmd):
+        calls.append(cmd)
+        return json.dumps(jobs) if cmd[0] == "qstat" else "20[].server\n"
+
+    monkeypatch.setenv("PBS_JOBID", "13.server")
+    monkeypatch.delenv("NCPUS", raising=False)
+    pbs = PBS(runner=runner)
+    assert pbs.get_end_time() == datetime(2026, 10, 18, 12)
+    assert pbs.get_n_cpus() == 16
+    tasks = pbs.get_array_tasks(user_name="user", job_name="disp")
+    assert [(task["array_id"], task["state"], task["held"]) for task in tasks] == [
+        ("10[].server", "R", False),
+        ("10[].server", "PD", False),
+        ("11[].server", "PD", True),
+    ]
+    pbs.hold_arrays(["10[].server"])
+    assert calls[-1] == ["qhold", "10[].server"]
+    pbs.hold_tasks(tasks[1:2])
+    assert calls[-1] == ["qhold", "10[1].server"]
+    pbs.release_tasks(tasks[2:])
+    assert calls[-1] == ["qrls", "11[0].server"]
+    assert pbs.submit_array("job.sh", 2, job_name="disp") == "20[].server"
+    assert calls[-1] == ["qsub", "-J", "0-1", "-N", "disp", "job.sh"]
+
+
+def test_lsf(monkeypatch):
+    """Test the LSF backend"""
+    records = [
+        {"JOBID": "10", "JOBINDEX": "1", "STAT": "RUN", "JOB_NAME": "disp[1-3]", "PEND_REASON": "", "TIME_LEFT": "1:30 L"},
+        {"JOBID": "10", "JOBINDEX": "2", "STAT": "PEND", "JOB_NAME": "disp[1-3]", "PEND_REASON": "Priority"},
+        {"JOBID": "10", "JOBINDEX": "3", "STAT": "PSUSP", "JOB_NAME": "disp[1-3]", "PEND_REASON": "Suspended"},
+        {"JOBID": "11", "JOBINDEX": "0", "STAT": "RUN", "JOB_NAME": "single", "PEND_REASON": ""},
+    ]
+    calls = []
+
+    def runner(cmd):
+        calls.append(cmd)
+        return json.dumps({"RECORDS": records}) if cmd[0] == "bjobs" else "Job <20> is submitted to queue <normal>.\n"
+
+    monkeypatch.setenv("USER", "user")
+    monkeypatch.setenv("LSB_JOBID", "10")
+    monkeypatch.setenv("LSB_JOBINDEX", "1")
+    lsf = LSF(runner=runner)
+    assert lsf.job_id == "10[1]"
+    assert 5390 < (lsf.get_end_time() - datetime.now()).total_seconds() <= 5400
+    tasks = lsf.get_array_tasks(user_name="user", job_name="disp")
+    assert [(task["job_id"], task["state"], task["held"]) for task in tasks] == [
+        ("10[1]", "R", False),
+        ("10[2]", "PD", False),
+        ("10[3]", "PD", True),
+    ]
+    # Only the pending tasks are suspended
+    lsf.hold_arrays(["10"])
+    assert calls[-1] == ["bstop", "10[2]"]
+    lsf.release_tasks(tasks[1:])
+    assert calls[-1] == ["bresume", "10[2,3]"]
+    assert lsf.submit_array("job.sh", 3, job_name="disp") == "20"
+    assert calls[-1] == ["bsub", "-J", "disp[1-3]", "job.sh"]
+
+
+def test_simulated_scheduler(tmp_path, monkeypatch):
+    """Test the simulated scheduler taking the walltime from a file and the environment"""
+    settings = tmp_path / "sim.json"
+    settings.write_text('{"job_id": "42", "walltime": 100, "ncpus": 8}')
+    monkeypatch.setenv(SIM_ENV_VAR, str(settings))
+    sched = Scheduler.get_scheduler()
+    assert isinstance(sched, Simulated)
+    assert sched.get_n_cpus() == 8
+    assert 95 < sched.get_remaining_seconds() <= 100
+    # The start time is shared with the child processes
+    assert "DISP_SIM_START_TIME" in os.environ
+
+    monkeypatch.setenv("DISP_SIM_WALLTIME", "1000")
+    assert 995 < Scheduler.get_scheduler(refresh=True).get_remaining_seconds() <= 1000
+
+
+def test_simulated_slurm_queue(tmp_path, monkeypatch):
+    """Test running the SLURM commands against the simulated queue"""
+    monkeypatch.setenv("USER", "user")
+    now = [1.0e9]
+    queue = SimulatedSlurmQueue(tmp_path / "queue.json", max_running=2, walltime=100, clock=lambda: now[0])
+    slurm = Slurm(runner=queue)
+    array_id = slurm.submit_array("job.sh", 3, job_name="disp")
+    assert [task["state"] for task in slurm.get_array_tasks()] == ["R", "R", "PD"]
+    assert slurm.get_pd_arrays(user_name="user") == [array_id]
+
+    slurm.hold_arrays([array_id])
+    now[0] += 200
+    # The running tasks are finished, the held one is not started
+    assert [(task["state"], task["reason"]) for task in slurm.get_array_tasks(job_name="disp")] == [("PD", "JobHeldUser")]
+    slurm.release_arrays([array_id])
+    assert [task["state"] for task in slurm.get_array_tasks(job_name="disp")] == ["R"]
+
+    # Individual tasks are held and released
+    slurm.submit_array("job.sh", 3, job_name="more")
+    tasks = slurm.get_array_tasks(job_name="more")
+    slurm.hold_tasks(tasks[1:])
+    assert [task["held"] for task in slurm.get_array_tasks(job_name="more")] == [False, True, True]
+    slurm.release_tasks(tasks[2:])
+    assert [task["held"] for task in slurm.get_array_tasks(job_name="more")] == [False, True, False]
+
+    # A job started from the simulated queue reads its end time with scontrol
+    monkeypatch.setenv(SIM_QUEUE_ENV_VAR, str(tmp_path / "queue2.json"))
+    monkeypatch.setenv("SLURM_JOB_ID", Slurm().submit_array("job.sh", 1))
+    monkeypatch.setattr(Slurm, "_task_info", None)
+    assert 3500 < Slurm().get_remaining_seconds() <= 3600
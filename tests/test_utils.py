@@ -5,7 +5,7 @@ from io import StringIO
 
 import pytest
 
-from disp.utils import filter_out_stream, trim_stream
+from disp.utils import filter_out_stream, read_tail, trim_stream
 
 
 @pytest.fixture
@@ -45,3 +45,15 @@ def test_filter(stream):
     assert "%BLOCK B" in res
     assert "%ENDBLOCK B" in res
     assert "%BLOCK A" not in res
+
+
+@pytest.mark.parametrize("ending", ["\n", ""])
+@pytest.mark.parametrize("block_size", [3, 4096])
+def test_read_tail(tmp_path, ending, block_size):
+    """Test reading the last few lines of a file"""
+    lines = [f"line {i}" for i in range(100)]
+    fname = tmp_path / "test.txt"
+    fname.write_text("\n".join(lines) + ending)
+    assert read_tail(fname, 5, block_size=block_size) == lines[-5:]
+    assert read_tail(fname, 200, block_size=block_size) == lines
+    assert read_tail(fname, 0) == []